@@ -0,0 +1,102 @@
+# Copyright (C) 2025 Entidad Pública Empresarial Red.es
+#
+# This file is part of "dge-ga-report (datos.gob.es)".
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import gzip
+import json
+import logging
+import datetime
+import tempfile
+
+from ckan.plugins.toolkit import (config)
+
+log = logging.getLogger(__name__)
+
+ARCHIVE_EXTENSION = '.jsonl.gz'
+
+
+def get_archive_dir():
+    '''Returns the directory of the archive, or None if it is disabled'''
+    return config.get('ckanext-dge-ga-report.archive.dir', None)
+
+
+def get_archive_path(period_name, stat):
+    return os.path.join(get_archive_dir(), stat, period_name + ARCHIVE_EXTENSION)
+
+
+def is_archived(period_name, stat):
+    return bool(get_archive_dir()) and os.path.exists(get_archive_path(period_name, stat))
+
+
+def write_archive(period_name, period_complete_day, stat, rows, source='ga4'):
+    '''
+    Writes the rows of the stat in the period, as classified after the
+    download, to a gzipped JSONL file. The first line is a header with the
+    period, the stat and the last day of the period loaded.
+    '''
+    if not get_archive_dir():
+        return None
+    path = get_archive_path(period_name, stat)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    header = {'period': period_name, 'stat': stat, 'end_day': period_complete_day,
+              'source': source, 'created': datetime.datetime.now().isoformat()}
+    # write to a temporary file and rename, so a failed load does not
+    # leave a partial archive
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as raw, gzip.open(raw, 'wt', encoding='utf-8') as archive:
+            archive.write(json.dumps(header) + '\n')
+            count = 0
+            for row in rows:
+                archive.write(json.dumps(row) + '\n')
+                count += 1
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    log.info('Archived %i rows of stat %s in period %s in %s', count, stat, period_name, path)
+    return path
+
+
+def read_archive_header(period_name, stat):
+    with gzip.open(get_archive_path(period_name, stat), 'rt', encoding='utf-8') as archive:
+        return json.loads(archive.readline())
+
+
+def read_archive(period_name, stat, chunk_size=10000):
+    '''Yields the archived rows of the stat in the period in lists of up to
+    chunk_size rows, so the file is never loaded whole into memory'''
+    with gzip.open(get_archive_path(period_name, stat), 'rt', encoding='utf-8') as archive:
+        archive.readline()
+        chunk = []
+        for line in archive:
+            chunk.append(tuple(json.loads(line)))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def get_archived_periods(stat):
+    '''Returns the names of the periods archived for the stat'''
+    stat_dir = os.path.join(get_archive_dir() or '', stat)
+    if not get_archive_dir() or not os.path.isdir(stat_dir):
+        return []
+    return sorted(name[:-len(ARCHIVE_EXTENSION)] for name in os.listdir(stat_dir)
+                  if name.endswith(ARCHIVE_EXTENSION))
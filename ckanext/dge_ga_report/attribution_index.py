@@ -0,0 +1,274 @@
+# Copyright (C) 2025 Entidad Pública Empresarial Red.es
+#
+# This file is part of "dge-ga-report (datos.gob.es)".
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Read-only snapshot of the package and resource attribution in a
+memory-mapped file, so worker processes can resolve urls without
+database connections.
+
+The file has a header, an open addressing hash table of fixed size slots
+and the keys and values, utf-8 encoded:
+
+  header: magic, catalog fingerprint, number of slots, number of entries
+  slot:   blake2b hash of the key, offset of the key, key length, value length
+
+Package keys are the package name or id, and their values the package id,
+name, organization id and publisher id. Resource keys are the package id
+and the resource url, and their values the resource id and format.
+'''
+
+import os
+import mmap
+import struct
+import hashlib
+import logging
+import tempfile
+
+from sqlalchemy import func
+
+import ckan.model as model
+from ckan.plugins.toolkit import (config)
+
+from . import ga_model
+from .lib import get_cache_dir, check_private_dir
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'DGEGAIX1'
+HEADER = struct.Struct('<8s32sQQ')
+SLOT = struct.Struct('<QQII')
+SEPARATOR = '\x1f'
+
+PACKAGE_PREFIX = 'p\x00'
+RESOURCE_PREFIX = 'r\x00'
+
+
+def get_snapshot_path():
+    return config.get('ckanext-dge-ga-report.attribution_index.path',
+                      os.path.join(get_cache_dir(), 'attribution.idx'))
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+
+def _encode_value(*fields):
+    return SEPARATOR.join(field or '' for field in fields).encode('utf-8')
+
+
+def _get_package_key(package_ref):
+    return (PACKAGE_PREFIX + package_ref).encode('utf-8')
+
+
+def _get_resource_key(package_id, resource_url):
+    return (RESOURCE_PREFIX + package_id + '\x00' + resource_url).encode('utf-8')
+
+
+def _decode_value(value):
+    return tuple(field or None for field in value.decode('utf-8').split(SEPARATOR))
+
+
+def get_catalog_fingerprint(session=None):
+    '''
+    Returns a digest of the state of the catalog and the package
+    attribution table. It changes whenever a package or resource is
+    created, updated, deleted or purged.
+    '''
+    session = session or model.Session
+    values = [
+        session.query(func.count(model.Package.id), func.max(model.Package.metadata_modified)).one(),
+        session.query(func.count(model.Resource.id)).filter(model.Resource.state=='active').one(),
+    ]
+    if ga_model.is_package_attribution_built(session):
+        values.append(session.query(func.count(ga_model.DgeGaPackageAttribution.package_name),
+                                    func.max(ga_model.DgeGaPackageAttribution.modified)).one())
+    return hashlib.blake2b(repr([tuple(value) for value in values]).encode('utf-8'),
+                           digest_size=32).digest()
+
+
+def _get_package_entries(session):
+    '''Yields the package keys and values, the most recent first'''
+    if ga_model.is_package_attribution_built(session):
+        query = session.query(ga_model.DgeGaPackageAttribution).\
+            order_by(ga_model.DgeGaPackageAttribution.modified.desc())
+        for item in query.yield_per(1000):
+            yield item.package_id, item.package_name, item.organization_id, item.publisher_id
+    else:
+        query = session.query(model.Package).order_by(model.Package.metadata_modified.desc())
+        for package in query.yield_per(1000):
+            org_id, pub_id = ga_model.get_package_organization_and_publisher(package, session)
+            yield package.id, package.name, org_id, pub_id
+
+
+def build_snapshot(path=None, session=None):
+    '''
+    Writes the attribution snapshot of the current catalog. The file is
+    written to a temporary file and renamed, so processes that have the
+    previous snapshot open keep reading it.
+    '''
+    path = path or get_snapshot_path()
+    session = session or model.Session
+    fingerprint = get_catalog_fingerprint(session)
+
+    entries = {}
+    for package_id, package_name, org_id, pub_id in _get_package_entries(session):
+        value = _encode_value(package_id, package_name, org_id, pub_id)
+        for package_ref in (package_name, package_id):
+            if package_ref:
+                entries.setdefault(_get_package_key(package_ref), value)
+    resources = session.query(model.Resource.package_id, model.Resource.url,
+                              model.Resource.id, model.Resource.format).\
+        filter(model.Resource.state=='active')
+    for package_id, url, resource_id, res_format in resources.yield_per(1000):
+        if url:
+            entries.setdefault(_get_resource_key(package_id, url),
+                               _encode_value(resource_id, res_format))
+    return write_snapshot(path, fingerprint, entries)
+
+
+def write_snapshot(path, fingerprint, entries):
+    '''
+    Writes a snapshot with the entries, a dict of encoded keys and values,
+    to a temporary file and renames it. Returns the number of entries.
+    '''
+    # power of two slots with a load factor of at most a half
+    slots = 1
+    while slots < len(entries) * 2:
+        slots *= 2
+    mask = slots - 1
+    table = bytearray(slots * SLOT.size)
+    offset = HEADER.size + len(table)
+    for key, value in entries.items():
+        key_hash = _hash(key)
+        slot = key_hash & mask
+        while SLOT.unpack_from(table, slot * SLOT.size)[2]:
+            slot = (slot + 1) & mask
+        SLOT.pack_into(table, slot * SLOT.size, key_hash, offset, len(key), len(value))
+        offset += len(key) + len(value)
+
+    if not check_private_dir(os.path.dirname(path)):
+        raise IOError('%s can not be used for the attribution snapshot' % os.path.dirname(path))
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as snapshot:
+            snapshot.write(HEADER.pack(MAGIC, fingerprint, slots, len(entries)))
+            snapshot.write(table)
+            for key, value in entries.items():
+                snapshot.write(key)
+                snapshot.write(value)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    log.info('Wrote attribution snapshot %s with %d entries', path, len(entries))
+    return len(entries)
+
+
+def read_fingerprint(path=None):
+    '''Returns the catalog fingerprint of a snapshot, or None if there is
+    no valid snapshot'''
+    try:
+        with open(path or get_snapshot_path(), 'rb') as snapshot:
+            magic, fingerprint, slots, count = HEADER.unpack(snapshot.read(HEADER.size))
+    except (IOError, OSError, struct.error):
+        return None
+    return fingerprint if magic == MAGIC else None
+
+
+def ensure_snapshot(path=None, force=False, session=None):
+    '''Builds the snapshot if it does not exist or the catalog has changed
+    since it was built. Returns True if it was built.'''
+    path = path or get_snapshot_path()
+    if not force and read_fingerprint(path) == get_catalog_fingerprint(session):
+        log.debug('Attribution snapshot %s is up to date', path)
+        return False
+    build_snapshot(path, session)
+    return True
+
+
+class AttributionIndex(object):
+    '''
+    Read-only view of an attribution snapshot. The file is memory-mapped,
+    so processes opening the same snapshot share its pages, and lookups
+    only decode the entry found.
+    '''
+
+    def __init__(self, path=None):
+        self.path = path or get_snapshot_path()
+        with open(self.path, 'rb') as snapshot:
+            self._map = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.fingerprint, self.slots, self.entries = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self._map.close()
+            raise ValueError('%s is not an attribution snapshot' % self.path)
+        self._mask = self.slots - 1
+
+    def close(self):
+        self._map.close()
+
+    def _lookup(self, key):
+        key_hash = _hash(key)
+        slot = key_hash & self._mask
+        while True:
+            slot_hash, offset, key_length, value_length = \
+                SLOT.unpack_from(self._map, HEADER.size + slot * SLOT.size)
+            if not key_length:
+                return None
+            if slot_hash == key_hash and self._map[offset:offset + key_length] == key:
+                return _decode_value(self._map[offset + key_length:offset + key_length + value_length])
+            slot = (slot + 1) & self._mask
+
+    def get_package(self, package_ref):
+        '''Returns the package id, package name, organization id and
+        publisher id of a package name or id, or None'''
+        return self._lookup(_get_package_key(package_ref))
+
+    def get_resource(self, package_id, resource_url):
+        '''Returns the resource id and format of the resource of the package
+        with the url (or any of its variants), or None'''
+        if not package_id:
+            return None
+        for url in ga_model.get_resource_url_variants(resource_url):
+            resource = self._lookup(_get_resource_key(package_id, url))
+            if resource is not None:
+                return resource
+        return None
+
+
+class MappedIdentifier(ga_model.Identifier):
+    '''
+    Identifier that finds the attribution of urls in an attribution
+    snapshot instead of the database.
+    '''
+
+    def __init__(self, index):
+        ga_model.Identifier.__init__(self)
+        self.index = index
+
+    def _get_package_attribution(self, package_ref):
+        return self.index.get_package(package_ref)
+
+    def get_resource_information(self, resource_url, package_url):
+        package_ref = self.get_package_ref(package_url)
+        attribution = self._get_package_attribution(package_ref) if package_ref else None
+        if attribution is None:
+            return None, None, None, None, None
+        package_id, package_name, org_id, pub_id = attribution
+        resource = self.index.get_resource(package_id, resource_url)
+        if resource is not None:
+            return resource[0], package_name, org_id, pub_id, resource[1]
+        return None, package_name, org_id, pub_id, None
@@ -0,0 +1,172 @@
+# Copyright (C) 2025 Entidad Pública Empresarial Red.es
+#
+# This file is part of "dge-ga-report (datos.gob.es)".
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import re
+import json
+import logging
+import itertools
+import tempfile
+import stat
+
+from ckan.plugins.toolkit import (config)
+from . import ga_model
+from .lib import check_private_dir
+
+log = logging.getLogger(__name__)
+
+STATUS_DOWNLOADING = 'downloading'
+STATUS_DOWNLOADED = 'downloaded'
+STATUS_DONE = 'done'
+
+
+def get_checkpoint_dir():
+    return config.get('ckanext-dge-ga-report.checkpoint.dir',
+                      os.path.join(tempfile.gettempdir(), 'dge_ga_report_checkpoints'))
+
+
+class LoadCheckpoint(object):
+    '''
+    Progress of the load of a stat (or a section of the visits stat) in a
+    period. The pages fetched from GA are kept in a spool file, so a
+    resumed load does not request them again, and the number of rows
+    stored is kept in the dge_ga_load_checkpoints table.
+
+    A checkpoint belongs to the load of the period until end_date
+    (YYYY-MM-DD), so it is only resumed by a load until the same day: the
+    checkpoint of the current month loaded yesterday is started again.
+
+    The spool files are only kept in a directory private to the current
+    user; otherwise the pages are not spooled and a checkpoint is not
+    resumed, as its pages could have been written by another user.
+    '''
+
+    def __init__(self, period_name, stat, section='', resume=False, end_date=''):
+        self.period_name = period_name
+        self.stat = stat
+        self.section = section or ''
+        self.end_date = end_date or ''
+        self.spool_path = os.path.join(
+            get_checkpoint_dir(),
+            re.sub('[^a-zA-Z0-9_-]', '_', '%s_%s_%s' % (period_name, stat, self.section)) + '.jsonl')
+        self.is_private = check_private_dir(get_checkpoint_dir())
+        values = ga_model.get_load_checkpoint(period_name, stat, self.section) if resume else None
+        if values is not None and not self.is_private:
+            log.warning('Checkpoint directory %s is not private, %s %s %s is started again',
+                        get_checkpoint_dir(), period_name, stat, self.section)
+            values = None
+        if values is not None and values['end_date'] != self.end_date:
+            log.info('Checkpoint of %s %s %s is of a load until %s, not %s. Starting again',
+                     period_name, stat, self.section, values['end_date'] or '(unknown)', self.end_date)
+            values = None
+        if values is None:
+            ga_model.reset_load_checkpoint(period_name, stat, self.section, STATUS_DOWNLOADING,
+                                           self.end_date)
+            values = {'status': STATUS_DOWNLOADING, 'pages_fetched': 0, 'rows_stored': 0}
+            self._remove_spool()
+        else:
+            log.info('Resuming %s %s %s from checkpoint %s', period_name, stat, self.section, values)
+        self.status = values['status']
+        self.pages_fetched = values['pages_fetched']
+        self.rows_stored = values['rows_stored']
+
+    def __repr__(self):
+        return '<LoadCheckpoint %s %s %s end_date=%s, status=%s, pages_fetched=%s, rows_stored=%s>' % \
+               (self.period_name, self.stat, self.section, self.end_date, self.status,
+                self.pages_fetched, self.rows_stored)
+
+    @property
+    def is_done(self):
+        return self.status == STATUS_DONE
+
+    @property
+    def is_downloaded(self):
+        return self.status in (STATUS_DOWNLOADED, STATUS_DONE)
+
+    def _is_own_spool(self):
+        '''Returns True if the spool file is a regular file of the current
+        user that other users can not write'''
+        try:
+            info = os.lstat(self.spool_path)
+        except OSError:
+            return False
+        if not stat.S_ISREG(info.st_mode) or info.st_mode & 0o022:
+            return False
+        return not hasattr(os, 'getuid') or info.st_uid == os.getuid()
+
+    def _count_pages(self):
+        count = 0
+        if self.pages_fetched and self.is_private and self._is_own_spool():
+            with open(self.spool_path, 'r', encoding='utf-8') as spool:
+                for line in spool:
+                    if count == self.pages_fetched:
+                        break
+                    count += 1
+        return count
+
+    def _read_pages(self, count):
+        with open(self.spool_path, 'r', encoding='utf-8') as spool:
+            for line in itertools.islice(spool, count):
+                yield json.loads(line)
+
+    def get_pages(self):
+        '''Returns an iterator of the rows of the pages already fetched. The
+        pages are read from the spool file one at a time.'''
+        count = self._count_pages()
+        if count != self.pages_fetched:
+            log.warning('Spool file %s has %d pages, %d expected. Fetching them again',
+                        self.spool_path, count, self.pages_fetched)
+            self._remove_spool()
+            self.pages_fetched = 0
+            self.status = STATUS_DOWNLOADING
+            self._update(pages_fetched=0, status=STATUS_DOWNLOADING)
+            return iter([])
+        if not count:
+            return iter([])
+        return self._read_pages(count)
+
+    def add_page(self, rows):
+        if not self.is_private:
+            return
+        fd = os.open(self.spool_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        with open(fd, 'a', encoding='utf-8') as spool:
+            spool.write(json.dumps(rows) + '\n')
+            spool.flush()
+            os.fsync(spool.fileno())
+        self.pages_fetched += 1
+        self._update(pages_fetched=self.pages_fetched)
+
+    def set_downloaded(self):
+        self.status = STATUS_DOWNLOADED
+        self._update(status=STATUS_DOWNLOADED)
+
+    def set_rows_stored(self, rows_stored, commit=True):
+        self.rows_stored = rows_stored
+        self._update(commit=commit, rows_stored=rows_stored)
+
+    def set_done(self):
+        self.status = STATUS_DONE
+        self._update(status=STATUS_DONE)
+        self._remove_spool()
+
+    def _update(self, commit=True, **values):
+        ga_model.update_load_checkpoint(self.period_name, self.stat, self.section,
+                                        commit=commit, **values)
+
+    def _remove_spool(self):
+        if self.is_private and os.path.lexists(self.spool_path):
+            os.remove(self.spool_path)
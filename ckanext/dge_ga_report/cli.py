@@ -24,17 +24,19 @@ import os
 import sys
 import io
 import csv
+import threading
+import concurrent.futures
 import ckanext.dge_ga_report.ga_model as ga_model
-from ckan.plugins.toolkit import (config)
+from ckan.plugins.toolkit import (config, asbool, asint)
 from ckan.model import Session
-from ckanext.dge_ga_report.ga_auth import init_service
 import logging
 from sqlalchemy import create_engine, text
 log = logging.getLogger(__name__)
 
 
 def get_commands():
-    return [dge_ga_report_initdb, dge_ga_report_getauthtoken, dge_ga_report_loadanalytics,dge_ga_report_generate_csv,dge_ga_report_generate_csv_admin]
+    return [dge_ga_report_initdb, dge_ga_report_getauthtoken, dge_ga_report_loadanalytics,dge_ga_report_generate_csv,dge_ga_report_generate_csv_admin,
+            dge_ga_report_index]
 
 
 @click.group("dge_ga_report_initdb")
@@ -56,6 +58,94 @@ def initdb():
         sys.exit(1)
 
 
+@click.group("dge_ga_report_index")
+def dge_ga_report_index():
+    """Maintains the lookup tables used to attribute GA data
+
+    Usage: paster dge_ga_report_index rebuild
+           paster dge_ga_report_index snapshot [--force]
+           paster dge_ga_report_index reindex_changed
+    """
+    pass
+
+@dge_ga_report_index.command("rebuild")
+def rebuild():
+    """Builds the resource url index and the package attribution of every package"""
+    init = datetime.datetime.now()
+    try:
+        count = ga_model.rebuild_resource_url_index()
+        click.echo('Indexed %d resource urls' % count)
+        count, purged = ga_model.rebuild_package_attribution()
+        click.echo('Stored the attribution of %d packages and %d purged packages' % (count, purged))
+    except Exception as e:
+        click.secho('Exception %s' % e)
+        sys.exit(1)
+    finally:
+        end = datetime.datetime.now()
+        click.echo('End DgeGaReportIndex command. Executed command in %s milliseconds' %
+                   ((end-init).total_seconds()*1000))
+
+
+@dge_ga_report_index.command("snapshot")
+@click.option('--force', '-f', is_flag=True, default=False,
+              help='Writes the snapshot even if the catalog has not changed.')
+def snapshot(force):
+    """Writes the attribution snapshot read by the worker processes. It is
+    also written when the worker processes are started, if the catalog has
+    changed since it was last written"""
+    from .attribution_index import ensure_snapshot, get_snapshot_path
+    init = datetime.datetime.now()
+    try:
+        if ensure_snapshot(force=force):
+            click.echo('Attribution snapshot written to %s' % get_snapshot_path())
+        else:
+            click.echo('Attribution snapshot %s is up to date' % get_snapshot_path())
+    except Exception as e:
+        click.secho('Exception %s' % e)
+        sys.exit(1)
+    finally:
+        end = datetime.datetime.now()
+        click.echo('End DgeGaReportIndex command. Executed command in %s milliseconds' %
+                   ((end-init).total_seconds()*1000))
+
+
+@dge_ga_report_index.command("reindex_changed")
+@click.option('--batch-size', '-b', default=1000, type=int,
+              help='Number of packages reindexed before each commit.')
+def reindex_changed(batch_size):
+    """Reindexes the packages whose view or download counts changed since
+    they were last pushed to the search index"""
+    from ckan import model
+    from ckan.lib import search
+    init = datetime.datetime.now()
+    try:
+        ga_model.clear_index_counts()
+        changed = ga_model.get_changed_index_counts()
+        package_names = sorted(changed)
+        click.echo('The counts of %d packages have changed' % len(package_names))
+        reindexed = 0
+        for index in range(0, len(package_names), batch_size):
+            batch = package_names[index:index + batch_size]
+            package_ids = [result[0] for result in
+                           Session.query(model.Package.id).
+                           filter(model.Package.name.in_(batch)).
+                           filter(model.Package.state=='active').all()]
+            if package_ids:
+                search.rebuild(package_ids=package_ids, defer_commit=True)
+                search.commit()
+                reindexed += len(package_ids)
+            ga_model.store_indexed_counts(dict((name, changed[name]) for name in batch))
+            Session.commit()
+        click.echo('Reindexed %d packages' % reindexed)
+    except Exception as e:
+        click.secho('Exception %s' % e)
+        sys.exit(1)
+    finally:
+        end = datetime.datetime.now()
+        click.echo('End DgeGaReportIndex command. Executed command in %s milliseconds' %
+                   ((end-init).total_seconds()*1000))
+
+
 @click.group("dge_ga_report_getauthtoken")
 def dge_ga_report_getauthtoken():
     """ Get's the Google auth token
@@ -76,9 +166,11 @@ def get_token():
     act as a form of verification instead of just getting the token and
     assuming it is correct.
     """
+    from ckanext.dge_ga_report.ga_auth import init_service
+
     try:
         click.secho('Credentials file')
-        init_service(config.get('ckanext-dge-ga-report.token.filepath', None))
+        init_service(config.get('ckanext-dge-ga-report.token.filepath', None), use_cache=False)
     except Exception as e:
         click.secho('Exception %s' % e)
         sys.exit(1)
@@ -102,13 +194,385 @@ def dge_ga_report_loadanalytics():
         pages       - pageviews for datasets and totalevents for resources
 
       <time-period> is:
-        latest      - (default) just the 'latest' data
-        YYYY-MM     - just data for the specific month
-        last_month  - just data for tha last month
+        latest          - (default) just the 'latest' data
+        YYYY-MM         - just data for the specific month
+        last_month      - just data for tha last month
+        YYYY-MM:YYYY-MM - data for every month in the range (both included)
+
+    Usage: paster dge_ga_report_loadanalytics reprocess <time-period>
+
+    Rebuilds the stats of the <time-period> (YYYY-MM or YYYY-MM:YYYY-MM)
+    from the archive of raw GA data.
+
+    Usage: paster dge_ga_report_loadanalytics export_ua <time-period>
+
+    Downloads the UA months of the <time-period> to the archive.
+
+    Usage: paster dge_ga_report_loadanalytics summaries [<time-period>]
+
+    Refreshes the tables precomputed from the stored stats of the
+    <time-period> (YYYY-MM or YYYY-MM:YYYY-MM), or of every month stored.
 
     """
     pass
 
+
+_thread_data = threading.local()
+
+
+def _get_limit_date_ga4():
+    return datetime.datetime(int(config.get('ckanext-dge-ga-report.date.ga4.year', None)), int(
+        config.get('ckanext-dge-ga-report.date.ga4.month', None)), 2, 0, 0, 0)
+
+
+def _get_months(time_period):
+    '''Returns the first day of every month in a YYYY-MM:YYYY-MM range'''
+    first, last = time_period.split(':', 1)
+    month = datetime.datetime.strptime(first, '%Y-%m')
+    last_month = datetime.datetime.strptime(last, '%Y-%m')
+    if month > last_month:
+        raise ValueError('Invalid range of months %s' % time_period)
+    months = []
+    while month <= last_month:
+        months.append(month)
+        if month.month == 12:
+            month = datetime.datetime(month.year + 1, 1, 1, 0, 0, 0)
+        else:
+            month = datetime.datetime(month.year, month.month + 1, 1, 0, 0, 0)
+    return months
+
+
+def _get_service(is_ga4, kind):
+    '''Returns the service and profile ids for GA4 or UA. They are cached
+    per thread, so a service is only built once by each thread of a
+    backfill.
+    '''
+    from .ga_auth import (init_service, get_profile_id)
+
+    services = getattr(_thread_data, 'services', None)
+    if services is None:
+        services = _thread_data.services = {}
+    if (is_ga4, kind) in services:
+        return services[(is_ga4, kind)]
+
+    svc = init_service(config.get('ckanext-dge-ga-report.token.filepath', None), is_ga4)
+
+    '''If ga4, profile_id is not neccessary'''
+    if is_ga4:
+        profile_id = ""
+        profile_id_gtm = ""
+    else:
+        webPropertyId_gtm = config.get('ckanext-dge-ga-report.prop_id_gtm')
+        view_id_gtm = config.get('ckanext-dge-ga-report.view_id_gtm', None)
+        profile_id_gtm = get_profile_id(svc, webPropertyId_gtm, view_id_gtm)
+        if kind == 'pages':
+            webPropertyId = config.get('ckanext-dge-ga-report.prop_id')
+            view_id = config.get('ckanext-dge-ga-report.view_id', None)
+            profile_id = get_profile_id(svc, webPropertyId, view_id)
+        else:
+            profile_id = ""
+    services[(is_ga4, kind)] = (svc, profile_id, profile_id_gtm)
+    return services[(is_ga4, kind)]
+
+
+def _get_downloader(kind, save, is_ga4, post_update=True, incremental=False, resume=False, force=False):
+    from ckanext.dge_ga_report.download_analytics import DownloadAnalytics
+
+    svc, profile_id, profile_id_gtm = _get_service(is_ga4, kind)
+    return DownloadAnalytics(service=svc, token=None, profile_id=profile_id, profile_id_gtm=profile_id_gtm,
+                             delete_first=False, stat=None, print_progress=True, kind_stats=kind, save_stats=save,
+                             is_ga4=is_ga4, post_update=post_update, incremental=incremental,
+                             resume=resume, force=force)
+
+
+def _is_ua_frozen():
+    '''Returns True if the UA months are loaded from the archive'''
+    return asbool(config.get('ckanext-dge-ga-report.ua.frozen', False))
+
+
+def _load_frozen_months(kind, save, dates):
+    '''Loads UA months from the archive instead of requesting them to GA'''
+    from ckanext.dge_ga_report import archive
+    from ckanext.dge_ga_report.download_analytics import DownloadAnalytics
+
+    for date in dates:
+        period_name = date.strftime('%Y-%m')
+        if save:
+            if not _reprocess_month(period_name, None, kind):
+                raise Exception('UA month %s is not archived' % period_name)
+        else:
+            for stat in DownloadAnalytics.KIND_STAT_STATS[kind]:
+                if archive.is_archived(period_name, stat):
+                    for rows in archive.read_archive(period_name, stat):
+                        for row in rows:
+                            print(row)
+
+
+def _load_months(kind, save, dates, is_ga4, resume=False, force=False):
+    log.info('Loading %s analytics for %s (%s)', kind, ', '.join(d.strftime('%Y-%m') for d in dates),
+             'GA4' if is_ga4 else 'UA')
+    if not is_ga4 and _is_ua_frozen():
+        _load_frozen_months(kind, save, dates)
+        return
+    try:
+        downloader = _get_downloader(kind, save, is_ga4, post_update=False, resume=resume,
+                                     force=force)
+        downloader.specific_months(dates)
+    finally:
+        Session.remove()
+
+
+def _get_month_batches(months, limit_date_ga4):
+    '''Groups the months in batches that are requested together: GA4 months
+    are batched by ckanext-dge-ga-report.ga4.date_ranges_per_request, UA
+    months are loaded one by one.
+    '''
+    batch_size = max(min(asint(config.get('ckanext-dge-ga-report.ga4.date_ranges_per_request', 4)), 4), 1)
+    batches = []
+    for for_date in months:
+        is_ga4 = limit_date_ga4 < for_date
+        if is_ga4 and batches and batches[-1][1] and len(batches[-1][0]) < batch_size:
+            batches[-1][0].append(for_date)
+        else:
+            batches.append(([for_date], is_ga4))
+    return batches
+
+
+def _load_month_range(kind, save, time_period, limit_date_ga4, parallel, resume=False, force=False):
+    '''Loads every month of the range, with up to <parallel> months being
+    loaded at the same time, and creates the 'All' records once at the end.
+    '''
+    months = _get_months(time_period)
+    click.echo('Loading %d months (%s) with parallelism %d' % (len(months), time_period, parallel))
+    batches = _get_month_batches(months, limit_date_ga4)
+    failed = []
+    ga_model.set_attribution_parallel(parallel)
+    if parallel > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+            futures = dict((executor.submit(_load_months, kind, save, dates, is_ga4, resume, force), dates)
+                           for dates, is_ga4 in batches)
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    log.exception(e)
+                    failed.extend(d.strftime('%Y-%m') for d in futures[future])
+    else:
+        for dates, is_ga4 in batches:
+            try:
+                _load_months(kind, save, dates, is_ga4, resume, force)
+            except Exception as e:
+                log.exception(e)
+                failed.extend(d.strftime('%Y-%m') for d in dates)
+
+    if save:
+        from ckanext.dge_ga_report.download_analytics import DownloadAnalytics
+        # Create the All records once for the whole range
+        DownloadAnalytics(kind_stats=kind, save_stats=save, is_ga4=True).post_update_stats()
+    if failed:
+        raise Exception('Unable to load months: %s' % ', '.join(sorted(failed)))
+
+
+def _start_workers(workers):
+    '''Starts the worker processes, before the threads of the months are
+    started'''
+    from ckanext.dge_ga_report import workers as worker_pool
+
+    if workers is None:
+        workers = worker_pool.get_workers()
+    if workers > 1:
+        click.echo('Starting %d worker processes' % workers)
+        worker_pool.start_pool(workers)
+
+
+def _stop_workers():
+    from ckanext.dge_ga_report import workers as worker_pool
+
+    worker_pool.shutdown_pool()
+
+
+def _reprocess_month(period_name, stat, kind=None):
+    from ckanext.dge_ga_report.download_analytics import DownloadAnalytics
+
+    try:
+        downloader = DownloadAnalytics(stat=stat, print_progress=True, save_stats=True, kind_stats=kind)
+        return downloader.reprocess(period_name)
+    finally:
+        Session.remove()
+
+
+@dge_ga_report_loadanalytics.command("reprocess")
+@click.argument(u"time_period")
+@click.option(
+    "-s",
+    "--stat",
+    metavar="STAT",
+    help="Only reprocess a particular stat",
+)
+@click.option(
+    "-p",
+    "--parallel",
+    type=int,
+    default=None,
+    help="Number of months reprocessed at the same time",
+)
+@click.option(
+    "-w",
+    "--workers",
+    type=int,
+    default=None,
+    help="Number of processes that decode the archive",
+)
+def reprocess(time_period, stat, parallel, workers):
+    """Rebuild the stats of a month (YYYY-MM) or a range of months
+    (YYYY-MM:YYYY-MM) from the archive of raw GA data, without requesting GA
+    """
+    init = datetime.datetime.now()
+    try:
+        from ckanext.dge_ga_report.download_analytics import DownloadAnalytics
+        from ckanext.dge_ga_report import archive
+
+        if not archive.get_archive_dir():
+            click.secho('The archive is disabled, ckanext-dge-ga-report.archive.dir must be configured')
+            sys.exit(1)
+        if ':' in time_period:
+            months = _get_months(time_period)
+        else:
+            months = [datetime.datetime.strptime(time_period, '%Y-%m')]
+        period_names = [month.strftime('%Y-%m') for month in months]
+        if parallel is None:
+            parallel = asint(config.get('ckanext-dge-ga-report.backfill.parallel', 1))
+        _start_workers(workers)
+        ga_model.set_attribution_parallel(parallel)
+        click.echo('Reprocessing %d months (%s) with parallelism %d' % (len(period_names), time_period, parallel))
+
+        reprocessed = set()
+        failed = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(parallel, 1)) as executor:
+            futures = dict((executor.submit(_reprocess_month, period_name, stat), period_name)
+                           for period_name in period_names)
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    stats = future.result()
+                    if not stats:
+                        click.echo('Month %s is not archived' % futures[future])
+                    reprocessed.update(stats)
+                except Exception as e:
+                    log.exception(e)
+                    failed.append(futures[future])
+
+        if reprocessed & set([DownloadAnalytics.PACKAGE_STAT, DownloadAnalytics.RESOURCE_STAT]):
+            # Create the All records once for the whole range
+            DownloadAnalytics(kind_stats=DownloadAnalytics.KIND_STAT_PACKAGE_RESOURCES, stat=stat,
+                              save_stats=True).post_update_stats()
+        if failed:
+            raise Exception('Unable to reprocess months: %s' % ', '.join(sorted(failed)))
+    except Exception as err:
+        click.secho('Exception %s' % err)
+        sys.exit(1)
+    finally:
+        _stop_workers()
+        end = datetime.datetime.now()
+        click.echo('End DgeGaReportReprocess command. Executed command in %s milliseconds' %
+                   ((end-init).total_seconds()*1000))
+    sys.exit(0)
+
+
+@dge_ga_report_loadanalytics.command("export_ua")
+@click.argument(u"time_period")
+def export_ua(time_period):
+    """Download the UA months (YYYY-MM or YYYY-MM:YYYY-MM) to the archive,
+    without storing them, so they can be loaded with
+    ckanext-dge-ga-report.ua.frozen enabled
+    """
+    init = datetime.datetime.now()
+    try:
+        from ckanext.dge_ga_report.download_analytics import DownloadAnalytics
+        from ckanext.dge_ga_report import archive
+
+        if not archive.get_archive_dir():
+            click.secho('The archive is disabled, ckanext-dge-ga-report.archive.dir must be configured')
+            sys.exit(1)
+        if ':' in time_period:
+            months = _get_months(time_period)
+        else:
+            months = [datetime.datetime.strptime(time_period, '%Y-%m')]
+        limit_date_ga4 = _get_limit_date_ga4()
+        months = [month for month in months if month <= limit_date_ga4]
+        click.echo('Exporting %d UA months (%s)' % (len(months), time_period))
+        for kind in DownloadAnalytics.KIND_STATS:
+            downloader = _get_downloader(kind, False, False)
+            downloader.export_archive([DownloadAnalytics.get_month_period(month) for month in months])
+    except Exception as err:
+        click.secho('Exception %s' % err)
+        sys.exit(1)
+    finally:
+        end = datetime.datetime.now()
+        click.echo('End DgeGaReportExportUa command. Executed command in %s milliseconds' %
+                   ((end-init).total_seconds()*1000))
+    sys.exit(0)
+
+
+@dge_ga_report_loadanalytics.command("summaries")
+@click.argument(u"time_period", required=False, default=None)
+def summaries(time_period):
+    """Refresh the tables precomputed from the stored stats of a month
+    (YYYY-MM), a range of months (YYYY-MM:YYYY-MM) or every month stored
+    """
+    init = datetime.datetime.now()
+    try:
+        from ckanext.dge_ga_report.download_analytics import DownloadAnalytics
+        from ckanext.dge_ga_report import popularity
+
+        if time_period is None:
+            period_names = ga_model.get_stored_periods()
+        elif ':' in time_period:
+            period_names = [month.strftime('%Y-%m') for month in _get_months(time_period)]
+        else:
+            period_names = [datetime.datetime.strptime(time_period, '%Y-%m').strftime('%Y-%m')]
+        click.echo('Refreshing the summaries of %d months' % len(period_names))
+        downloader = DownloadAnalytics(save_stats=True)
+        stats = (DownloadAnalytics.PACKAGE_STAT, DownloadAnalytics.RESOURCE_STAT)
+        if time_period is None:
+            # the running totals of every month are computed at once
+            for stat in stats:
+                ga_model.rebuild_dge_ga_cumulative(stat)
+        for period_name in period_names:
+            for stat in stats:
+                downloader.refresh_summaries(period_name, stat, cumulative=time_period is not None)
+        ga_model.refresh_dge_ga_top_packages('All')
+        popularity.refresh_popularity()
+    except Exception as err:
+        click.secho('Exception %s' % err)
+        sys.exit(1)
+    finally:
+        end = datetime.datetime.now()
+        click.echo('End DgeGaReportSummaries command. Executed command in %s milliseconds' %
+                   ((end-init).total_seconds()*1000))
+    sys.exit(0)
+
+
+@dge_ga_report_loadanalytics.command("popularity")
+def popularity():
+    """Recompute the popularity scores of the packages from their monthly
+    pageviews and downloads
+    """
+    init = datetime.datetime.now()
+    try:
+        from ckanext.dge_ga_report import popularity as package_popularity
+
+        count = package_popularity.refresh_popularity()
+        click.echo('Stored the popularity of %d packages' % count)
+    except Exception as err:
+        click.secho('Exception %s' % err)
+        sys.exit(1)
+    finally:
+        end = datetime.datetime.now()
+        click.echo('End DgeGaReportPopularity command. Executed command in %s milliseconds' %
+                   ((end-init).total_seconds()*1000))
+    sys.exit(0)
+
+
 @dge_ga_report_loadanalytics.command("loadanalytics")
 @click.argument(u"save_print", required=False, default=u"print")
 @click.argument(u"kind", default=None)
@@ -125,15 +589,62 @@ def dge_ga_report_loadanalytics():
     metavar="STAT",
     help="Only calulcate a particular stat (or collection of stats)",
 )
-def loadanalytics(save_print, kind, time_period, delete_first, stat):
+@click.option(
+    "-p",
+    "--parallel",
+    type=int,
+    default=None,
+    help="Number of months loaded at the same time in a range of months",
+)
+@click.option(
+    "-i",
+    "--incremental",
+    is_flag=True,
+    default=None,
+    help="Load only the days since the last load of the 'latest' period",
+)
+@click.option(
+    "-r",
+    "--resume",
+    is_flag=True,
+    help="Continue the load from the last checkpoint of the period",
+)
+@click.option(
+    "-f",
+    "--force",
+    is_flag=True,
+    help="Load the period even if its GA totals have not changed",
+)
+@click.option(
+    "-w",
+    "--workers",
+    type=int,
+    default=None,
+    help="Number of processes that classify the GA rows",
+)
+def loadanalytics(save_print, kind, time_period, delete_first, stat, parallel, incremental, resume, force,
+                  workers):
     """Grab raw data from Google Analytics and save to the database"""
     init = datetime.datetime.now()
-    limit_date_ga4 = datetime.datetime(int(config.get('ckanext-dge-ga-report.date.ga4.year', None)), int(
-        config.get('ckanext-dge-ga-report.date.ga4.month', None)), 2, 0, 0, 0)
+    limit_date_ga4 = _get_limit_date_ga4()
 
     try:
         from ckanext.dge_ga_report.download_analytics import DownloadAnalytics
-        from .ga_auth import (init_service, get_profile_id)
+
+        save = True if save_print == 'save' else False
+
+        if kind is None or kind not in DownloadAnalytics.KIND_STATS:
+            click.secho(('A valid kind of statistics that you want to load must be '
+                    'specified: %s' % DownloadAnalytics.KIND_STATS))
+            sys.exit(1)
+
+        _start_workers(workers)
+
+        if ':' in time_period:
+            if parallel is None:
+                parallel = asint(config.get('ckanext-dge-ga-report.backfill.parallel', 1))
+            _load_month_range(kind, save, time_period, limit_date_ga4, max(parallel, 1), resume, force)
+            sys.exit(0)
 
         '''Analyzing whether the specified period is before or after GA4.'''
         if time_period == 'latest' or time_period == 'last_month':
@@ -142,39 +653,24 @@ def loadanalytics(save_print, kind, time_period, delete_first, stat):
             specific_month = datetime.datetime.strptime(time_period, '%Y-%m')
             is_ga4 = limit_date_ga4 < specific_month
 
+        if incremental is None:
+            incremental = asbool(config.get('ckanext-dge-ga-report.incremental', False))
+
+        if not is_ga4 and _is_ua_frozen():
+            _load_frozen_months(kind, save, [specific_month])
+            if save:
+                DownloadAnalytics(kind_stats=kind, save_stats=save).post_update_stats()
+            sys.exit(0)
+
         try:
-            svc = init_service(config.get('ckanext-dge-ga-report.token.filepath', None), is_ga4)
+            downloader = _get_downloader(kind, save, is_ga4, incremental=incremental, resume=resume,
+                                         force=force)
         except TypeError:
             click.echo ('Unable to create a service. Have you correctly run the getauthtoken task and '
                     'specified the correct token file in the CKAN config under '
                     '"ckanext-dge-ga-report.token.filepath"?')
             sys.exit(1)
 
-        save = True if save_print == 'save' else False
-
-        if kind is None or kind not in DownloadAnalytics.KIND_STATS:
-            click.secho(('A valid kind of statistics that you want to load must be '
-                    'specified: %s' % DownloadAnalytics.KIND_STATS))
-            sys.exit(1)
-
-        '''If ga4, profile_id is not neccessary'''
-        if is_ga4:
-           profile_id = ""
-           profile_id_gtm = ""
-        else:
-            webPropertyId_gtm = config.get('ckanext-dge-ga-report.prop_id_gtm')
-            view_id_gtm = config.get('ckanext-dge-ga-report.view_id_gtm', None)
-            profile_id_gtm = get_profile_id(svc, webPropertyId_gtm, view_id_gtm)
-            if kind == 'pages':
-                webPropertyId = config.get('ckanext-dge-ga-report.prop_id')
-                view_id = config.get('ckanext-dge-ga-report.view_id', None)
-                profile_id = get_profile_id(svc, webPropertyId, view_id)
-            else:
-                profile_id = ""
-
-        downloader = DownloadAnalytics(service=svc, token=None, profile_id=profile_id, profile_id_gtm=profile_id_gtm,
-                                       delete_first=False, stat=None, print_progress=True, kind_stats=kind, save_stats=save, is_ga4=is_ga4)
-
         if time_period == 'latest':
             downloader.latest()
         elif time_period == 'last_month':
@@ -192,7 +688,10 @@ def loadanalytics(save_print, kind, time_period, delete_first, stat):
         click.secho('Exception %s' % err)
         sys.exit(1)
     finally:
-        click.echo('End DgeGaReportLoadAnalytics command with args. Executed command in milliseconds')
+        _stop_workers()
+        end = datetime.datetime.now()
+        click.echo('End DgeGaReportLoadAnalytics command with args. Executed command in %s milliseconds' %
+                   ((end-init).total_seconds()*1000))
     sys.exit(0)
 
 
@@ -636,14 +1135,14 @@ def generar_csv_visitas_publico_mas_vistos():
 	        s1.pageviews AS "Visitas",
 	        ROW_NUMBER() OVER (
 	            PARTITION BY s1.year_month
-	            ORDER BY s1.pageviews DESC
+	            ORDER BY s1.rank
 	        ) AS rn
 	    FROM
 	        "group" g
-	        INNER JOIN dge_ga_packages s1 ON g.id = s1.publisher_id
+	        INNER JOIN dge_ga_top_packages s1 ON g.id = s1.publisher_id
 	        INNER JOIN package p ON p.name = s1.package_name
 	    WHERE
-	        s1.publisher_id IS NOT null and p.private is false
+	        s1.scope = '' and p.private is false
 	)
 	SELECT
 	    "Mes", "Url", "Conjunto de datos", "Publicador", "Visitas"
@@ -16,16 +16,38 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import sys
 import datetime
 import collections
+import threading
+import itertools
+import concurrent.futures
+import heapq
 import requests
 import time
 import re
 import logging
 import urllib.request, urllib.parse, urllib.error
+import socket
+import json
 
-from ckan.plugins.toolkit import (config)
+import httplib2
+from googleapiclient.errors import HttpError
+
+import ckan.model as model
+from ckan.plugins.toolkit import (config, asbool, asint)
 from . import ga_model
+from . import transport
+from . import archive
+from . import workers
+from . import popularity
+from .lib import SpillingAggregator, RowTotals
+
+# errors of the connection to GA that are retried
+TRANSIENT_NETWORK_ERRORS = (socket.timeout, socket.gaierror, ConnectionError, TimeoutError,
+                            httplib2.ServerNotFoundError)
+# reasons of the HTTP 403 errors of UA rate limits, which are retried
+RATE_LIMIT_REASONS = ('userRateLimitExceeded', 'rateLimitExceeded')
 
 log = logging.getLogger(__name__)
 
@@ -42,9 +64,14 @@ class DownloadAnalytics(object):
     KIND_STAT_VISITS = 'sessions'
     KIND_STATS = [KIND_STAT_PACKAGE_RESOURCES, KIND_STAT_VISITS]
 
+    # Maximum number of dateRanges accepted by GA4 runReport
+    MAX_DATE_RANGES = 4
+
     PACKAGE_STAT = 'dge_ga_package'
     RESOURCE_STAT = 'dge_ga_resource'
     VISIT_STAT = 'dge_ga_visit'
+    KIND_STAT_STATS = {KIND_STAT_PACKAGE_RESOURCES: [PACKAGE_STAT, RESOURCE_STAT],
+                       KIND_STAT_VISITS: [VISIT_STAT]}
 
     URL_PREFIX = '^(|/es|/en|/eu|/ca|/gl)/'
     URL_SUFFIX = '[/?].+'
@@ -64,6 +91,13 @@ class DownloadAnalytics(object):
         URL_PREFIX + 'catalogo/new/?$'
     ]
 
+    # Relaxed versions of the classifier regexs that can be evaluated by GA.
+    # They must always match a superset of the paths accepted locally (GA
+    # paths may carry a host or language prefix), the local classification
+    # is still applied on the downloaded rows.
+    PACKAGE_URL_PUSHDOWN_REGEX = 'catalogo/' + NAME_REGEX + '/?$'
+    RESOURCE_URL_PUSHDOWN_REGEX = PACKAGE_URL_PUSHDOWN_REGEX
+
     CATALOG_URL_EXCLUDED_REGEXS = [
         URL_PREFIX + 'catalogo/new(/?|\?.*)$',
         URL_PREFIX + 'catalogo/(edit|resources|new_resource)/' + NAME_REGEX + '(|/|/.+)$',
@@ -688,7 +722,8 @@ class DownloadAnalytics(object):
 
     def __init__(self, service=None, token=None, profile_id=None, profile_id_gtm=None,
                  delete_first=False, stat=None, print_progress=False,
-                 kind_stats=None, save_stats=False, is_ga4=False):
+                 kind_stats=None, save_stats=False, is_ga4=False, post_update=True,
+                 incremental=False, resume=False, force=False):
         self.period = config.get('ckanext-dge-ga-report.period', 'monthly')
         self.hostname = config.get('ckanext-dge-ga-report.hostname', None)
         self.segment = config.get('ckanext-dge-ga-report.segment', None)
@@ -708,10 +743,27 @@ class DownloadAnalytics(object):
         self.kind_stats = kind_stats
         self.save_stats = save_stats
         self.is_ga4 = is_ga4
-        self.property_id = 'properties/' + config.get('ckanext-dge-ga-report.view_id_ga4', None)
-        self.property_id_gtm = 'properties/' + config.get('ckanext-dge-ga-report.view_id_ga4_gtm', None)
+        self.post_update = post_update
+        self.date_ranges_per_request = asint(config.get('ckanext-dge-ga-report.ga4.date_ranges_per_request',
+                                                        DownloadAnalytics.MAX_DATE_RANGES))
+        self._prefetched = {}
+        self._totals_probes = {}
+        self.incremental = incremental
+        self.incremental_overlap_days = asint(config.get('ckanext-dge-ga-report.incremental.overlap_days', 2))
+        self.resume = resume
+        self.checkpoints = save_stats and (resume or asbool(config.get('ckanext-dge-ga-report.checkpoints', False)))
+        self._checkpoints = {}
+        self.force = force
+        self.totals_probe = asbool(config.get('ckanext-dge-ga-report.totals_probe', True))
+        self.pushdown = asbool(config.get('ckanext-dge-ga-report.filter.pushdown', True))
+        self.pushdown_parity_check = asbool(config.get('ckanext-dge-ga-report.filter.pushdown.parity_check', False))
+        self.split_row_threshold = asint(config.get('ckanext-dge-ga-report.split.row_threshold', 0))
+        self.split_parallel = asint(config.get('ckanext-dge-ga-report.split.parallel', 4))
+        self.retry_attempts = asint(config.get('ckanext-dge-ga-report.retry.attempts', 5))
+        self.retry_backoff = float(config.get('ckanext-dge-ga-report.retry.backoff', 2))
 
-    def specific_month(self, date):
+    @staticmethod
+    def get_month_period(date):
         import calendar
 
         first_of_this_month = datetime.datetime(date.year, date.month, 1)
@@ -722,9 +774,18 @@ class DownloadAnalytics(object):
         if now.year == date.year and now.month == date.month:
             last_day_of_month = now.day
             last_of_this_month = now
-        periods = ((date.strftime(FORMAT_MONTH),
-                    last_day_of_month,
-                    first_of_this_month, last_of_this_month),)
+        return (date.strftime(FORMAT_MONTH),
+                last_day_of_month,
+                first_of_this_month, last_of_this_month)
+
+    def specific_month(self, date):
+        periods = (self.get_month_period(date),)
+        self.download_and_store(periods)
+
+    def specific_months(self, dates):
+        '''Downloads and stores several months. With GA4 the months are
+        requested in batches of date ranges.'''
+        periods = tuple(self.get_month_period(date) for date in dates)
         self.download_and_store(periods)
 
     def latest(self):
@@ -737,7 +798,118 @@ class DownloadAnalytics(object):
                         first_of_this_month, now),)
         else:
             raise NotImplementedError
-        self.download_and_store(periods)
+        if self.incremental and self.is_ga4 and self.save_stats and \
+           self.kind_stats == DownloadAnalytics.KIND_STAT_PACKAGE_RESOURCES:
+            self.download_and_store_incremental(periods)
+        else:
+            self.download_and_store(periods)
+
+    def download_and_store_incremental(self, periods):
+        '''Downloads only the days since the last incremental load of each
+        stat (minus an overlap of late data days) and merges them into the
+        stored rows of the period. When the month changes, the remaining days
+        of the month of the last load are merged before the new period is
+        loaded.
+
+        Sessions are not additive by day, so only package and resource
+        stats are loaded incrementally.
+        '''
+        for period_name, period_complete_day, start_date, end_date in periods:
+            for stat, path, excluded_paths, object_type in (
+                    (DownloadAnalytics.PACKAGE_STAT,
+                     DownloadAnalytics.PACKAGE_SECCIONS2_REGEX,
+                     DownloadAnalytics.PACKAGE_URL_EXCLUDED_REGEXS,
+                     ga_model.DgeGaPackage),
+                    (DownloadAnalytics.RESOURCE_STAT,
+                     DownloadAnalytics.RESOURCE_URL_REGEX,
+                     DownloadAnalytics.RESOURCE_URL_EXCLUDED_REGEXS,
+                     ga_model.DgeGaResource)):
+                if self.stat not in (None, stat):
+                    continue
+                watermark = ga_model.get_load_watermark(stat)
+                if watermark is not None and watermark.year_month < period_name:
+                    # Close out the month of the last load up to its last day
+                    last_day = datetime.datetime.strptime(watermark.last_day, '%Y-%m-%d')
+                    (last_period_name, last_period_complete_day,
+                     last_start_date, last_end_date) = self.get_month_period(last_day)
+                    since_date = max(last_start_date,
+                                     last_day - datetime.timedelta(days=self.incremental_overlap_days))
+                    log.info('Closing out stat %s of period %s since %s', stat, last_period_name,
+                             since_date.strftime('%Y-%m-%d'))
+                    print('Closing out stat %s of period %s since %s' %
+                          (stat, last_period_name, since_date.strftime('%Y-%m-%d')))
+                    if not self._merge_incremental(last_period_name, last_period_complete_day,
+                                                   last_start_date, since_date, last_end_date,
+                                                   path, excluded_paths, stat, object_type,
+                                                   archive_rows=True):
+                        log.error('Unable to close out stat %s of period %s, period %s is not loaded',
+                                  stat, last_period_name, period_name)
+                        continue
+                if watermark is None or watermark.year_month != period_name:
+                    # First load of the period, it is fully downloaded
+                    log.info('No watermark for stat %s in period %s, loading the whole period',
+                             stat, period_name)
+                    if stat == DownloadAnalytics.PACKAGE_STAT:
+                        ga_model.pre_update_dge_ga_package_stats(period_name)
+                    else:
+                        ga_model.pre_update_dge_ga_resource_stats(period_name)
+                    ga_model.delete_dge_ga_daily_stats(stat)
+                    since_date = start_date
+                else:
+                    last_day = datetime.datetime.strptime(watermark.last_day, '%Y-%m-%d')
+                    since_date = max(start_date,
+                                     last_day - datetime.timedelta(days=self.incremental_overlap_days))
+                log.info('Downloading analytics for stat %s since %s', stat, since_date.strftime('%Y-%m-%d'))
+                print('Incremental load of stat %s since %s' % (stat, since_date.strftime('%Y-%m-%d')))
+                self._merge_incremental(period_name, period_complete_day, start_date, since_date,
+                                        end_date, path, excluded_paths, stat, object_type)
+
+    def _merge_incremental(self, period_name, period_complete_day, start_date, since_date, end_date,
+                           path, excluded_paths, stat, object_type, archive_rows=False):
+        '''Downloads the daily rows of the stat since since_date, merges them
+        into the stored rows of the period and records the total of the
+        period and the watermark of the load. If archive_rows, the rows of
+        the whole period, added up from the daily values, are archived, as
+        done when a month is closed out.
+
+        Returns False if the download is unsuccessful.
+        '''
+        data = self.download(since_date, end_date, path, excluded_paths, stat, daily=True)
+        if stat not in data:
+            log.error('Unable to download stat %s, the watermark is not updated', stat)
+            return False
+        # the daily values, their differences and the watermark are
+        # committed together, so a failed merge is downloaded again
+        try:
+            differences = ga_model.merge_dge_ga_daily_stats(stat, period_name,
+                                                            since_date.strftime('%Y-%m-%d'),
+                                                            data[stat])
+            if stat == DownloadAnalytics.PACKAGE_STAT:
+                rows = [(url, difference) for url, _, difference in differences]
+            else:
+                rows = differences
+            log.info('Merging %i changed urls of stat %s', len(rows), stat)
+            print('Merging %i changed urls of stat %s' % (len(rows), stat))
+            self.store(period_name, period_complete_day, {stat: rows}, stat, commit=False)
+            ga_model.update_end_day(object_type, period_name, period_complete_day, commit=False)
+            ga_model.set_load_watermark(stat, period_name, end_date.strftime('%Y-%m-%d'), commit=False)
+            model.Session.commit()
+        except Exception:
+            model.Session.rollback()
+            raise
+        self.refresh_summaries(period_name, stat)
+        if archive_rows:
+            self.archive_stat(period_name, period_complete_day, stat,
+                              ga_model.get_dge_ga_daily_totals(
+                                  stat, period_name, stat == DownloadAnalytics.RESOURCE_STAT))
+        if self.totals_probe:
+            # the total of the whole period, compared by the next full load
+            totals = self.download(start_date, end_date, path, excluded_paths, stat, totals=True)
+            if stat in totals:
+                ga_model.set_period_total(period_name, stat, totals[stat])
+        if self.post_update:
+            self.post_update_stat(stat)
+        return True
 
     @staticmethod
     def get_full_period_name(period_name, period_complete_day):
@@ -746,7 +918,142 @@ class DownloadAnalytics(object):
         else:
             return period_name
 
+    def _get_stat_downloads(self):
+        '''Returns the arguments of the downloads done by download_and_store
+        for the current kind of stats, as tuples of (stat, path, excluded
+        paths, path_section, metrics, sort).
+        '''
+        downloads = []
+        if self.kind_stats == DownloadAnalytics.KIND_STAT_PACKAGE_RESOURCES:
+            if self.stat in (None, DownloadAnalytics.PACKAGE_STAT):
+                downloads.append((DownloadAnalytics.PACKAGE_STAT,
+                                  DownloadAnalytics.PACKAGE_SECCIONS2_REGEX if self.is_ga4
+                                  else DownloadAnalytics.PACKAGE_SECCIONS2_REGEX_UA,
+                                  DownloadAnalytics.PACKAGE_URL_EXCLUDED_REGEXS,
+                                  None, None, 'None'))
+            if self.stat in (None, DownloadAnalytics.RESOURCE_STAT):
+                downloads.append((DownloadAnalytics.RESOURCE_STAT,
+                                  DownloadAnalytics.RESOURCE_URL_REGEX,
+                                  DownloadAnalytics.RESOURCE_URL_EXCLUDED_REGEXS,
+                                  None, None, 'None'))
+        if self.kind_stats == DownloadAnalytics.KIND_STAT_VISITS and \
+           self.stat in (None, DownloadAnalytics.VISIT_STAT):
+            sections = DownloadAnalytics.SECTIONS_GTM_GA4 if self.is_ga4 \
+                else DownloadAnalytics.SECTIONS_GTM
+            for section in sections:
+                if section.get('name', None) or section.get('key', None):
+                    downloads.append((DownloadAnalytics.VISIT_STAT,
+                                      section.get('seccions2_regex', ''),
+                                      section.get('exluded_url_regex', []),
+                                      section.get('seccion', 'customEvent:seccion_s2'),
+                                      section.get('metrics', None),
+                                      section.get('sort', None)))
+        return downloads
+
+    @staticmethod
+    def _get_download_key(start_date, end_date, stat, path, path_section, metrics_stat, sort_stat, pushdown):
+        return (start_date.strftime('%Y-%m-%d'), end_date.strftime('%Y-%m-%d'),
+                stat, path, path_section, metrics_stat, sort_stat, pushdown)
+
+    def prefetch(self, periods):
+        '''Downloads the data of several periods at once, requesting up to
+        date_ranges_per_request periods in each GA4 request. The data is kept
+        until download() is called for the same period and arguments.
+
+        The totals of the package and resource stats are probed first, and
+        only the periods whose totals have changed are prefetched.
+        '''
+        batch_size = min(self.date_ranges_per_request, DownloadAnalytics.MAX_DATE_RANGES)
+        if not self.is_ga4 or batch_size < 2 or len(periods) < 2 or self.checkpoints:
+            return
+        for stat, path, excluded_paths, path_section, metrics, sort in self._get_stat_downloads():
+            stat_periods = periods
+            if stat in (DownloadAnalytics.PACKAGE_STAT, DownloadAnalytics.RESOURCE_STAT):
+                stat_periods = []
+                for period in periods:
+                    period_name, _, start_date, end_date = period
+                    probe = self._is_unchanged(period_name, start_date, end_date, path,
+                                               excluded_paths, stat)
+                    # kept for download_and_store, so it is not probed again
+                    self._totals_probes[(period_name, stat)] = probe
+                    if not probe[0]:
+                        stat_periods.append(period)
+            if len(stat_periods) < 2:
+                continue
+            for index in range(0, len(stat_periods), batch_size):
+                batch = stat_periods[index:index + batch_size]
+                if len(batch) < 2:
+                    continue
+                date_ranges = [(period_name, start_date, end_date)
+                               for period_name, _, start_date, end_date in batch]
+                log.info('Prefetching stat %s of periods %s', stat,
+                         ', '.join(r[0] for r in date_ranges))
+                data = self.download(date_ranges[0][1], date_ranges[-1][2], path, excluded_paths,
+                                     stat, path_section, metrics, sort, date_ranges=date_ranges)
+                if not data:
+                    continue
+                for period_name, start_date, end_date in date_ranges:
+                    if period_name in data:
+                        key = self._get_download_key(start_date, end_date, stat, path, path_section,
+                                                     metrics, sort, self.pushdown)
+                        self._prefetched[key] = data[period_name]
+
+    def get_checkpoint(self, period_name, stat, end_date, section=''):
+        '''Returns the checkpoint of the stat in the period loaded until
+        end_date if checkpoints are enabled. On resumed loads, the previous
+        checkpoint is continued if it was a load until the same day.
+        '''
+        if not self.checkpoints:
+            return None
+        key = (period_name, stat, section or '', end_date.strftime('%Y-%m-%d'))
+        if key not in self._checkpoints:
+            from .checkpoint import LoadCheckpoint
+            self._checkpoints[key] = LoadCheckpoint(period_name, stat, section, resume=self.resume,
+                                                    end_date=key[3])
+        return self._checkpoints[key]
+
+    def _is_loaded(self, period_name, stat, end_date):
+        '''Returns True if a resumed load until the same day already stored
+        the stat'''
+        checkpoint = self.get_checkpoint(period_name, stat, end_date)
+        if checkpoint and checkpoint.is_done:
+            log.info('Stat %s of period %s already loaded, skipping it', stat, period_name)
+            print('Stat %s of period %s already loaded, skipping it' % (stat, period_name))
+            return True
+        return False
+
+    def _is_unchanged(self, period_name, start_date, end_date, path, excluded_paths, stat):
+        '''Requests the total of the stat in the period, without dimensions,
+        and compares it with the total recorded on the last load. The
+        stored rows can not be used, because GA rows are also classified
+        locally.
+
+        Returns (unchanged, total).
+        '''
+        if (period_name, stat) in self._totals_probes:
+            # already probed by prefetch
+            return self._totals_probes.pop((period_name, stat))
+        if self.force or not self.save_stats or not self.totals_probe or self.delete_first:
+            return False, None
+        checkpoint = self.get_checkpoint(period_name, stat, end_date)
+        if checkpoint and checkpoint.rows_stored:
+            return False, None
+        data = self.download(start_date, end_date, path, excluded_paths, stat, totals=True)
+        if stat not in data:
+            return False, None
+        total = data[stat]
+        if ga_model.get_period_total(period_name, stat) == total:
+            log.info('Total of stat %s in period %s has not changed (%s), skipping it',
+                     stat, period_name, total)
+            print('Total of stat %s in period %s has not changed (%s), skipping it' %
+                  (stat, period_name, total))
+            if checkpoint:
+                checkpoint.set_done()
+            return True, total
+        return False, total
+
     def download_and_store(self, periods):
+        self.prefetch(periods)
         for period_name, period_complete_day, start_date, end_date in periods:
             log.info('Period "%s" (%s - %s)',
                      self.get_full_period_name(period_name, period_complete_day),
@@ -759,66 +1066,105 @@ class DownloadAnalytics(object):
                 ga_model.delete(period_name)
 
             if self.stat in (None, DownloadAnalytics.PACKAGE_STAT) and \
-               self.kind_stats == DownloadAnalytics.KIND_STAT_PACKAGE_RESOURCES:
+               self.kind_stats == DownloadAnalytics.KIND_STAT_PACKAGE_RESOURCES and \
+               not self._is_loaded(period_name, DownloadAnalytics.PACKAGE_STAT, end_date):
                 # Clean out old dge_ga_package data before storing the new
                 stat = DownloadAnalytics.PACKAGE_STAT
-                if self.save_stats:
-                    ga_model.pre_update_dge_ga_package_stats(period_name)
-                log.info('Downloading analytics for package views')
                 if self.is_ga4:
-                    data = self.download(start_date, end_date,
-                                         DownloadAnalytics.PACKAGE_SECCIONS2_REGEX,
-                                         DownloadAnalytics.PACKAGE_URL_EXCLUDED_REGEXS,
-                                         stat)
+                    path = DownloadAnalytics.PACKAGE_SECCIONS2_REGEX
                 else:
-                    data = self.download(start_date, end_date,
-                                         DownloadAnalytics.PACKAGE_SECCIONS2_REGEX_UA,
+                    path = DownloadAnalytics.PACKAGE_SECCIONS2_REGEX_UA
+                unchanged, total = self._is_unchanged(period_name, start_date, end_date, path,
+                                                      DownloadAnalytics.PACKAGE_URL_EXCLUDED_REGEXS, stat)
+                checkpoint = self.get_checkpoint(period_name, stat, end_date)
+                if self.save_stats and not unchanged and not (checkpoint and checkpoint.rows_stored):
+                    ga_model.pre_update_dge_ga_package_stats(period_name)
+                data = None
+                if not unchanged:
+                    log.info('Downloading analytics for package views')
+                    data = self.download(start_date, end_date, path,
                                          DownloadAnalytics.PACKAGE_URL_EXCLUDED_REGEXS,
-                                         stat)
+                                         stat, checkpoint=checkpoint)
+                if data and self.pushdown_parity_check:
+                    self.check_pushdown_parity(start_date, end_date, path,
+                                               DownloadAnalytics.PACKAGE_URL_EXCLUDED_REGEXS,
+                                               stat, data)
                 if data:
                     if self.save_stats:
                         log.info('Storing package views (%i rows)', len(data.get(stat, [])))
                         print('Storing package views (%i rows)' % (len(data.get(stat, []))))
-                        self.store(period_name, period_complete_day, data, stat)
+                        self.store(period_name, period_complete_day, data, stat, checkpoint)
+                        self.refresh_summaries(period_name, stat)
                         # Create the All records
-                        ga_model.post_update_dge_ga_package_stats()
+                        if self.post_update:
+                            self.post_update_stat(stat)
+                        if stat in data:
+                            self.archive_stat(period_name, period_complete_day, stat, data[stat])
+                        if total is not None and stat in data:
+                            ga_model.set_period_total(period_name, stat, total)
+                        if checkpoint and stat in data:
+                            checkpoint.set_done()
                     else:
                         print('The result contains %i rows:' % (len(data.get(stat, []))))
                         for row in data.get(stat):
                             print(row)
 
             if self.stat in (None, DownloadAnalytics.RESOURCE_STAT) and\
-               self.kind_stats == DownloadAnalytics.KIND_STAT_PACKAGE_RESOURCES:
+               self.kind_stats == DownloadAnalytics.KIND_STAT_PACKAGE_RESOURCES and \
+               not self._is_loaded(period_name, DownloadAnalytics.RESOURCE_STAT, end_date):
                 # Clean out old dge_ga_package data before storing the new
                 stat = DownloadAnalytics.RESOURCE_STAT
-                if self.save_stats:
+                unchanged, total = self._is_unchanged(period_name, start_date, end_date,
+                                                      DownloadAnalytics.RESOURCE_URL_REGEX,
+                                                      DownloadAnalytics.RESOURCE_URL_EXCLUDED_REGEXS, stat)
+                checkpoint = self.get_checkpoint(period_name, stat, end_date)
+                if self.save_stats and not unchanged and not (checkpoint and checkpoint.rows_stored):
                     ga_model.pre_update_dge_ga_resource_stats(period_name)
 
-                log.info('Downloading analytics for resource views')
-                data = self.download(start_date, end_date,
-                                     DownloadAnalytics.RESOURCE_URL_REGEX,
-                                     DownloadAnalytics.RESOURCE_URL_EXCLUDED_REGEXS,
-                                     stat)
+                data = None
+                if not unchanged:
+                    log.info('Downloading analytics for resource views')
+                    data = self.download(start_date, end_date,
+                                         DownloadAnalytics.RESOURCE_URL_REGEX,
+                                         DownloadAnalytics.RESOURCE_URL_EXCLUDED_REGEXS,
+                                         stat, checkpoint=checkpoint)
+                if data and self.pushdown_parity_check:
+                    self.check_pushdown_parity(start_date, end_date,
+                                               DownloadAnalytics.RESOURCE_URL_REGEX,
+                                               DownloadAnalytics.RESOURCE_URL_EXCLUDED_REGEXS,
+                                               stat, data)
                 if data:
                     if self.save_stats:
                         log.info('Storing resource views (%i rows)', len(data.get(stat, [])))
                         print('Storing resource views (%i rows)' % (len(data.get(stat, []))))
-                        self.store(period_name, period_complete_day, data, stat)
+                        self.store(period_name, period_complete_day, data, stat, checkpoint)
+                        self.refresh_summaries(period_name, stat)
                         # Create the All records
-                        ga_model.post_update_dge_ga_resource_stats()
+                        if self.post_update:
+                            self.post_update_stat(stat)
+                        if stat in data:
+                            self.archive_stat(period_name, period_complete_day, stat, data[stat])
+                        if total is not None and stat in data:
+                            ga_model.set_period_total(period_name, stat, total)
+                        if checkpoint and stat in data:
+                            checkpoint.set_done()
                     else:
                         print('The result contains %i rows:' % (len(data.get(stat, []))))
                         for row in data.get(stat):
                             print(row)
 
             if self.stat in (None, DownloadAnalytics.VISIT_STAT) and \
-               self.kind_stats == DownloadAnalytics.KIND_STAT_VISITS:
+               self.kind_stats == DownloadAnalytics.KIND_STAT_VISITS and \
+               not self._is_loaded(period_name, DownloadAnalytics.VISIT_STAT, end_date):
                 # Clean out old dge_ga_package data before storing the new
                 stat = DownloadAnalytics.VISIT_STAT
-                if self.save_stats:
+                checkpoint = self.get_checkpoint(period_name, stat, end_date)
+                if self.save_stats and not (checkpoint and checkpoint.rows_stored):
                     ga_model.pre_update_dge_ga_visit_stats(period_name)
 
                 visits = []
+                section_checkpoints = []
+                downloaded = True
 
                 if self.is_ga4:
                     sections = DownloadAnalytics.SECTIONS_GTM_GA4
@@ -838,26 +1184,207 @@ class DownloadAnalytics(object):
                         log.info(
                             'Downloading analytics %s for %s %s', metrics, name, key)
                         print('Downloading analytics %s for %s %s' % (metrics, name, key))
+                        section_checkpoint = self.get_checkpoint(period_name, stat, end_date, name or key)
+                        if section_checkpoint:
+                            section_checkpoints.append(section_checkpoint)
                         data = self.download(
-                            start_date, end_date, path, excluded_paths, stat, path_section, metrics, sort)
+                            start_date, end_date, path, excluded_paths, stat, path_section, metrics, sort,
+                            checkpoint=section_checkpoint)
                         if data:
                             visits.append((key, name, data.get(stat, 0)))
+                            downloaded = downloaded and stat in data
                 if visits and len(visits) >= 1:
                     if self.save_stats:
                         log.info('Storing session visits (%i rows)', len(visits))
                         print('Storing session visits (%i rows)' % (len(visits)))
-                        self.store(period_name, period_complete_day, {stat:visits}, stat)
+                        self.store(period_name, period_complete_day, {stat:visits}, stat, checkpoint)
+                        if downloaded:
+                            self.archive_stat(period_name, period_complete_day, stat, visits)
+                        if checkpoint and downloaded:
+                            for section_checkpoint in section_checkpoints:
+                                section_checkpoint.set_done()
+                            checkpoint.set_done()
                     else:
                         print('The result contains %i rows:' % (len(visits)))
                         for row in visits:
                             print(row)
 
-    def download(self, start_date, end_date, path=None, exludedPaths=None, stat=None, path_section=None, metrics_stat=None, sort_stat='None'):
+    def refresh_summaries(self, period_name, stat, cumulative=True):
+        '''Refreshes the tables precomputed from the stored rows of the stat
+        for the period just stored'''
+        if stat in (DownloadAnalytics.PACKAGE_STAT, DownloadAnalytics.RESOURCE_STAT):
+            ga_model.refresh_dge_ga_rollups(period_name, stat)
+            if cumulative:
+                ga_model.refresh_dge_ga_cumulative(period_name, stat)
+        if stat == DownloadAnalytics.PACKAGE_STAT:
+            ga_model.refresh_dge_ga_top_packages(period_name)
+
+    def archive_stat(self, period_name, period_complete_day, stat, rows):
+        '''Archives the rows of a stat loaded in full, or of a month loaded
+        incrementally when it is closed out, so it can be reprocessed later
+        without requesting GA'''
+        if archive.get_archive_dir():
+            archive.write_archive(period_name, period_complete_day, stat, rows,
+                                  source='ga4' if self.is_ga4 else 'ua')
+
+    def export_archive(self, periods):
+        '''Downloads the stats of the periods and writes them to the archive
+        without storing them. Used to freeze the UA periods.
+        '''
+        for period_name, period_complete_day, start_date, end_date in periods:
+            visits = []
+            for stat, path, excluded_paths, path_section, metrics, sort in self._get_stat_downloads():
+                data = self.download(start_date, end_date, path, excluded_paths, stat,
+                                     path_section, metrics, sort)
+                if stat not in data:
+                    raise DownloadError('Unable to download stat %s of period %s' % (stat, period_name))
+                if stat == DownloadAnalytics.VISIT_STAT:
+                    visits.append(data[stat])
+                else:
+                    self.archive_stat(period_name, period_complete_day, stat, data[stat])
+            if visits:
+                sections = DownloadAnalytics.SECTIONS_GTM_GA4 if self.is_ga4 \
+                    else DownloadAnalytics.SECTIONS_GTM
+                sections = [section for section in sections
+                            if section.get('name', None) or section.get('key', None)]
+                self.archive_stat(period_name, period_complete_day, DownloadAnalytics.VISIT_STAT,
+                                  [(section.get('key', None), section.get('name', None), value)
+                                   for section, value in zip(sections, visits)])
+
+    def reprocess(self, period_name):
+        '''Stores again the stats of the period from the archive, without
+        requesting GA. The 'All' records are not created.
+
+        Returns the stats reprocessed.
+        '''
+        reprocessed = []
+        for stat, pre_update in ((DownloadAnalytics.PACKAGE_STAT, ga_model.pre_update_dge_ga_package_stats),
+                                 (DownloadAnalytics.RESOURCE_STAT, ga_model.pre_update_dge_ga_resource_stats),
+                                 (DownloadAnalytics.VISIT_STAT, ga_model.pre_update_dge_ga_visit_stats)):
+            if self.stat not in (None, stat) or not archive.is_archived(period_name, stat):
+                continue
+            if self.kind_stats and stat not in DownloadAnalytics.KIND_STAT_STATS[self.kind_stats]:
+                continue
+            header = archive.read_archive_header(period_name, stat)
+            log.info('Reprocessing stat %s of period %s from %s archive', stat, period_name, header.get('source'))
+            print('Reprocessing stat %s of period %s from %s archive' % (stat, period_name, header.get('source')))
+            pre_update(period_name)
+            if stat != DownloadAnalytics.VISIT_STAT and workers.get_pool() is not None:
+                rows = workers.read_archive_rows(period_name, stat)
+            else:
+                rows = itertools.chain.from_iterable(archive.read_archive(period_name, stat))
+            if stat == DownloadAnalytics.VISIT_STAT:
+                rows = list(rows)
+            self.store(period_name, header['end_day'], {stat: rows}, stat)
+            self.refresh_summaries(period_name, stat)
+            reprocessed.append(stat)
+        return reprocessed
+
+    def post_update_stats(self):
+        '''Creates the 'All' records of the stats of this kind. Used when
+        several periods are stored with post_update disabled.
+        '''
+        if not self.save_stats or \
+           self.kind_stats != DownloadAnalytics.KIND_STAT_PACKAGE_RESOURCES:
+            return
+        if self.stat in (None, DownloadAnalytics.PACKAGE_STAT):
+            ga_model.post_update_dge_ga_package_stats()
+        if self.stat in (None, DownloadAnalytics.RESOURCE_STAT):
+            ga_model.post_update_dge_ga_resource_stats()
+        popularity.refresh_popularity()
+
+    def post_update_stat(self, stat):
+        '''Creates the 'All' records of the stat just stored and refreshes
+        the popularity scores'''
+        if stat == DownloadAnalytics.PACKAGE_STAT:
+            ga_model.post_update_dge_ga_package_stats()
+        else:
+            ga_model.post_update_dge_ga_resource_stats()
+        popularity.refresh_popularity()
+
+    def check_pushdown_parity(self, start_date, end_date, path, exludedPaths, stat, data):
+        '''Downloads again the stat without pushing down the classifier
+        filters to GA and compares the result with the pushed-down one.
+
+        Returns True if both results are the same.
+        '''
+        log.info('Checking pushdown parity for stat %s', stat)
+        local_data = self.download(start_date, end_date, path, exludedPaths, stat,
+                                   pushdown=False)
+        # both results are sorted by dimensions, so they are compared as
+        # they are read
+        differences = 0
+        for dimensions, pushed_value, local_value in _compare_rows(data.get(stat, []),
+                                                                   local_data.get(stat, [])):
+            differences += 1
+            if pushed_value is None:
+                log.warning('Row missing in pushed-down result: %s', dimensions + (local_value,))
+            elif local_value is None:
+                log.warning('Row missing in local result: %s', dimensions + (pushed_value,))
+            else:
+                log.warning('Row %s is %s in pushed-down result and %s in local result',
+                            dimensions, pushed_value, local_value)
+        if differences:
+            log.warning('Pushdown parity check failed for stat %s: %i rows differ',
+                        stat, differences)
+            print('Pushdown parity check FAILED for stat %s' % stat)
+            return False
+        log.info('Pushdown parity check passed for stat %s (%i rows)',
+                 stat, len(data.get(stat, [])))
+        print('Pushdown parity check passed for stat %s' % stat)
+        return True
+
+    def _get_pushdown_filter(self, stat):
+        '''Returns the GA filter (a GA4 filter expression or an UA filter
+        string) equivalent to the local classification of the stat rows,
+        or None if it can not be evaluated by GA.
+        '''
+        if stat == DownloadAnalytics.PACKAGE_STAT:
+            if self.is_ga4:
+                return {
+                    "filter": {
+                        "fieldName": "pagePath",
+                        "stringFilter": {
+                            "matchType": "PARTIAL_REGEXP",
+                            "value": DownloadAnalytics.PACKAGE_URL_PUSHDOWN_REGEX,
+                            "caseSensitive": False
+                        }
+                    }
+                }
+            return 'ga:dimension19=~%s' % DownloadAnalytics.PACKAGE_URL_PUSHDOWN_REGEX
+        return None
+
+    def download(self, start_date, end_date, path=None, exludedPaths=None, stat=None, path_section=None, metrics_stat=None, sort_stat='None',
+                 pushdown=None, date_ranges=None, daily=False, checkpoint=None, totals=False):
         '''Get views & visits data for particular paths & time period from GA
+
+        If pushdown is enabled, the classifier rules of the package and
+        resource stats are sent to GA as filters so that discarded rows are
+        not downloaded.
+
+        If date_ranges, a list of (period_name, start_date, end_date), is
+        given all of them are requested at once to GA4 and a dict with the
+        data of each period_name is returned.
+
+        If daily, the rows are split by day and returned as (day, url,
+        package_url, value) tuples. Only supported by GA4.
+
+        If a checkpoint is given, the pages fetched are saved in it and the
+        pages already fetched by a previous load are not requested again.
+
+        If totals, only the total of the metric is requested, without
+        dimensions, and returned as the value of the stat.
         '''
+        if pushdown is None:
+            pushdown = self.pushdown
         if start_date and end_date and path is not None and stat:
             if stat not in [DownloadAnalytics.PACKAGE_STAT, DownloadAnalytics.RESOURCE_STAT, DownloadAnalytics.VISIT_STAT]:
                 return {}
+            if not date_ranges and not daily and not totals:
+                key = self._get_download_key(start_date, end_date, stat, path, path_section,
+                                             metrics_stat, sort_stat, pushdown)
+                if key in self._prefetched:
+                    return self._prefetched.pop(key)
             start_date = start_date.strftime('%Y-%m-%d')
             end_date = end_date.strftime('%Y-%m-%d')
             print('Downloading analytics for stat %s, since %s, until %s with path %s' %(stat, start_date, end_date, path))
@@ -905,12 +1432,19 @@ class DownloadAnalytics(object):
                             }
                         }
                         query.append(query_filter3)
+                    if pushdown:
+                        query.append(self._get_pushdown_filter(stat))
                     metrics = 'eventCount'
                     sort = True
                     dimensions = [{"name": "pagePath"}]
                 else:
                     if path:
                         query = 'ga:dimension3=~%s' % path
+                    if pushdown:
+                        if query:
+                            query += ';%s' % self._get_pushdown_filter(stat)
+                        else:
+                            query = self._get_pushdown_filter(stat)
                     metrics = 'ga:pageviews'
                     sort = '-ga:pageviews'
                     dimensions = "ga:dimension19"
@@ -928,7 +1462,7 @@ class DownloadAnalytics(object):
                         }
                     }
                     query.append(query_filter)
-                    if path:
+                    if path and pushdown:
                         path_filter = {
                             "filter": {
                                 "fieldName": "pagePath",
@@ -952,25 +1486,14 @@ class DownloadAnalytics(object):
                     ]
                 else:
                     query = 'ga:eventCategory==Resource;ga:eventAction==Download'
-                    if path:
+                    if path and pushdown:
                         query += ';ga:pagePath=~%s' % path
                     metrics = 'ga:totalEvents'
                     sort = '-ga:totalEvents'
                     dimensions = "ga:eventLabel, ga:pagePath"
                 if self.hostname:
-                    if self.is_ga4:
-                        query_filter = {
-                            "filter": {
-                                "fieldName": "hostName",
-                                "stringFilter": {
-                                    "matchType": "FULL_REGEXP",
-                                    "value": self.hostname,
-                                    "caseSensitive": False
-                                }
-                            }
-                        }
-                        query.append(query_filter)
-                    else:
+                    # GA4 hostnames are filtered by property, see _get_properties_data
+                    if not self.is_ga4:
                         if query:
                             query += ';ga:hostname=~%s' % self.hostname
                         else:
@@ -1072,6 +1595,11 @@ class DownloadAnalytics(object):
                     else:
                         query += '%s' % self.default_filter
 
+            if daily and self.is_ga4:
+                dimensions = dimensions + [{"name": "date"}]
+            if totals:
+                dimensions = [] if self.is_ga4 else ""
+
             # Supported query params at
             # https://developers.google.com/analytics/devguides/reporting/core/v3/reference
             try:
@@ -1084,185 +1612,331 @@ class DownloadAnalytics(object):
                 args["metrics"] = metrics
                 if stat == DownloadAnalytics.RESOURCE_STAT:
                     args["ids"] = "ga:" + self.profile_id
-                    args["prop_ids"] = self.property_id
                 else:
                     args["ids"] = "ga:" + self.profile_id_gtm
-                    args["prop_ids"] = self.property_id_gtm
                 args["filters"] = query
                 args["alt"] = "json"
                 if self.segment:
                     args['segment'] = 'gaid::%s' % self.segment
+                if checkpoint:
+                    args["checkpoint"] = checkpoint
+                if date_ranges:
+                    args["date-ranges"] = [(period_name, period_start.strftime('%Y-%m-%d'),
+                                            period_end.strftime('%Y-%m-%d'))
+                                           for period_name, period_start, period_end in date_ranges]
 
-
-                results = self._get_ga_data(args)
+                if self.is_ga4:
+                    results = self._get_properties_data(args, get_stat_properties(stat))
+                else:
+                    results = self._get_ga_data(args)
 
             except Exception as e:
                 log.exception(e)
                 print('EXCEPTION %s' % e)
                 return dict(url=[])
 
-
-            if stat == DownloadAnalytics.PACKAGE_STAT:
-                packages = []
-                pattern = re.compile('^' + DownloadAnalytics.PACKAGE_URL_REGEX)
-                excluded_patterns = []
-                for regex in DownloadAnalytics.PACKAGE_URL_EXCLUDED_REGEXS:
-                    excluded_patterns.append(re.compile('^' + regex))
-
-                rows = results if results else None
-                if rows and len(rows) >= 1:
-                    for row in rows:
-                        if self.is_ga4:
-                            path = row.get('dimensionValues', [])[0]['value']
-                            pageviews = row.get('metricValues', [])[0]['value']
-                        else:
-                            (path, pageviews) = row
-                        url = strip_off_host_prefix(path)
-                        url = strip_off_language_prefix(url)
-                        if not pattern.match(url):
-                            continue
-                        for excluded_pattern in excluded_patterns:
-                            if excluded_pattern.match(url):
-                                continue
-                        packages.append( (url, pageviews) ) # Temporary hack
-                return {stat:packages}
-            elif stat == DownloadAnalytics.RESOURCE_STAT:
-                resources = []
-                pattern = re.compile('^' + DownloadAnalytics.RESOURCE_URL_REGEX)
-                excluded_patterns = []
-                for regex in DownloadAnalytics.RESOURCE_URL_EXCLUDED_REGEXS:
-                    excluded_patterns.append(re.compile('^' + regex))
-
-                rows = results if results else None
-                if rows and len(rows) >= 1:
-                    for row in rows:
-                        if self.is_ga4:
-                            event_label = row.get('dimensionValues', [])[0]['value']
-                            page_path = row.get('dimensionValues', [])[1]['value']
-                            total_events = row.get('metricValues', [])[0]['value']
-                        else:
-                            (event_label, page_path, total_events) = row
-                        page_url = strip_off_host_prefix(page_path)
-                        page_url = strip_off_language_prefix(page_url)
-                        res_url = urllib.parse.unquote_plus(event_label)
-                        if not pattern.match(page_url):
-                            continue
-                        for excluded_pattern in excluded_patterns:
-                            if excluded_pattern.match(page_url):
-                                continue
-                        resources.append( (res_url, page_url, total_events) ) # Temporary hack
-                return {stat:resources}
-            elif stat == DownloadAnalytics.VISIT_STAT:
-                rows = results if results else None
-                print(rows)
-                visits = 0
-                if rows and len(rows) >= 1:
-                    for row in rows:
-                        if row:
-                            if self.is_ga4:
-                                visits = row.get('metricValues', [])[0]['value']
-                            else:
-                                visits = row[0]
-                            break
-                return {stat:visits}
+            if results is None:
+                # the download failed, so the stat is not returned
+                return {}
+            if totals:
+                rows = list(results)
+                return {stat: int(rows[0][-1]) if rows else 0}
+
+            if date_ranges:
+                # rows are grouped by the name of their date range
+                return dict((period_name, self._parse_results(stat, results.get(period_name, [])))
+                            for period_name, _, _ in date_ranges)
+            return self._parse_results(stat, results, daily)
         else:
             log.info("Not all parameters were received")
             print ("Not all parameters were received")
             return {}
 
-    def store(self, period_name, period_complete_day, data, stat):
+    def _parse_results(self, stat, results, daily=False):
+        '''Classifies the rows returned by GA for the stat. The package and
+        resource rows are classified in the worker processes if a pool of
+        workers has been started, and returned added up by url in RowTotals,
+        so they are not all kept in memory.'''
+        if stat in (DownloadAnalytics.PACKAGE_STAT, DownloadAnalytics.RESOURCE_STAT):
+            rows = results if results else []
+            if workers.get_pool() is not None:
+                return {stat: workers.classify_rows(stat, rows, daily)}
+            return {stat: RowTotals().add_rows(classify_rows(stat, rows, daily))}
+        elif stat == DownloadAnalytics.VISIT_STAT:
+            rows = results if results else None
+            visits = 0
+            if rows and len(rows) >= 1:
+                for row in rows:
+                    if row:
+                        visits = row[0]
+                        break
+            return {stat:visits}
+
+    def store(self, period_name, period_complete_day, data, stat, checkpoint=None, commit=True):
+        '''Stores the rows of the stat. The package and resource rows are
+        added up by url first, within the memory budget of
+        ckanext-dge-ga-report.memory.row_budget, so data[stat] may be any
+        iterable of rows. If commit is False, the package and resource rows
+        are left in the session for the caller to commit.
+        '''
         if self.save_stats:
             if stat and stat == DownloadAnalytics.PACKAGE_STAT and stat in data:
-                ga_model.update_dge_ga_package_stats(period_name, period_complete_day, data[stat],
-                                          print_progress=self.print_progress)
+                rows, total = _aggregate_rows(data[stat])
+                ga_model.update_dge_ga_package_stats(period_name, period_complete_day, rows,
+                                          print_progress=self.print_progress,
+                                          checkpoint=checkpoint, total=total, commit=commit)
 
             if stat and stat == DownloadAnalytics.RESOURCE_STAT and stat in data:
-                ga_model.update_dge_ga_resource_stats(period_name, period_complete_day, data[stat],
-                                          print_progress=self.print_progress)
+                rows, total = _aggregate_rows(data[stat])
+                ga_model.update_dge_ga_resource_stats(period_name, period_complete_day, rows,
+                                          print_progress=self.print_progress,
+                                          checkpoint=checkpoint, total=total, commit=commit)
 
             if stat and stat == DownloadAnalytics.VISIT_STAT and stat in data:
                 ga_model.update_dge_ga_visit_stats(period_name, period_complete_day, data[stat],
-                                          print_progress=self.print_progress)
+                                          print_progress=self.print_progress,
+                                          checkpoint=checkpoint)
+
+    def _get_properties_data(self, params, properties):
+        '''Returns the GA4 data specified in params from every property that
+        serves the stat. The properties are requested concurrently if the
+        transport allows it, and the rows of the same dimensions are added
+        up.
+
+        Returns the rows, or None if the data of any property is unsuccessful.
+        '''
+        def get_property_data(ga_property):
+            property_params = dict(params)
+            property_params['prop_ids'] = ga_property['id']
+            if ga_property['hostname']:
+                property_params['filters'] = list(params['filters'] or []) + [{
+                    "filter": {
+                        "fieldName": "hostName",
+                        "stringFilter": {
+                            "matchType": "FULL_REGEXP",
+                            "value": ga_property['hostname'],
+                            "caseSensitive": False
+                        }
+                    }
+                }]
+            if len(properties) > 1:
+                # the spooled pages of a checkpoint belong to one property
+                property_params.pop('checkpoint', None)
+                log.info('Requesting property %s', ga_property['name'])
+            with _get_property_semaphore(ga_property):
+                return self._get_ga_data(property_params)
+
+        if not properties:
+            log.error('No GA4 property configured for the request')
+            return None
+        if len(properties) > 1 and params.get('checkpoint'):
+            log.warning('The pages of %s are requested from %d properties, so they are not '
+                        'kept in its checkpoint and a resumed load requests them again. '
+                        'The rows stored are still checkpointed',
+                        params['checkpoint'], len(properties))
+            print('WARNING: the pages of %s are not checkpointed, as they are requested '
+                  'from %d properties' % (params['checkpoint'], len(properties)))
+        if len(properties) == 1:
+            return get_property_data(properties[0])
+        if transport.is_thread_safe():
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(properties)) as executor:
+                property_results = list(executor.map(get_property_data, properties))
+        else:
+            property_results = [get_property_data(ga_property) for ga_property in properties]
+        if any(results is None for results in property_results):
+            return None
+        if params.get('date-ranges'):
+            return dict((name, _add_up_rows(results.get(name, []) for results in property_results))
+                        for name, _, _ in params['date-ranges'])
+        return _add_up_rows(property_results)
 
     def _get_ga_data(self, params):
         '''Returns the GA data specified in params.
-        Does all requests to the GA API and retries if needed.
+        Does all requests to the GA API. Failed pages are retried by
+        _execute_request.
 
-        Returns a dict with the data, or dict(url=[]) if unsuccessful.
+        Returns the rows, or None if unsuccessful.
         '''
         try:
-            data = self._get_ga_data_simple(params)
+            data = self._get_ga_data_split(params)
         except DownloadError:
-            log.info('Will retry requests after a pause')
-            time.sleep(300)
-            try:
-                data = self._get_ga_data_simple(params)
-            except DownloadError:
-                return dict(url=[])
-            except Exception as e:
-                log.exception(e)
-                log.error('Uncaught exception in get_ga_data_simple (see '
-                          'above)')
-                return dict(url=[])
+            return None
         except Exception as e:
             log.exception(e)
             log.error('Uncaught exception in get_ga_data_simple (see above)')
-            return dict(url=[])
+            return None
         return data
 
 
+    def _execute_request(self, request):
+        '''Executes a request of a page to the GA API. Transient errors (HTTP
+        429 and 5xx responses, timeouts and connection errors) are retried up
+        to ckanext-dge-ga-report.retry.attempts times with exponential
+        backoff, so a failed page does not restart the report. Any other
+        error is raised at once.
+        '''
+        attempt = 1
+        while True:
+            try:
+                return request.execute()
+            except Exception as e:
+                if not _is_transient_error(e) or attempt >= self.retry_attempts:
+                    raise
+                pause = min(self.retry_backoff * (2 ** (attempt - 1)), 300)
+                log.warning('Error requesting GA page (attempt %i of %i), retrying in %.1f s: %s',
+                            attempt, self.retry_attempts, pause, e)
+                time.sleep(pause)
+                attempt += 1
+
+    def _get_ga4_request(self, params, date_ranges, offset, limit):
+        '''Returns the body of a GA4 runReport request'''
+        request = {
+            "metrics": [{'name': params['metrics']}],
+            "dateRanges": date_ranges,
+            "orderBys": [
+                {
+                    "desc": True,
+                    "metric": {
+                        "metricName": params['metrics']
+                    },
+                }
+            ],
+            "limit": str(limit),
+            "offset": str(offset),
+        }
+
+        if 'dimensions' in params and params['dimensions']:
+            request["dimensions"] = params['dimensions']
+
+        if any('name' in date_range for date_range in date_ranges):
+            # the rows of several named date ranges are told apart by it
+            dimensions = list(request.get("dimensions", []))
+            if {"name": "dateRange"} not in dimensions:
+                dimensions.append({"name": "dateRange"})
+            request["dimensions"] = dimensions
+
+        if 'filters' in params and params['filters']:
+            request["dimensionFilter"] = {
+                "andGroup": {
+                    "expressions": params['filters']
+                }
+            }
+        return request
+
+    def _get_row_count(self, params):
+        '''Returns the number of rows of a GA4 report, requesting just one'''
+        date_ranges = [{"startDate": params['start-date'], "endDate": params['end-date']}]
+        try:
+            response = self._execute_request(self.service.properties().runReport(
+                property=params['prop_ids'],
+                body=self._get_ga4_request(params, date_ranges, 0, 1)))
+        except Exception as e:
+            log.error("Exception getting GA row count: %s" % e)
+            raise DownloadError()
+        return response.get('rowCount', 0)
+
+    def _get_split_date_ranges(self, params):
+        '''Returns the weeks or days in which a GA4 report is split because
+        its row count exceeds ckanext-dge-ga-report.split.row_threshold, or
+        None if it is not split.
+        '''
+        if not self.is_ga4 or self.split_row_threshold <= 0 or not params.get('dimensions') or \
+           params.get('date-ranges') or params.get('checkpoint'):
+            return None
+        start_date = datetime.datetime.strptime(params['start-date'], '%Y-%m-%d')
+        end_date = datetime.datetime.strptime(params['end-date'], '%Y-%m-%d')
+        days = (end_date - start_date).days + 1
+        if days < 2:
+            return None
+        row_count = self._get_row_count(params)
+        if row_count <= self.split_row_threshold:
+            return None
+        # split in weeks unless they would still exceed the threshold
+        step = 7 if days >= 14 and row_count * 7 / days <= self.split_row_threshold else 1
+        log.info('Report of %i rows, splitting it in ranges of %i days', row_count, step)
+        print('Report of %i rows, splitting it in ranges of %i days' % (row_count, step))
+        ranges = []
+        range_start = start_date
+        while range_start <= end_date:
+            range_end = min(range_start + datetime.timedelta(days=step - 1), end_date)
+            ranges.append((range_start.strftime('%Y-%m-%d'), range_end.strftime('%Y-%m-%d')))
+            range_start = range_end + datetime.timedelta(days=1)
+        return ranges
+
+    def _get_ga_data_split(self, params):
+        '''Returns the GA data specified in params. Big GA4 reports are
+        requested by weeks or days, concurrently if the transport allows it,
+        and the rows of the same dimensions are added up.
+        Raises DownloadError if unsuccessful.
+        '''
+        ranges = self._get_split_date_ranges(params)
+        if not ranges:
+            return self._get_ga_data_simple(params)
+
+        def get_range_data(date_range):
+            range_params = dict(params)
+            range_params['start-date'], range_params['end-date'] = date_range
+            return self._get_ga_data_simple(range_params)
+
+        if transport.is_thread_safe() and self.split_parallel > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.split_parallel) as executor:
+                range_results = list(executor.map(get_range_data, ranges))
+        else:
+            range_results = [get_range_data(date_range) for date_range in ranges]
+
+        return _add_up_rows(range_results)
+
     def _get_ga_data_simple(self, params):
         '''Returns the GA data specified in params.
         Does all requests to the GA API.
-        Returns a dict with the data, or raises DownloadError if unsuccessful.
+        Returns the rows in RowTotals, or raises DownloadError if
+        unsuccessful. GA4 rows are decoded page by page into tuples, like the
+        UA ones, and each page is added up into the totals as it arrives.
+
+        If several GA4 date ranges are requested, the rows are returned in a
+        dict by the name of their date range.
         '''
         try:
-            results = []
+            results = RowTotals()
             start_index = 1
             max_results = 10000
             completed = False
+            date_ranges = params.get('date-ranges', None)
+            if self.is_ga4 and date_ranges:
+                results = dict((name, RowTotals()) for name, _, _ in date_ranges)
+                date_ranges = [
+                    {
+                        "name": name,
+                        "startDate": start_date,
+                        "endDate": end_date
+                    } for name, start_date, end_date in date_ranges
+                ]
+            else:
+                date_ranges = [
+                    {
+                        "startDate": params['start-date'],
+                        "endDate": params['end-date']
+                    }
+                ]
+            checkpoint = params.get('checkpoint', None)
+            if checkpoint:
+                for page in checkpoint.get_pages():
+                    results.add_rows(page)
+                start_index += checkpoint.pages_fetched * max_results
+                completed = checkpoint.is_downloaded
             while not completed:
                 if self.is_ga4:
                     start_index_ga4 = start_index - 1
-                    request = {
-                        "metrics": [{'name': params['metrics']}],
-                        "dateRanges": [
-                            {
-                                "startDate": params['start-date'],
-                                "endDate": params['end-date']
-                            }
-                        ],
-                        "orderBys": [
-                            {
-                                "desc": True,
-                                "metric": {
-                                    "metricName": params['metrics']
-                                },
-                            }
-                        ],
-                        "limit": str(max_results),
-                        "offset": str(start_index_ga4),
-                    }
-
-                    if 'dimensions' in params and params['dimensions']:
-                        request["dimensions"] = params['dimensions']
-
-                    if 'filters' in params and params['filters']:
-                        request["dimensionFilter"] = {
-                            "andGroup": {
-                                "expressions": params['filters']
-                            }
-                        }
-
-                    response = self.service.properties().runReport(
-                        property=params['prop_ids'], body=request).execute()
+                    request = self._get_ga4_request(params, date_ranges, start_index_ga4, max_results)
+                    response = self._execute_request(self.service.properties().runReport(
+                        property=params['prop_ids'], body=request))
                 else:
                     print('filtros %s' % params['filters'])
                     print('dimensions %s' % params['dimensions'])
                     print('metrics %s' % params['metrics'])
                     print('sort %s' % params['sort'])
                     print('id %s' % params['ids'])
-                    response = self.service.data().ga().get(ids=params['ids'],
+                    response = self._execute_request(self.service.data().ga().get(ids=params['ids'],
                                     filters=params['filters'],
                                     dimensions=params['dimensions'],
                                     start_date=params['start-date'],
@@ -1271,15 +1945,25 @@ class DownloadAnalytics(object):
                                     metrics=params['metrics'],
                                     sort=params['sort'],
                                     end_date=params['end-date'],
-                                    alt=params['alt']).execute()
+                                    alt=params['alt']))
                 log.info('There are %d results', response.get('totalResults', 0) if response else 0)
                 print ('There are %d results' % response.get('totalResults', 0) if response else 0)
                 result_count = len(response.get('rows', []))
                 if result_count < max_results:
                     completed = True
-                results.extend(response.get('rows', []))
+                if isinstance(results, dict):
+                    for name, row in decode_ga4_rows(response, date_ranges=True):
+                        results.setdefault(name, RowTotals()).add_row(row)
+                else:
+                    rows = decode_ga4_rows(response) if self.is_ga4 else response.get('rows', [])
+                    results.add_rows(rows)
+                    if checkpoint:
+                        checkpoint.add_page(rows)
+                response = None
                 start_index += max_results
                 time.sleep(0.2)
+            if checkpoint and not checkpoint.is_downloaded:
+                checkpoint.set_downloaded()
             return results
         except Exception as e:
             log.error("Exception getting GA data: %s" % e)
@@ -1296,7 +1980,8 @@ class DownloadAnalytics(object):
         # are going to make these requests ourselves.
         ga_url = 'https://www.googleapis.com/analytics/v3/data/ga'
         try:
-            response = requests.get(ga_url, params=params, headers=headers)
+            response = transport.get_session().get(ga_url, params=params, headers=headers,
+                                                   timeout=transport.get_timeout())
         except requests.exceptions.RequestException as e:
             log.error("Exception getting GA data: %s" % e)
             raise DownloadError()
@@ -1307,6 +1992,217 @@ class DownloadAnalytics(object):
         return response
 
 
+def _is_transient_error(error):
+    '''Returns True if a failed GA request may succeed if it is retried'''
+    if isinstance(error, HttpError):
+        status = getattr(error.resp, 'status', None)
+        try:
+            status = int(status)
+        except (TypeError, ValueError):
+            return False
+        if status == 403:
+            return _get_error_reason(error) in RATE_LIMIT_REASONS
+        return status == 429 or status >= 500
+    return isinstance(error, TRANSIENT_NETWORK_ERRORS)
+
+
+def _get_error_reason(error):
+    '''Returns the reason of the first error in the content of a Google
+    API HttpError, e.g. userRateLimitExceeded, or None'''
+    content = error.content
+    if isinstance(content, bytes):
+        content = content.decode('utf-8', 'replace')
+    try:
+        errors = json.loads(content).get('error', {}).get('errors', [])
+    except (TypeError, ValueError, AttributeError):
+        return None
+    return errors[0].get('reason') if errors and isinstance(errors[0], dict) else None
+
+
+def classify_rows(stat, rows, daily=False):
+    '''Normalizes the paths of the package or resource rows returned by GA
+    and yields the rows of the urls of the stat'''
+    if stat == DownloadAnalytics.PACKAGE_STAT:
+        pattern = re.compile('^' + DownloadAnalytics.PACKAGE_URL_REGEX)
+        excluded_patterns = []
+        for regex in DownloadAnalytics.PACKAGE_URL_EXCLUDED_REGEXS:
+            excluded_patterns.append(re.compile('^' + regex))
+
+        for row in rows:
+            if daily:
+                (path, day, pageviews) = row
+            else:
+                (path, pageviews) = row
+            url = strip_off_host_prefix(path)
+            url = strip_off_language_prefix(url)
+            if not pattern.match(url):
+                continue
+            if any(excluded_pattern.match(url) for excluded_pattern in excluded_patterns):
+                continue
+            if daily:
+                yield (day, url, '', pageviews)
+            else:
+                yield (url, pageviews) # Temporary hack
+    elif stat == DownloadAnalytics.RESOURCE_STAT:
+        pattern = re.compile('^' + DownloadAnalytics.RESOURCE_URL_REGEX)
+        excluded_patterns = []
+        for regex in DownloadAnalytics.RESOURCE_URL_EXCLUDED_REGEXS:
+            excluded_patterns.append(re.compile('^' + regex))
+
+        for row in rows:
+            if daily:
+                (event_label, page_path, day, total_events) = row
+            else:
+                (event_label, page_path, total_events) = row
+            page_url = strip_off_host_prefix(page_path)
+            page_url = strip_off_language_prefix(page_url)
+            res_url = urllib.parse.unquote_plus(event_label)
+            if not pattern.match(page_url):
+                continue
+            if any(excluded_pattern.match(page_url) for excluded_pattern in excluded_patterns):
+                continue
+            if daily:
+                yield (day, res_url, page_url, total_events)
+            else:
+                yield (res_url, page_url, total_events) # Temporary hack
+
+
+def _aggregate_rows(rows):
+    '''Adds up the metric of the rows with the same dimensions, spilling to
+    disk beyond the row budget. Returns an iterator of the rows sorted by
+    dimensions and the number of rows (an upper bound if spilled).
+    '''
+    if isinstance(rows, RowTotals):
+        # already added up by the download
+        return iter(rows), len(rows)
+    aggregator = SpillingAggregator()
+    for row in rows:
+        aggregator.add(tuple(row[:-1]), int(row[-1] or 0))
+    return ((key + (value,)) for key, value in aggregator), len(aggregator)
+
+
+def _add_up_rows(row_lists):
+    '''Adds up the metric of the rows with the same dimensions in several
+    iterables of rows, and returns them in RowTotals'''
+    totals = RowTotals()
+    for rows in row_lists:
+        totals.add_rows(rows)
+    return totals
+
+
+def _compare_rows(rows, other_rows):
+    '''Yields the dimensions and the metrics of the rows that differ
+    between two iterables of rows sorted by dimensions and added up, with
+    None as the metric of the rows missing in one of them'''
+    tagged = heapq.merge(((tuple(row[:-1]), 0, row[-1]) for row in rows),
+                         ((tuple(row[:-1]), 1, row[-1]) for row in other_rows))
+    for dimensions, group in itertools.groupby(tagged, key=lambda item: item[0]):
+        values = [None, None]
+        for _, side, value in group:
+            values[side] = value
+        if values[0] != values[1]:
+            yield dimensions, values[0], values[1]
+
+
+_property_semaphores = {}
+_property_semaphores_lock = threading.Lock()
+
+
+def _get_property_semaphore(ga_property):
+    '''Returns the semaphore that limits the concurrent requests to a
+    property in the process'''
+    with _property_semaphores_lock:
+        if ga_property['name'] not in _property_semaphores:
+            _property_semaphores[ga_property['name']] = threading.BoundedSemaphore(
+                max(ga_property['max_concurrent'], 1))
+        return _property_semaphores[ga_property['name']]
+
+
+def get_properties():
+    '''
+    Returns the GA4 properties configured in ckanext-dge-ga-report.properties,
+    each with its id, stats, hostname and maximum of concurrent requests in
+    ckanext-dge-ga-report.property.<name>.*. If none is configured, the
+    view_id_ga4 property serves the resource stat and the view_id_ga4_gtm
+    property the other ones.
+    '''
+    names = config.get('ckanext-dge-ga-report.properties', '').split()
+    if not names:
+        return [
+            {'name': 'gtm',
+             'id': 'properties/%s' % config.get('ckanext-dge-ga-report.view_id_ga4_gtm', None),
+             'stats': [DownloadAnalytics.PACKAGE_STAT, DownloadAnalytics.VISIT_STAT],
+             'hostname': None,
+             'max_concurrent': asint(config.get('ckanext-dge-ga-report.property.max_concurrent', 10))},
+            {'name': 'resources',
+             'id': 'properties/%s' % config.get('ckanext-dge-ga-report.view_id_ga4', None),
+             'stats': [DownloadAnalytics.RESOURCE_STAT],
+             'hostname': config.get('ckanext-dge-ga-report.hostname', None),
+             'max_concurrent': asint(config.get('ckanext-dge-ga-report.property.max_concurrent', 10))},
+        ]
+    properties = []
+    for name in names:
+        prefix = 'ckanext-dge-ga-report.property.%s.' % name
+        properties.append({
+            'name': name,
+            'id': 'properties/%s' % config.get(prefix + 'id'),
+            'stats': config.get(prefix + 'stats', ' '.join([DownloadAnalytics.PACKAGE_STAT,
+                                                            DownloadAnalytics.RESOURCE_STAT,
+                                                            DownloadAnalytics.VISIT_STAT])).split(),
+            'hostname': config.get(prefix + 'hostname', None),
+            'max_concurrent': asint(config.get(prefix + 'max_concurrent',
+                                               config.get('ckanext-dge-ga-report.property.max_concurrent', 10))),
+        })
+    return properties
+
+
+def get_stat_properties(stat):
+    '''Returns the GA4 properties that serve the stat'''
+    return [ga_property for ga_property in get_properties() if stat in ga_property['stats']]
+
+
+def _get_metric_value(value):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def decode_ga4_rows(response, date_ranges=False):
+    '''Decodes the rows of a GA4 runReport response into tuples with the
+    dimension values followed by the metric values. The dimension values
+    are interned, the date dimension is returned as YYYY-MM-DD and the
+    metrics are converted to numbers.
+
+    If date_ranges, (date_range, row) tuples are returned. The dateRange
+    dimension must be in the response, otherwise DownloadError is raised.
+    '''
+    headers = [header.get('name') for header in response.get('dimensionHeaders', [])]
+    range_index = None
+    if date_ranges:
+        if 'dateRange' not in headers:
+            if not response.get('rows'):
+                return []
+            raise DownloadError('The dateRange dimension is missing in the GA4 response')
+        range_index = headers.index('dateRange')
+    date_index = headers.index('date') if 'date' in headers else None
+    intern = sys.intern
+    decoded = []
+    for row in response.get('rows', []):
+        values = [intern(value['value']) for value in row.get('dimensionValues', [])]
+        if date_index is not None:
+            day = values[date_index]
+            values[date_index] = '%s-%s-%s' % (day[0:4], day[4:6], day[6:8])
+        if range_index is not None:
+            name = values.pop(range_index)
+        values.extend(_get_metric_value(value['value']) for value in row.get('metricValues', []))
+        if range_index is not None:
+            decoded.append((name, tuple(values)))
+        else:
+            decoded.append(tuple(values))
+    return decoded
+
+
 global host_re
 global http_re
 host_re = None
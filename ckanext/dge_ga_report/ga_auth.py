@@ -16,17 +16,31 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import os
-import httplib2
+import datetime
 from apiclient.discovery import build
-from oauth2client.client import flow_from_clientsecrets
-from oauth2client.file import Storage
-from oauth2client import tools
+from googleapiclient.discovery_cache.base import Cache
 from oauth2client.service_account import ServiceAccountCredentials
 import logging
 log = logging.getLogger(__name__)
 
 
-from ckan.plugins.toolkit import (config)
+from ckan.plugins.toolkit import (config, asint)
+from .lib import JsonFileCache
+from .transport import get_http
+
+
+class DiscoveryCache(Cache):
+    '''Keeps the discovery documents of the APIs in the file cache'''
+
+    def __init__(self):
+        self.cache = JsonFileCache(
+            'discovery', asint(config.get('ckanext-dge-ga-report.cache.discovery_ttl', 86400)))
+
+    def get(self, url):
+        return self.cache.get(url)
+
+    def set(self, url, content):
+        self.cache.set(url, content)
 
 
 def _prepare_credentials(credentials_file):
@@ -42,20 +56,50 @@ def _prepare_credentials(credentials_file):
     return credentials
 
 
-def init_service(credentials_file, is_ga4=False):
+def _load_access_token(credentials, credentials_file, use_cache=True):
+    """
+    Reuses the access token of the credentials cached by a previous
+    command while it is still valid. Otherwise a new token is requested
+    and cached until it expires.
+    """
+    cache = JsonFileCache('tokens', 0)
+    key = '%s:%s' % (os.path.abspath(credentials_file), credentials.service_account_email)
+    token = cache.get(key) if use_cache else None
+    if token:
+        credentials.access_token = token['access_token']
+        credentials.token_expiry = datetime.datetime.utcfromtimestamp(token['expires'])
+        if not credentials.access_token_expired:
+            return
+    token_info = credentials.get_access_token()
+    # leave a margin so a cached token does not expire in the middle of a load
+    expires_in = max((token_info.expires_in or 0) - 300, 0)
+    if expires_in:
+        cache.set(key, {'access_token': token_info.access_token,
+                        'expires': (credentials.token_expiry - datetime.datetime(1970, 1, 1)).total_seconds()},
+                  ttl=expires_in)
+
+
+def init_service(credentials_file, is_ga4=False, use_cache=True):
     """
     Given a file containing the user's oauth token (and another with
     credentials in case we need to generate the token) will return a
     service object representing the analytics API.
+
+    The discovery documents and the access token are cached in
+    ckanext-dge-ga-report.cache_dir unless use_cache is False. The
+    requests are made with the transport of ckanext-dge-ga-report.http.transport.
     """
     credentials = _prepare_credentials(credentials_file)
+    _load_access_token(credentials, credentials_file, use_cache)
+    discovery_cache = DiscoveryCache() if use_cache else None
+    http = credentials.authorize(get_http())
 
     if is_ga4:
-        return build('analyticsdata', 'v1beta', credentials=credentials, cache_discovery=False)
+        return build('analyticsdata', 'v1beta', http=http,
+                     cache_discovery=use_cache, cache=discovery_cache)
     else:
-        http = httplib2.Http()
-        http = credentials.authorize(http)
-        return build('analytics', 'v3', http=http, cache_discovery=False)
+        return build('analytics', 'v3', http=http,
+                     cache_discovery=use_cache, cache=discovery_cache)
 
 
 def get_profile_id(service, webPropertyId, view_id):
@@ -65,19 +109,34 @@ def get_profile_id(service, webPropertyId, view_id):
     over all of the accounts available to the user who invoked the
     service to find one where the account name matches (in case the
     user has several).
+
+    The profile IDs found are cached for
+    ckanext-dge-ga-report.cache.profile_ttl seconds.
     """
+    accountName = config.get('googleanalytics.account')
+    cache = JsonFileCache('profiles', asint(config.get('ckanext-dge-ga-report.cache.profile_ttl', 86400)))
+    key = '%s:%s:%s' % (accountName, webPropertyId, view_id)
+    profile_id = cache.get(key)
+    if profile_id:
+        return profile_id
+
+    profile_id = _find_profile_id(service, accountName, webPropertyId, view_id)
+    if profile_id:
+        cache.set(key, profile_id)
+    return profile_id
+
+
+def _find_profile_id(service, accountName, webPropertyId, view_id):
     accounts = service.management().accounts().list().execute()
 
     if not accounts.get('items'):
         return None
 
-    accountName = config.get('googleanalytics.account')
+    accountId = None
     for acc in accounts.get('items'):
         if acc.get('name') == accountName:
             accountId = acc.get('id')
 
-    webproperties = service.management().webproperties().list(accountId=accountId).execute()
-
     profiles = service.management().profiles().list(
         accountId=accountId, webPropertyId=webPropertyId).execute()
 
@@ -18,14 +18,21 @@
 # -*- coding:utf-8 -*-
 import logging
 import re
+import time
+import hashlib
 import urllib.request, urllib.parse, urllib.error
 import datetime
+import threading
+import itertools
+import collections
+import concurrent.futures
 
 from ckan.model.domain_object import DomainObject
 
 from sqlalchemy import Table, Column, MetaData, PrimaryKeyConstraint
 from sqlalchemy import types
-from sqlalchemy.orm import mapper
+from sqlalchemy import create_engine
+from sqlalchemy.orm import mapper, scoped_session, sessionmaker
 from sqlalchemy.sql.expression import cast
 from sqlalchemy import func
 from sqlalchemy.exc import InvalidRequestError, IntegrityError
@@ -33,23 +40,57 @@ from sqlalchemy.exc import InvalidRequestError, IntegrityError
 from psycopg2.errors import UniqueViolation 
 
 import ckan.model as model
+from ckan.plugins.toolkit import (config, asint)
 
 
-from .lib import GaProgressBar
+from .lib import GaProgressBar, get_row_budget
 
 log = logging.getLogger(__name__)
 
 DGE_GA_PACKAGE_TABLE_NAME = 'dge_ga_packages'
 DGE_GA_RESOURCE_TABLE_NAME = 'dge_ga_resources'
 DGE_GA_VISIT_TABLE_NAME = 'dge_ga_visits'
+DGE_GA_LOAD_WATERMARK_TABLE_NAME = 'dge_ga_load_watermarks'
+DGE_GA_DAILY_STAT_TABLE_NAME = 'dge_ga_daily_stats'
+DGE_GA_LOAD_CHECKPOINT_TABLE_NAME = 'dge_ga_load_checkpoints'
+DGE_GA_PERIOD_TOTAL_TABLE_NAME = 'dge_ga_period_totals'
+DGE_GA_RESOURCE_URL_INDEX_TABLE_NAME = 'dge_ga_resource_url_index'
+DGE_GA_PACKAGE_ATTRIBUTION_TABLE_NAME = 'dge_ga_package_attribution'
+DGE_GA_ROLLUP_TABLE_NAME = 'dge_ga_rollups'
+DGE_GA_CUMULATIVE_TABLE_NAME = 'dge_ga_cumulative'
+DGE_GA_TOP_PACKAGE_TABLE_NAME = 'dge_ga_top_packages'
+DGE_GA_POPULARITY_TABLE_NAME = 'dge_ga_popularity'
+DGE_GA_INDEXED_COUNTS_TABLE_NAME = 'dge_ga_indexed_counts'
 
 global dge_ga_package_table
 global dge_ga_resource_table
 global dge_ga_visit_table
+global dge_ga_load_watermark_table
+global dge_ga_daily_stat_table
+global dge_ga_load_checkpoint_table
+global dge_ga_period_total_table
+global dge_ga_resource_url_index_table
+global dge_ga_package_attribution_table
+global dge_ga_rollup_table
+global dge_ga_cumulative_table
+global dge_ga_top_package_table
+global dge_ga_popularity_table
+global dge_ga_indexed_counts_table
 
 dge_ga_package_table = None
 dge_ga_resource_table = None
 dge_ga_visit_table = None
+dge_ga_load_watermark_table = None
+dge_ga_daily_stat_table = None
+dge_ga_load_checkpoint_table = None
+dge_ga_period_total_table = None
+dge_ga_resource_url_index_table = None
+dge_ga_package_attribution_table = None
+dge_ga_rollup_table = None
+dge_ga_cumulative_table = None
+dge_ga_top_package_table = None
+dge_ga_popularity_table = None
+dge_ga_indexed_counts_table = None
 
 metadata = MetaData()
 
@@ -221,6 +262,162 @@ class DgeGaVisit(DgeGaDomainObject):
             log.debug(log_message)
             print(log_message)
 
+class DgeGaLoadWatermark(DgeGaDomainObject):
+    '''
+    A DgeGaLoadWatermark contains the last day loaded by an incremental load
+    of a stat.
+    '''
+    def __init__(self, **kwargs):
+        for k,v in list(kwargs.items()):
+            setattr(self, k, v)
+
+    def __repr__(self):
+        return '''<DgeGaLoadWatermark stat=%s, year_month=%s, last_day=%s>''' % \
+               (self.stat, self.year_month, self.last_day)
+
+class DgeGaDailyStat(DgeGaDomainObject):
+    '''
+    A DgeGaDailyStat contains the daily pageviews or total events of an url
+    of the period being loaded incrementally.
+    '''
+    def __init__(self, **kwargs):
+        for k,v in list(kwargs.items()):
+            setattr(self, k, v)
+
+    def __repr__(self):
+        return '''<DgeGaDailyStat stat=%s, year_month=%s, day=%s, url=%s, package_url=%s, value=%s>''' % \
+               (self.stat, self.year_month, self.day, self.url, self.package_url, self.value)
+
+class DgeGaLoadCheckpoint(DgeGaDomainObject):
+    '''
+    A DgeGaLoadCheckpoint contains the progress of the load of a stat (or a
+    section of the visits stat) in a period until end_date: pages fetched
+    and rows stored.
+    '''
+    def __init__(self, **kwargs):
+        for k,v in list(kwargs.items()):
+            setattr(self, k, v)
+
+    def __repr__(self):
+        return '''<DgeGaLoadCheckpoint year_month=%s, stat=%s, section=%s, end_date=%s, status=%s, 
+                  pages_fetched=%s, rows_stored=%s>''' % \
+               (self.year_month, self.stat, self.section, self.end_date, self.status,
+                self.pages_fetched, self.rows_stored)
+
+class DgeGaPeriodTotal(DgeGaDomainObject):
+    '''
+    A DgeGaPeriodTotal contains the total of a stat in a period returned by
+    GA on the last load of the period.
+    '''
+    def __init__(self, **kwargs):
+        for k,v in list(kwargs.items()):
+            setattr(self, k, v)
+
+    def __repr__(self):
+        return '''<DgeGaPeriodTotal year_month=%s, stat=%s, total=%s>''' % \
+               (self.year_month, self.stat, self.total)
+
+class DgeGaResourceUrlIndex(DgeGaDomainObject):
+    '''
+    A DgeGaResourceUrlIndex contains the hash of the url of a resource, to
+    find the resource of a GA event label with one indexed lookup.
+    '''
+    def __init__(self, **kwargs):
+        for k,v in list(kwargs.items()):
+            setattr(self, k, v)
+
+    def __repr__(self):
+        return '''<DgeGaResourceUrlIndex url_hash=%s, resource_id=%s, package_name=%s, format=%s>''' % \
+               (self.url_hash, self.resource_id, self.package_name, self.format)
+
+class DgeGaPackageAttribution(DgeGaDomainObject):
+    '''
+    A DgeGaPackageAttribution contains the last known organization and
+    publisher of a package name. Rows are kept when the package is deleted
+    or purged.
+    '''
+    def __init__(self, **kwargs):
+        for k,v in list(kwargs.items()):
+            setattr(self, k, v)
+
+    def __repr__(self):
+        return '''<DgeGaPackageAttribution package_name=%s, package_id=%s, organization_id=%s, 
+                  publisher_id=%s, state=%s>''' % \
+               (self.package_name, self.package_id, self.organization_id,
+                self.publisher_id, self.state)
+
+class DgeGaRollup(DgeGaDomainObject):
+    '''
+    A DgeGaRollup contains the pageviews or total events of a month added
+    up by publisher, organization and format, or by some of them. The bits
+    of grouping_id are set for the columns added up over.
+    '''
+    def __init__(self, **kwargs):
+        for k,v in list(kwargs.items()):
+            setattr(self, k, v)
+
+    def __repr__(self):
+        return '''<DgeGaRollup year_month=%s, stat=%s, grouping_id=%s, publisher_id=%s, 
+                  organization_id=%s, format=%s, value=%s>''' % \
+               (self.year_month, self.stat, self.grouping_id, self.publisher_id,
+                self.organization_id, self.format, self.value)
+
+class DgeGaCumulative(DgeGaDomainObject):
+    '''
+    A DgeGaCumulative contains the pageviews of a package (key is its name)
+    or the total events of a resource (key is its id) in a month, and their
+    running total up to that month. There are only rows for the months with
+    values.
+    '''
+    def __init__(self, **kwargs):
+        for k,v in list(kwargs.items()):
+            setattr(self, k, v)
+
+    def __repr__(self):
+        return '''<DgeGaCumulative stat=%s, key=%s, year_month=%s, value=%s, cumulative=%s>''' % \
+               (self.stat, self.key, self.year_month, self.value, self.cumulative)
+
+class DgeGaTopPackage(DgeGaDomainObject):
+    '''
+    A DgeGaTopPackage contains one of the most viewed public packages of a
+    month (or 'All'), in the ranking of every package (scope is '') or of
+    the packages of a publisher (scope is the publisher id).
+    '''
+    def __init__(self, **kwargs):
+        for k,v in list(kwargs.items()):
+            setattr(self, k, v)
+
+    def __repr__(self):
+        return '''<DgeGaTopPackage year_month=%s, scope=%s, rank=%s, package_name=%s, pageviews=%s>''' % \
+               (self.year_month, self.scope, self.rank, self.package_name, self.pageviews)
+
+class DgeGaPopularity(DgeGaDomainObject):
+    '''
+    A DgeGaPopularity contains the popularity score of a package: its
+    monthly pageviews and resource downloads with an exponential decay by
+    the age of the month, up to the month of year_month.
+    '''
+    def __init__(self, **kwargs):
+        for k,v in list(kwargs.items()):
+            setattr(self, k, v)
+
+    def __repr__(self):
+        return '''<DgeGaPopularity package_name=%s, score=%s, year_month=%s>''' % \
+               (self.package_name, self.score, self.year_month)
+
+class DgeGaIndexedCounts(DgeGaDomainObject):
+    '''
+    A DgeGaIndexedCounts contains the view and download counts of a package
+    last pushed to the search index by the reindex of changed counts.
+    '''
+    def __init__(self, **kwargs):
+        for k,v in list(kwargs.items()):
+            setattr(self, k, v)
+
+    def __repr__(self):
+        return '''<DgeGaIndexedCounts package_name=%s, views_total=%s, views_last_month=%s, downloads_total=%s>''' % \
+               (self.package_name, self.views_total, self.views_last_month, self.downloads_total)
+
 
 dge_ga_package_table = Table(DGE_GA_PACKAGE_TABLE_NAME, metadata,
                           Column('year_month', types.UnicodeText, nullable = False),
@@ -258,6 +455,126 @@ dge_ga_visit_table = Table(DGE_GA_VISIT_TABLE_NAME, metadata,
                           PrimaryKeyConstraint('year_month', 'key','key_value'))
 mapper(DgeGaVisit, dge_ga_visit_table)
 
+
+dge_ga_load_watermark_table = Table(DGE_GA_LOAD_WATERMARK_TABLE_NAME, metadata,
+                          Column('stat', types.UnicodeText, nullable = False),
+                          Column('year_month', types.UnicodeText, nullable = False),
+                          Column('last_day', types.UnicodeText, nullable = False),
+                          Column('modified', types.DateTime, nullable = True),
+                          PrimaryKeyConstraint('stat'))
+mapper(DgeGaLoadWatermark, dge_ga_load_watermark_table)
+
+
+dge_ga_daily_stat_table = Table(DGE_GA_DAILY_STAT_TABLE_NAME, metadata,
+                          Column('stat', types.UnicodeText, nullable = False),
+                          Column('year_month', types.UnicodeText, nullable = False),
+                          Column('day', types.UnicodeText, nullable = False),
+                          Column('url', types.UnicodeText, nullable = False),
+                          Column('package_url', types.UnicodeText, nullable = False, server_default=''),
+                          Column('value', types.Integer, nullable = False, server_default='0'),
+                          PrimaryKeyConstraint('stat', 'day', 'url', 'package_url'))
+mapper(DgeGaDailyStat, dge_ga_daily_stat_table)
+
+
+dge_ga_load_checkpoint_table = Table(DGE_GA_LOAD_CHECKPOINT_TABLE_NAME, metadata,
+                          Column('year_month', types.UnicodeText, nullable = False),
+                          Column('stat', types.UnicodeText, nullable = False),
+                          Column('section', types.UnicodeText, nullable = False, server_default=''),
+                          Column('end_date', types.UnicodeText, nullable = False, server_default=''),
+                          Column('status', types.UnicodeText, nullable = False),
+                          Column('pages_fetched', types.Integer, nullable = False, server_default='0'),
+                          Column('rows_stored', types.Integer, nullable = False, server_default='0'),
+                          Column('modified', types.DateTime, nullable = True),
+                          PrimaryKeyConstraint('year_month', 'stat', 'section'))
+mapper(DgeGaLoadCheckpoint, dge_ga_load_checkpoint_table)
+
+
+dge_ga_period_total_table = Table(DGE_GA_PERIOD_TOTAL_TABLE_NAME, metadata,
+                          Column('year_month', types.UnicodeText, nullable = False),
+                          Column('stat', types.UnicodeText, nullable = False),
+                          Column('total', types.BigInteger, nullable = False, server_default='0'),
+                          Column('modified', types.DateTime, nullable = True),
+                          PrimaryKeyConstraint('year_month', 'stat'))
+mapper(DgeGaPeriodTotal, dge_ga_period_total_table)
+
+
+dge_ga_resource_url_index_table = Table(DGE_GA_RESOURCE_URL_INDEX_TABLE_NAME, metadata,
+                          Column('url_hash', types.UnicodeText, nullable = False),
+                          Column('resource_id', types.UnicodeText, nullable = False),
+                          Column('package_id', types.UnicodeText, nullable = False, index = True),
+                          Column('package_name', types.UnicodeText, nullable = False),
+                          Column('format', types.UnicodeText, nullable = True),
+                          PrimaryKeyConstraint('url_hash', 'package_id', 'resource_id'))
+mapper(DgeGaResourceUrlIndex, dge_ga_resource_url_index_table)
+
+
+dge_ga_package_attribution_table = Table(DGE_GA_PACKAGE_ATTRIBUTION_TABLE_NAME, metadata,
+                          Column('package_name', types.UnicodeText, nullable = False),
+                          Column('package_id', types.UnicodeText, nullable = True, index = True),
+                          Column('organization_id', types.UnicodeText, nullable = True),
+                          Column('publisher_id', types.UnicodeText, nullable = True),
+                          Column('state', types.UnicodeText, nullable = True),
+                          Column('modified', types.DateTime, nullable = True),
+                          PrimaryKeyConstraint('package_name'))
+mapper(DgeGaPackageAttribution, dge_ga_package_attribution_table)
+
+
+dge_ga_rollup_table = Table(DGE_GA_ROLLUP_TABLE_NAME, metadata,
+                          Column('year_month', types.UnicodeText, nullable = False),
+                          Column('stat', types.UnicodeText, nullable = False),
+                          Column('grouping_id', types.Integer, nullable = False),
+                          Column('publisher_id', types.UnicodeText, nullable = False, server_default=''),
+                          Column('organization_id', types.UnicodeText, nullable = False, server_default=''),
+                          Column('format', types.UnicodeText, nullable = False, server_default=''),
+                          Column('value', types.BigInteger, nullable = False, server_default='0'),
+                          Column('modified', types.DateTime, nullable = True),
+                          PrimaryKeyConstraint('year_month', 'stat', 'grouping_id',
+                                               'publisher_id', 'organization_id', 'format'))
+mapper(DgeGaRollup, dge_ga_rollup_table)
+
+
+dge_ga_cumulative_table = Table(DGE_GA_CUMULATIVE_TABLE_NAME, metadata,
+                          Column('stat', types.UnicodeText, nullable = False),
+                          Column('key', types.UnicodeText, nullable = False),
+                          Column('year_month', types.UnicodeText, nullable = False),
+                          Column('value', types.BigInteger, nullable = False, server_default='0'),
+                          Column('cumulative', types.BigInteger, nullable = False, server_default='0'),
+                          PrimaryKeyConstraint('stat', 'key', 'year_month'))
+mapper(DgeGaCumulative, dge_ga_cumulative_table)
+
+
+dge_ga_top_package_table = Table(DGE_GA_TOP_PACKAGE_TABLE_NAME, metadata,
+                          Column('year_month', types.UnicodeText, nullable = False),
+                          Column('scope', types.UnicodeText, nullable = False, server_default=''),
+                          Column('rank', types.Integer, nullable = False),
+                          Column('end_day', types.Integer, nullable = False),
+                          Column('package_name', types.UnicodeText, nullable = False),
+                          Column('publisher_id', types.UnicodeText, nullable = False),
+                          Column('pageviews', types.Integer, nullable = False, server_default='0'),
+                          PrimaryKeyConstraint('year_month', 'scope', 'rank'))
+mapper(DgeGaTopPackage, dge_ga_top_package_table)
+
+
+dge_ga_popularity_table = Table(DGE_GA_POPULARITY_TABLE_NAME, metadata,
+                          Column('package_name', types.UnicodeText, nullable = False),
+                          Column('score', types.Float, nullable = False, server_default='0'),
+                          Column('pageviews_score', types.Float, nullable = False, server_default='0'),
+                          Column('downloads_score', types.Float, nullable = False, server_default='0'),
+                          Column('year_month', types.UnicodeText, nullable = False),
+                          Column('modified', types.DateTime, nullable = True),
+                          PrimaryKeyConstraint('package_name'))
+mapper(DgeGaPopularity, dge_ga_popularity_table)
+
+
+dge_ga_indexed_counts_table = Table(DGE_GA_INDEXED_COUNTS_TABLE_NAME, metadata,
+                          Column('package_name', types.UnicodeText, nullable = False),
+                          Column('views_total', types.Integer, nullable = False, server_default='0'),
+                          Column('views_last_month', types.Integer, nullable = False, server_default='0'),
+                          Column('downloads_total', types.Integer, nullable = False, server_default='0'),
+                          Column('modified', types.DateTime, nullable = True),
+                          PrimaryKeyConstraint('package_name'))
+mapper(DgeGaIndexedCounts, dge_ga_indexed_counts_table)
+
 def init_tables():
     engine = model.meta.engine
     if (dge_ga_package_table not in metadata.sorted_tables and \
@@ -296,6 +613,30 @@ def init_tables():
             log.debug('%s table already exists', DGE_GA_VISIT_TABLE_NAME)
             print('%s table already exists' % (DGE_GA_VISIT_TABLE_NAME))
 
+        for table_name, table in ((DGE_GA_LOAD_WATERMARK_TABLE_NAME, dge_ga_load_watermark_table),
+                                  (DGE_GA_DAILY_STAT_TABLE_NAME, dge_ga_daily_stat_table),
+                                  (DGE_GA_LOAD_CHECKPOINT_TABLE_NAME, dge_ga_load_checkpoint_table),
+                                  (DGE_GA_PERIOD_TOTAL_TABLE_NAME, dge_ga_period_total_table),
+                                  (DGE_GA_RESOURCE_URL_INDEX_TABLE_NAME, dge_ga_resource_url_index_table),
+                                  (DGE_GA_PACKAGE_ATTRIBUTION_TABLE_NAME, dge_ga_package_attribution_table),
+                                  (DGE_GA_ROLLUP_TABLE_NAME, dge_ga_rollup_table),
+                                  (DGE_GA_CUMULATIVE_TABLE_NAME, dge_ga_cumulative_table),
+                                  (DGE_GA_TOP_PACKAGE_TABLE_NAME, dge_ga_top_package_table),
+                                  (DGE_GA_POPULARITY_TABLE_NAME, dge_ga_popularity_table),
+                                  (DGE_GA_INDEXED_COUNTS_TABLE_NAME, dge_ga_indexed_counts_table)):
+            if not table.exists(model.meta.engine):
+                table.create(model.meta.engine)
+                log.debug('%s table created', table_name)
+                print('%s table created' % (table_name))
+            else:
+                log.debug('%s table already exists', table_name)
+                print('%s table already exists' % (table_name))
+
+        # the end date of the loads was added to the checkpoints table
+        model.Session.execute("alter table %s add column if not exists end_date text not null default ''" %
+                              DGE_GA_LOAD_CHECKPOINT_TABLE_NAME)
+        model.Session.commit()
+
 cached_tables = {}
 
 def get_table(name):
@@ -379,14 +720,42 @@ def complete_historical_values_dge_ga_tables(tablename=None):
 
 
 class Identifier:
-    
-    def __init__(self):
+    '''
+    Finds the package, organization and publisher of urls. Each instance
+    uses its own session (model.Session by default), so instances can be
+    used by different threads.
+    '''
+
+    def __init__(self, session=None):
         from .download_analytics import DownloadAnalytics
-        Identifier.package_re = re.compile('^' + DownloadAnalytics.PACKAGE_URL_REGEX)
+        self.package_re = re.compile('^' + DownloadAnalytics.PACKAGE_URL_REGEX)
+        self.session = session or model.Session
+
+    def _get_package(self, reference):
+        package = self.session.query(model.Package).get(reference)
+        if package is None:
+            package = self.session.query(model.Package).filter_by(name=reference).first()
+        return package
+
+    def _get_group(self, reference):
+        return _get_group(self.session, reference)
+
+    def _get_package_attribution(self, package_ref):
+        '''Returns the package id, package name, organization id and
+        publisher id of a package name or id, or None if it is unknown'''
+        if is_package_attribution_built(self.session):
+            attribution = get_package_attribution(package_ref, self.session)
+            if attribution is not None:
+                return attribution
+        package = self._get_package(package_ref)
+        if package is None:
+            return None
+        org_id, pub_id = get_package_organization_and_publisher(package, self.session)
+        return package.id, package.name, org_id, pub_id
 
     def get_package_ref(self, url):
         package_ref = None
-        package_match = Identifier.package_re.match(url)
+        package_match = self.package_re.match(url)
         if package_match:
             index = url.find('/catalogo/')
             if index > -1:
@@ -399,20 +768,9 @@ class Identifier:
 
         package_ref = self.get_package_ref(url)
         if package_ref:
-            package = model.Package.get(package_ref)
-            if package:
-                org = None
-                pub = None
-                if hasattr(package, 'owner_org'):
-                    org = model.Group.get(package.owner_org)
-                if package.extras:
-                    pub_id = package.extras.get('publisher', None)
-                    if pub_id and org and pub_id == org.id:
-                        pub = org
-                    else:
-                        pub = model.Group.get(pub_id)
-                return package.name, (org.id if org else None), \
-                       (pub.id if pub else None)
+            attribution = self._get_package_attribution(package_ref)
+            if attribution:
+                return attribution[1:]
             else:
                 return None, None, None
         return None, None, None
@@ -421,69 +779,301 @@ class Identifier:
         package_ref = self.get_package_ref(package_url)
 
         if package_ref:
-            package = model.Package.get(package_ref)
-            if package:
-                org = None
-                pub = None
-                if hasattr(package, 'owner_org'):
-                    org = model.Group.get(package.owner_org)
-                if package.extras:
-                    pub_id = package.extras.get('publisher', None)
-                    if pub_id and org and pub_id == org.id:
-                        pub = org
-                    else:
-                        pub = model.Group.get(pub_id)
-                resources = package.resources
+            attribution = self._get_package_attribution(package_ref)
+            if attribution:
+                package_id, package_name, org_id, pub_id = attribution
+                if is_resource_url_index_built(self.session):
+                    indexed = self.session.query(DgeGaResourceUrlIndex).\
+                        filter(DgeGaResourceUrlIndex.package_id==package_id).\
+                        filter(DgeGaResourceUrlIndex.url_hash.in_(
+                            [get_url_hash(url) for url in get_resource_url_variants(resource_url)])).\
+                        first()
+                    if indexed:
+                        return indexed.resource_id, package_name, org_id, pub_id, \
+                               indexed.format
+                    return None, package_name, org_id, pub_id, None
+                package = self._get_package(package_id or package_ref)
+                resources = package.resources if package else None
                 if resources:
-                    resource_urls = [resource_url]
-                    res_url = None
-                    try:
-                        res_url = urllib.parse.unquote_plus(resource_url)
-                        resource_urls.append(res_url)
-                    except:
-                        pass
-                    try:
-                        resource_urls.append(resource_url.encode('latin-1').decode('utf-8'))
-                    except:
-                        pass
-                    try:
-                        if res_url:
-                            resource_urls.append(res_url.encode('latin-1').decode('utf-8'))
-                    except:
-                        pass
-                    
-                    if resource_url.endswith('/'):
-                        res_url_1 = resource_url[:-1]
-                        resource_urls.append(res_url_1)
-                        res_url_2 = None
-                        try:
-                            res_url_2 = urllib.parse.unquote_plus(res_url_1)
-                            resource_urls.append(res_url_2)
-                        except:
-                            pass
-                        try:
-                            resource_urls.append(res_url_1.encode('latin-1').decode('utf-8'))
-                        except:
-                            pass
-                        try:
-                            resource_urls.append(res_url_2.encode('latin-1').decode('utf-8'))
-                        except:
-                            pass
+                    resource_urls = get_resource_url_variants(resource_url)
 
                     for resource in resources:
-                        for resource in resources:
-                            if resource.url in resource_urls:
-                                return resource.id, package.name, \
-                                       (org.id if org else None), \
-                                       (pub.id if pub else None), \
-                                       resource.format
-                        # print 'No resource found'
-                    return None, package.name, (org.id if org else None), \
-                           (pub.id if pub else None), None
+                        if resource.url in resource_urls:
+                            return resource.id, package_name, org_id, pub_id, \
+                                   resource.format
+                    # print 'No resource found'
+                    return None, package_name, org_id, pub_id, None
                 else:
                     # print 'No package found'
                     return None, None, None, None, None
-            return None, None, None, None, None
+        return None, None, None, None, None
+
+def _get_group(session, reference):
+    if not reference:
+        return None
+    group = session.query(model.Group).get(reference)
+    if group is None:
+        group = session.query(model.Group).filter_by(name=reference).first()
+    return group
+
+def get_package_organization_and_publisher(package, session=None):
+    '''Returns the organization id and the publisher id of a package. The
+    publisher is the group in the publisher extra.'''
+    session = session or model.Session
+    org = None
+    pub = None
+    if hasattr(package, 'owner_org'):
+        org = _get_group(session, package.owner_org)
+    if package.extras:
+        pub_id = package.extras.get('publisher', None)
+        if pub_id and org and pub_id == org.id:
+            pub = org
+        else:
+            pub = _get_group(session, pub_id)
+    return (org.id if org else None), (pub.id if pub else None)
+
+def get_resource_url_variants(resource_url):
+    '''Returns the urls a GA event label may stand for: the label, unquoted,
+    recoded from latin-1 and without the trailing slash'''
+    resource_urls = [resource_url]
+    res_url = None
+    try:
+        res_url = urllib.parse.unquote_plus(resource_url)
+        resource_urls.append(res_url)
+    except:
+        pass
+    try:
+        resource_urls.append(resource_url.encode('latin-1').decode('utf-8'))
+    except:
+        pass
+    try:
+        if res_url:
+            resource_urls.append(res_url.encode('latin-1').decode('utf-8'))
+    except:
+        pass
+
+    if resource_url.endswith('/'):
+        res_url_1 = resource_url[:-1]
+        resource_urls.append(res_url_1)
+        res_url_2 = None
+        try:
+            res_url_2 = urllib.parse.unquote_plus(res_url_1)
+            resource_urls.append(res_url_2)
+        except:
+            pass
+        try:
+            resource_urls.append(res_url_1.encode('latin-1').decode('utf-8'))
+        except:
+            pass
+        try:
+            resource_urls.append(res_url_2.encode('latin-1').decode('utf-8'))
+        except:
+            pass
+    return resource_urls
+
+def get_url_hash(url):
+    return hashlib.md5(url.encode('utf-8')).hexdigest()
+
+_filled_tables = {}
+_filled_tables_checked = {}
+
+def _is_table_filled(table, column, session=None):
+    '''Returns True if a lookup table maintained by the plugin has rows,
+    so it can be used. An empty table is checked again after a minute.'''
+    name = table.name
+    if not _filled_tables.get(name) and time.time() - _filled_tables_checked.get(name, 0) > 60:
+        _filled_tables_checked[name] = time.time()
+        try:
+            session = session or model.Session
+            _filled_tables[name] = table.exists(model.meta.engine) and \
+                session.query(column).first() is not None
+        except Exception as e:
+            log.warning('Unable to check the %s table: %s', name, e)
+            _filled_tables[name] = False
+    return bool(_filled_tables.get(name))
+
+def is_resource_url_index_built(session=None):
+    '''Returns True if the resource url index has been built, so it can be
+    used instead of comparing the urls of the resources of the package'''
+    return _is_table_filled(dge_ga_resource_url_index_table,
+                            DgeGaResourceUrlIndex.url_hash, session)
+
+def is_package_attribution_built(session=None):
+    '''Returns True if the package attribution table has been built, so it
+    can be used instead of loading the package and its groups'''
+    return _is_table_filled(dge_ga_package_attribution_table,
+                            DgeGaPackageAttribution.package_name, session)
+
+def index_package_resources(package_id, session=None):
+    '''
+    Replaces the entries of the resource url index of a package with its
+    current resources. The session is not committed.
+    '''
+    session = session or model.Session
+    session.query(DgeGaResourceUrlIndex).\
+        filter(DgeGaResourceUrlIndex.package_id==package_id).\
+        delete(synchronize_session=False)
+    package = session.query(model.Package).get(package_id)
+    if package is None:
+        return 0
+    entries = set()
+    for resource in package.resources:
+        if resource.url:
+            entries.add((get_url_hash(resource.url), resource.id, resource.format))
+    for url_hash, resource_id, res_format in entries:
+        session.add(DgeGaResourceUrlIndex(url_hash=url_hash, resource_id=resource_id,
+                                          package_id=package.id, package_name=package.name,
+                                          format=res_format))
+    return len(entries)
+
+def rebuild_resource_url_index():
+    '''Builds the resource url index of every package'''
+    model.Session.query(DgeGaResourceUrlIndex).delete(synchronize_session=False)
+    package_ids = [result[0] for result in model.Session.query(model.Package.id).all()]
+    count = 0
+    for package_id in package_ids:
+        count += index_package_resources(package_id)
+        model.Session.commit()
+    _filled_tables[DGE_GA_RESOURCE_URL_INDEX_TABLE_NAME] = count > 0
+    log.info('Indexed %d resource urls of %d packages', count, len(package_ids))
+    return count
+
+def get_package_attribution(package_ref, session=None):
+    '''
+    Returns the package id, package name, organization id and publisher id
+    stored in the package attribution table for a package name or id, or
+    None if it is not there.
+    '''
+    session = session or model.Session
+    item = session.query(DgeGaPackageAttribution).\
+        filter(DgeGaPackageAttribution.package_name==package_ref).first()
+    if item is None:
+        item = session.query(DgeGaPackageAttribution).\
+            filter(DgeGaPackageAttribution.package_id==package_ref).\
+            order_by(DgeGaPackageAttribution.modified.desc()).first()
+    if item is None:
+        return None
+    return item.package_id, item.package_name, item.organization_id, item.publisher_id
+
+def update_package_attribution(package_id, session=None):
+    '''
+    Stores the current organization and publisher of a package in the
+    package attribution table. The rows of previous names of the package
+    and the rows of purged packages are kept. The session is not committed.
+    '''
+    session = session or model.Session
+    package = session.query(model.Package).get(package_id)
+    if package is None:
+        session.query(DgeGaPackageAttribution).\
+            filter(DgeGaPackageAttribution.package_id==package_id).\
+            update({'state': 'purged', 'modified': datetime.datetime.now()},
+                   synchronize_session=False)
+        return False
+    org_id, pub_id = get_package_organization_and_publisher(package, session)
+    session.merge(DgeGaPackageAttribution(package_name=package.name, package_id=package.id,
+                                          organization_id=org_id, publisher_id=pub_id,
+                                          state=package.state,
+                                          modified=datetime.datetime.now()))
+    return True
+
+def rebuild_package_attribution():
+    '''
+    Stores the attribution of every package, and the last attribution stored
+    in dge_ga_packages of the package names no longer in the catalog
+    '''
+    package_ids = [result[0] for result in model.Session.query(model.Package.id).all()]
+    count = 0
+    for package_id in package_ids:
+        if update_package_attribution(package_id):
+            count += 1
+        model.Session.commit()
+    query = '''insert into {t0} (package_name, package_id, organization_id, publisher_id, state, modified)
+               select distinct on (p.package_name) p.package_name, null, p.organization_id,
+                      p.publisher_id, 'purged', now()
+               from {t1} p
+               where p.package_name != ''
+               and p.organization_id != '' and p.organization_id is not null
+               and p.publisher_id != '' and p.publisher_id is not null
+               and p.year_month not like 'All'
+               and not exists (select 1 from {t0} a where a.package_name = p.package_name)
+               order by p.package_name, p.year_month desc;'''.format(
+                   t0=DGE_GA_PACKAGE_ATTRIBUTION_TABLE_NAME, t1=DGE_GA_PACKAGE_TABLE_NAME)
+    purged = model.Session.execute(query).rowcount
+    model.Session.commit()
+    _filled_tables[DGE_GA_PACKAGE_ATTRIBUTION_TABLE_NAME] = count + purged > 0
+    log.info('Stored the attribution of %d packages and %d purged packages', count, purged)
+    return count, purged
+
+_attribution_session = None
+_attribution_pool_size = 0
+_attribution_parallel = 1
+_attribution_session_lock = threading.Lock()
+
+def get_attribution_workers():
+    return asint(config.get('ckanext-dge-ga-report.attribution.workers', 1))
+
+def set_attribution_parallel(parallel):
+    '''Sets the number of loads that may resolve attributions at the same
+    time, e.g. the months loaded in parallel, so the connection pool of the
+    attribution workers has a connection for every thread of every load'''
+    global _attribution_parallel
+    with _attribution_session_lock:
+        _attribution_parallel = max(int(parallel or 1), 1)
+
+def _get_attribution_session():
+    '''Returns the scoped session of the attribution workers, bound to an
+    engine with its own connection pool of workers * parallel loads
+    connections'''
+    global _attribution_session, _attribution_pool_size
+    with _attribution_session_lock:
+        pool_size = get_attribution_workers() * _attribution_parallel
+        if _attribution_session is None or _attribution_pool_size < pool_size:
+            # the sessions in use keep the previous engine until removed
+            engine = create_engine(config.get('sqlalchemy.url'), pool_size=pool_size, max_overflow=0)
+            _attribution_session = scoped_session(sessionmaker(bind=engine))
+            _attribution_pool_size = pool_size
+        return _attribution_session
+
+def resolve_attributions(keys, resolve, kind=None):
+    '''
+    Returns a dict with the result of resolve(identifier, key) of every
+    key. If a pool of worker processes has been started with an attribution
+    snapshot, the keys of the kind ('package' or 'resource') are resolved
+    in the worker processes instead. With
+    ckanext-dge-ga-report.attribution.workers greater than 1 the keys are
+    partitioned across threads, each with its own session.
+    '''
+    from . import workers as worker_pool
+
+    if kind is not None and keys and worker_pool.has_snapshot():
+        return worker_pool.resolve_attributions(kind, keys)
+    workers = get_attribution_workers()
+    if workers <= 1 or len(keys) < 2:
+        identifier = Identifier()
+        return dict((key, resolve(identifier, key)) for key in keys)
+
+    def resolve_partition(partition):
+        session = _get_attribution_session()
+        try:
+            identifier = Identifier(session())
+            return dict((key, resolve(identifier, key)) for key in partition)
+        finally:
+            session.remove()
+
+    attributions = {}
+    partitions = [keys[index::workers] for index in range(workers)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for partition_attributions in executor.map(resolve_partition, partitions):
+            attributions.update(partition_attributions)
+    return attributions
+
+def _get_batches(rows, size=1000):
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
 
 def delete(period_name):
     '''
@@ -495,6 +1085,8 @@ def delete(period_name):
         if period_name != 'All':
             q = q.filter_by(period_name=period_name)
         q.delete()
+    for stat in ('dge_ga_package', 'dge_ga_resource'):
+        clear_incremental_load(stat, None if period_name == 'All' else period_name)
     model.repo.commit_and_remove()
 
 def pre_update_dge_ga_package_stats(period_name):
@@ -503,6 +1095,8 @@ def pre_update_dge_ga_package_stats(period_name):
     log.debug("Deleting %d '%s' %s records" % (q.count(), period_name, DGE_GA_PACKAGE_TABLE_NAME))
     print(("Deleting %d '%s' %s records" % (q.count(), period_name, DGE_GA_PACKAGE_TABLE_NAME)))
     q.delete()
+    # the incremental load of the period starts again from the new rows
+    clear_incremental_load('dge_ga_package', period_name)
 
     model.Session.flush()
     model.Session.commit()
@@ -516,6 +1110,8 @@ def pre_update_dge_ga_resource_stats(period_name):
     log.debug("Deleting %d '%s' %s records" % (q.count(), period_name, DGE_GA_RESOURCE_TABLE_NAME))
     print(("Deleting %d '%s' %s records" % (q.count(), period_name, DGE_GA_RESOURCE_TABLE_NAME)))
     q.delete()
+    # the incremental load of the period starts again from the new rows
+    clear_incremental_load('dge_ga_resource', period_name)
 
     model.Session.flush()
     model.Session.commit()
@@ -536,6 +1132,463 @@ def pre_update_dge_ga_visit_stats(period_name):
     log.debug('...done')
     print('...done')
 
+def get_load_watermark(stat):
+    '''Returns the watermark of the last incremental load of the stat'''
+    return model.Session.query(DgeGaLoadWatermark).\
+        filter(DgeGaLoadWatermark.stat==stat).first()
+
+def set_load_watermark(stat, period_name, last_day, commit=True):
+    item = get_load_watermark(stat)
+    if item is None:
+        item = DgeGaLoadWatermark(stat=stat)
+    item.year_month = period_name
+    item.last_day = last_day
+    item.modified = datetime.datetime.now()
+    model.Session.add(item)
+    if commit:
+        model.Session.commit()
+
+def clear_incremental_load(stat, period_name=None):
+    '''
+    Deletes the daily values and the watermark of the incremental load of
+    the stat in the period (or in every period), whose rows are deleted to
+    be loaded again in full. The session is not committed.
+    '''
+    q = model.Session.query(DgeGaDailyStat).\
+        filter(DgeGaDailyStat.stat==stat)
+    watermark = get_load_watermark(stat)
+    if period_name is not None:
+        q = q.filter(DgeGaDailyStat.year_month==period_name)
+        if watermark is not None and watermark.year_month != period_name:
+            watermark = None
+    q.delete(synchronize_session=False)
+    if watermark is not None:
+        log.info('Clearing the incremental load of stat %s in period %s', stat, watermark.year_month)
+        model.Session.delete(watermark)
+
+def get_dge_ga_daily_totals(stat, period_name, package_urls=False):
+    '''
+    Yields the daily values of the stat in the period added up by url, as
+    (url, value) rows, or (url, package_url, value) rows if package_urls.
+    These are the rows of the period loaded incrementally.
+    '''
+    columns = [DgeGaDailyStat.url]
+    if package_urls:
+        columns.append(DgeGaDailyStat.package_url)
+    q = model.Session.query(*(columns + [func.sum(DgeGaDailyStat.value)])).\
+        filter(DgeGaDailyStat.stat==stat).\
+        filter(DgeGaDailyStat.year_month==period_name).\
+        group_by(*columns).\
+        order_by(*columns)
+    for row in q.yield_per(10000):
+        yield tuple(row[:-1]) + (int(row[-1] or 0),)
+
+def delete_dge_ga_daily_stats(stat):
+    q = model.Session.query(DgeGaDailyStat).\
+        filter(DgeGaDailyStat.stat==stat)
+    log.debug("Deleting %d '%s' %s records" % (q.count(), stat, DGE_GA_DAILY_STAT_TABLE_NAME))
+    q.delete(synchronize_session=False)
+    model.Session.commit()
+
+def merge_dge_ga_daily_stats(stat, period_name, since_day, data):
+    '''
+    Given a list of (day, url, package_url, value) since a day, replaces
+    the daily values stored for the stat since that day.
+
+    Returns a list of (url, package_url, difference) with the difference
+    between the new and the replaced values of each url. The session is not
+    committed, so the daily values are committed with the differences
+    stored and the watermark.
+    '''
+    previous_values = collections.defaultdict(int)
+    q = model.Session.query(DgeGaDailyStat).\
+        filter(DgeGaDailyStat.stat==stat).\
+        filter(DgeGaDailyStat.day>=since_day)
+    for item in q.all():
+        previous_values[(item.url, item.package_url)] += int(item.value or 0)
+    q.delete(synchronize_session=False)
+
+    daily_values = collections.defaultdict(int)
+    for day, url, package_url, value in data:
+        daily_values[(day, url, package_url or '')] += int(value or 0)
+
+    new_values = collections.defaultdict(int)
+    for (day, url, package_url), value in daily_values.items():
+        model.Session.add(DgeGaDailyStat(stat=stat, year_month=period_name, day=day,
+                                         url=url, package_url=package_url, value=value))
+        new_values[(url, package_url)] += value
+    model.Session.flush()
+
+    differences = []
+    for key in set(previous_values) | set(new_values):
+        difference = new_values.get(key, 0) - previous_values.get(key, 0)
+        if difference:
+            differences.append((key[0], key[1], difference))
+    log.debug('%d urls changed in %s since %s', len(differences), stat, since_day)
+    return differences
+
+def update_end_day(object_type, period_name, period_complete_day, commit=True):
+    model.Session.query(object_type).\
+        filter(object_type.year_month==period_name).\
+        update({'end_day': period_complete_day}, synchronize_session=False)
+    if commit:
+        model.Session.commit()
+
+def get_load_checkpoint(period_name, stat, section=''):
+    '''Returns the values of a checkpoint as a dict, or None'''
+    item = model.Session.query(DgeGaLoadCheckpoint).\
+        filter(DgeGaLoadCheckpoint.year_month==period_name).\
+        filter(DgeGaLoadCheckpoint.stat==stat).\
+        filter(DgeGaLoadCheckpoint.section==section).first()
+    if item is None:
+        return None
+    return {'status': item.status,
+            'end_date': item.end_date,
+            'pages_fetched': item.pages_fetched,
+            'rows_stored': item.rows_stored}
+
+def reset_load_checkpoint(period_name, stat, section='', status='downloading', end_date=''):
+    model.Session.query(DgeGaLoadCheckpoint).\
+        filter(DgeGaLoadCheckpoint.year_month==period_name).\
+        filter(DgeGaLoadCheckpoint.stat==stat).\
+        filter(DgeGaLoadCheckpoint.section==section).\
+        delete(synchronize_session=False)
+    model.Session.add(DgeGaLoadCheckpoint(year_month=period_name, stat=stat, section=section,
+                                          end_date=end_date, status=status, pages_fetched=0,
+                                          rows_stored=0, modified=datetime.datetime.now()))
+    model.Session.commit()
+
+def update_load_checkpoint(period_name, stat, section='', commit=True, **values):
+    '''
+    Updates the checkpoint values. If commit is False, the update is
+    committed with the next commit of the session, e.g. with the stored row.
+    '''
+    values['modified'] = datetime.datetime.now()
+    model.Session.execute(dge_ga_load_checkpoint_table.update().
+                          where(dge_ga_load_checkpoint_table.c.year_month==period_name).
+                          where(dge_ga_load_checkpoint_table.c.stat==stat).
+                          where(dge_ga_load_checkpoint_table.c.section==section).
+                          values(**values))
+    if commit:
+        model.Session.commit()
+
+def get_period_total(period_name, stat):
+    '''Returns the total of the stat recorded on the last load of the period'''
+    item = model.Session.query(DgeGaPeriodTotal).\
+        filter(DgeGaPeriodTotal.year_month==period_name).\
+        filter(DgeGaPeriodTotal.stat==stat).first()
+    return item.total if item is not None else None
+
+def set_period_total(period_name, stat, total):
+    item = model.Session.query(DgeGaPeriodTotal).\
+        filter(DgeGaPeriodTotal.year_month==period_name).\
+        filter(DgeGaPeriodTotal.stat==stat).first()
+    if item is None:
+        item = DgeGaPeriodTotal(year_month=period_name, stat=stat)
+    item.total = total
+    item.modified = datetime.datetime.now()
+    model.Session.add(item)
+    model.Session.commit()
+
+ROLLUP_PUBLISHER = 4
+ROLLUP_ORGANIZATION = 2
+ROLLUP_FORMAT = 1
+ROLLUP_COLUMNS = (('publisher_id', ROLLUP_PUBLISHER),
+                  ('organization_id', ROLLUP_ORGANIZATION),
+                  ('format', ROLLUP_FORMAT))
+
+# The months of the fact tables are added up with one GROUP BY CUBE, which
+# gives the rows of every combination of publisher, organization and format.
+# Packages have no format, so it is always added up over.
+ROLLUP_QUERIES = {
+    'dge_ga_package': '''
+        select year_month, grouping(publisher_id, organization_id) * 2 + 1,
+               coalesce(publisher_id, ''), coalesce(organization_id, ''), '', sum(value)
+        from (select year_month, coalesce(publisher_id, '') as publisher_id,
+                     coalesce(organization_id, '') as organization_id, pageviews as value
+              from {t0} where year_month = :period_name) facts
+        group by year_month, cube(publisher_id, organization_id)''',
+    'dge_ga_resource': '''
+        select year_month, grouping(publisher_id, organization_id, format),
+               coalesce(publisher_id, ''), coalesce(organization_id, ''), coalesce(format, ''), sum(value)
+        from (select year_month, coalesce(publisher_id, '') as publisher_id,
+                     coalesce(organization_id, '') as organization_id,
+                     coalesce(format, '') as format, total_events as value
+              from {t1} where year_month = :period_name) facts
+        group by year_month, cube(publisher_id, organization_id, format)''',
+}
+
+def refresh_dge_ga_rollups(period_name, stat):
+    '''
+    Replaces the rollups of the stat (dge_ga_package or dge_ga_resource) in
+    the period with the totals of the rows stored in the period.
+    '''
+    if stat not in ROLLUP_QUERIES or period_name == 'All':
+        return 0
+    model.Session.query(DgeGaRollup).\
+        filter(DgeGaRollup.year_month==period_name).\
+        filter(DgeGaRollup.stat==stat).\
+        delete(synchronize_session=False)
+    query = '''insert into {t2} (year_month, grouping_id, publisher_id, organization_id, format,
+                                 value, stat, modified)
+               select *, :stat, now() from ({select}) rollups'''.format(
+                   t2=DGE_GA_ROLLUP_TABLE_NAME,
+                   select=ROLLUP_QUERIES[stat].format(t0=DGE_GA_PACKAGE_TABLE_NAME,
+                                                      t1=DGE_GA_RESOURCE_TABLE_NAME))
+    count = model.Session.execute(query, {'period_name': period_name, 'stat': stat}).rowcount
+    model.Session.commit()
+    log.debug('Stored %d %s rollups of %s', count, stat, period_name)
+    return count
+
+# monthly values of the stats by key, for the cumulative table
+CUMULATIVE_QUERIES = {
+    'dge_ga_package': '''select package_name as key, year_month, sum(pageviews) as value
+                         from {t0} where package_name != '' and year_month != 'All'
+                         and ({where}) group by package_name, year_month''',
+    'dge_ga_resource': '''select resource_id as key, year_month, sum(total_events) as value
+                          from {t1} where resource_id != '' and year_month != 'All'
+                          and ({where}) group by resource_id, year_month''',
+}
+
+def _get_cumulative_query(stat, where):
+    return CUMULATIVE_QUERIES[stat].format(t0=DGE_GA_PACKAGE_TABLE_NAME,
+                                           t1=DGE_GA_RESOURCE_TABLE_NAME, where=where)
+
+def _lock_dge_ga_cumulative():
+    '''Serializes the changes of the cumulative table until the end of the
+    transaction, as a month changes the running totals of later months'''
+    model.Session.execute("select pg_advisory_xact_lock(hashtext('%s'))" % DGE_GA_CUMULATIVE_TABLE_NAME)
+
+def refresh_dge_ga_cumulative(period_name, stat):
+    '''
+    Updates the cumulative table with the values of the stat stored in the
+    period: the difference with the previous values of the period is added
+    to the running totals of the later months, and the rows of the period
+    are replaced.
+    '''
+    if stat not in CUMULATIVE_QUERIES or period_name == 'All':
+        return 0
+    _lock_dge_ga_cumulative()
+    params = {'period_name': period_name, 'stat': stat}
+    new_values = _get_cumulative_query(stat, 'year_month = :period_name')
+    query = '''with new_values as ({new_values}),
+               differences as (
+                   select coalesce(n.key, o.key) as key,
+                          coalesce(n.value, 0) - coalesce(o.value, 0) as difference
+                   from new_values n
+                   full join (select key, value from {t2}
+                              where stat = :stat and year_month = :period_name) o on o.key = n.key)
+               update {t2} c set cumulative = c.cumulative + d.difference
+               from differences d
+               where c.stat = :stat and c.key = d.key and c.year_month > :period_name
+               and d.difference != 0'''.format(new_values=new_values, t2=DGE_GA_CUMULATIVE_TABLE_NAME)
+    updated = model.Session.execute(query, params).rowcount
+    model.Session.query(DgeGaCumulative).\
+        filter(DgeGaCumulative.stat==stat).\
+        filter(DgeGaCumulative.year_month==period_name).\
+        delete(synchronize_session=False)
+    query = '''insert into {t2} (stat, key, year_month, value, cumulative)
+               select :stat, n.key, n.year_month, n.value,
+                      n.value + coalesce((select p.cumulative from {t2} p
+                                          where p.stat = :stat and p.key = n.key
+                                          and p.year_month < :period_name
+                                          order by p.year_month desc limit 1), 0)
+               from ({new_values}) n'''.format(new_values=new_values, t2=DGE_GA_CUMULATIVE_TABLE_NAME)
+    count = model.Session.execute(query, params).rowcount
+    model.Session.commit()
+    log.debug('Stored %d %s cumulative values of %s, updated %d of later months',
+              count, stat, period_name, updated)
+    return count
+
+def rebuild_dge_ga_cumulative(stat):
+    '''Computes again the whole cumulative table of the stat with a window
+    function over the monthly values'''
+    if stat not in CUMULATIVE_QUERIES:
+        return 0
+    _lock_dge_ga_cumulative()
+    model.Session.query(DgeGaCumulative).\
+        filter(DgeGaCumulative.stat==stat).\
+        delete(synchronize_session=False)
+    query = '''insert into {t2} (stat, key, year_month, value, cumulative)
+               select :stat, key, year_month, value,
+                      sum(value) over (partition by key order by year_month)
+               from ({monthly_values}) m'''.format(monthly_values=_get_cumulative_query(stat, 'true'),
+                                                    t2=DGE_GA_CUMULATIVE_TABLE_NAME)
+    count = model.Session.execute(query, {'stat': stat}).rowcount
+    model.Session.commit()
+    log.info('Stored %d %s cumulative values', count, stat)
+    return count
+
+def get_cumulative_value(stat, key, period_name):
+    '''Returns the total of the stat of a package name or resource id up to
+    the end of the period'''
+    item = model.Session.query(DgeGaCumulative.cumulative).\
+        filter(DgeGaCumulative.stat==stat).\
+        filter(DgeGaCumulative.key==key).\
+        filter(DgeGaCumulative.year_month<=period_name).\
+        order_by(DgeGaCumulative.year_month.desc()).first()
+    return int(item[0]) if item else 0
+
+def get_range_value(stat, key, first_period_name, last_period_name):
+    '''Returns the total of the stat of a package name or resource id from
+    the first to the last period, both included'''
+    item = model.Session.query(DgeGaCumulative.cumulative).\
+        filter(DgeGaCumulative.stat==stat).\
+        filter(DgeGaCumulative.key==key).\
+        filter(DgeGaCumulative.year_month<first_period_name).\
+        order_by(DgeGaCumulative.year_month.desc()).first()
+    return get_cumulative_value(stat, key, last_period_name) - (int(item[0]) if item else 0)
+
+def get_top_packages_size():
+    '''Returns the number of packages kept in each ranking. It is larger
+    than the rankings shown, as packages may become private later.'''
+    return asint(config.get('ckanext-dge-ga-report.top_packages.size', 20))
+
+def refresh_dge_ga_top_packages(period_name):
+    '''
+    Replaces the rankings of the most viewed public packages of the period
+    (a month or 'All'), of every package and of the packages of each
+    publisher.
+    '''
+    model.Session.query(DgeGaTopPackage).\
+        filter(DgeGaTopPackage.year_month==period_name).\
+        delete(synchronize_session=False)
+    query = '''insert into {t3} (year_month, scope, rank, end_day, package_name, publisher_id, pageviews)
+               select year_month, scope, rn, end_day, package_name, publisher_id, pageviews
+               from (select s1.year_month, s1.end_day, s1.package_name, s1.publisher_id, s1.pageviews,
+                            '' as scope,
+                            row_number() over (order by s1.pageviews desc) as rn
+                     from {t0} s1
+                     inner join "group" g on g.id = s1.publisher_id
+                     inner join package p on p.name = s1.package_name
+                     where s1.year_month = :period_name and p.private is false
+                     union all
+                     select s1.year_month, s1.end_day, s1.package_name, s1.publisher_id, s1.pageviews,
+                            s1.publisher_id as scope,
+                            row_number() over (partition by s1.publisher_id order by s1.pageviews desc) as rn
+                     from {t0} s1
+                     inner join "group" g on g.id = s1.publisher_id
+                     inner join package p on p.name = s1.package_name
+                     where s1.year_month = :period_name and p.private is false) ranked
+               where rn <= :size'''.format(t0=DGE_GA_PACKAGE_TABLE_NAME, t3=DGE_GA_TOP_PACKAGE_TABLE_NAME)
+    count = model.Session.execute(query, {'period_name': period_name,
+                                          'size': get_top_packages_size()}).rowcount
+    model.Session.commit()
+    log.debug('Stored %d top packages of %s', count, period_name)
+    return count
+
+def get_stored_periods():
+    '''Returns the months stored in dge_ga_packages or dge_ga_resources'''
+    periods = set()
+    for object_type in (DgeGaPackage, DgeGaResource):
+        periods.update(result[0] for result in
+                       model.Session.query(object_type.year_month).distinct().all())
+    periods.discard('All')
+    return sorted(periods)
+
+# views of the 'All' and the latest month rows and downloads of the 'All'
+# rows of every package
+# views_last_month are the views of the last complete month, not of the
+# current month, which is only loaded up to today
+INDEX_COUNTS_QUERY = '''
+    select package_name, sum(views_total), sum(views_last_month), sum(downloads_total)
+    from (select package_name, pageviews as views_total, 0 as views_last_month, 0 as downloads_total
+          from {t0}
+          where year_month = 'All' and package_name != ''
+          union all
+          select package_name, 0, pageviews, 0
+          from {t0}
+          where year_month = (select max(year_month) from {t0}
+                              where year_month != 'All' and year_month < to_char(current_date, 'YYYY-MM'))
+          and package_name != ''
+          union all
+          select package_name, 0, 0, total_events
+          from {t1}
+          where year_month = 'All' and package_name != '' and package_name is not null) counts
+    group by package_name'''
+
+_index_counts = None
+_index_counts_loaded = 0
+_index_counts_lock = threading.Lock()
+
+def get_index_counts_ttl():
+    return asint(config.get('ckanext-dge-ga-report.index_counts.ttl', 300))
+
+def load_index_counts(session=None):
+    '''Returns the total views, views of the last complete month and total
+    downloads of every package by package name'''
+    session = session or model.Session
+    query = INDEX_COUNTS_QUERY.format(t0=DGE_GA_PACKAGE_TABLE_NAME, t1=DGE_GA_RESOURCE_TABLE_NAME)
+    return dict((package_name, (int(views_total or 0), int(views_last_month or 0), int(downloads_total or 0)))
+                for package_name, views_total, views_last_month, downloads_total
+                in session.execute(query).fetchall())
+
+def get_index_counts(package_name):
+    '''
+    Returns the total views, views of the latest month and total downloads
+    of a package, for the search index. The counts of every package are
+    loaded at once and kept for ckanext-dge-ga-report.index_counts.ttl
+    seconds, so a bulk reindex runs a single query.
+    '''
+    global _index_counts, _index_counts_loaded
+    with _index_counts_lock:
+        if _index_counts is None or time.time() - _index_counts_loaded > get_index_counts_ttl():
+            _index_counts = load_index_counts()
+            _index_counts_loaded = time.time()
+        return _index_counts.get(package_name, (0, 0, 0))
+
+def clear_index_counts():
+    global _index_counts
+    with _index_counts_lock:
+        _index_counts = None
+
+def get_changed_index_counts(session=None):
+    '''
+    Returns the counts of the packages whose counts are different from the
+    ones last pushed to the search index, by package name. Packages no
+    longer in the stats have their counts set to 0.
+    '''
+    session = session or model.Session
+    counts = load_index_counts(session)
+    changed = {}
+    indexed = set()
+    for item in session.query(DgeGaIndexedCounts).yield_per(1000):
+        indexed.add(item.package_name)
+        current = counts.get(item.package_name, (0, 0, 0))
+        if current != (item.views_total, item.views_last_month, item.downloads_total):
+            changed[item.package_name] = current
+    for package_name, current in counts.items():
+        if package_name not in indexed and current != (0, 0, 0):
+            changed[package_name] = current
+    return changed
+
+def store_indexed_counts(counts, session=None):
+    '''Records the counts pushed to the search index. The session is not
+    committed.'''
+    session = session or model.Session
+    modified = datetime.datetime.now()
+    for package_name, (views_total, views_last_month, downloads_total) in counts.items():
+        session.merge(DgeGaIndexedCounts(package_name=package_name, views_total=views_total,
+                                         views_last_month=views_last_month,
+                                         downloads_total=downloads_total, modified=modified))
+
+def get_dge_ga_rollups(stat, columns=(), period_name=None):
+    '''
+    Returns the rollups of the stat by month and by the given columns
+    (publisher_id, organization_id and format), as tuples of the month,
+    the values of the columns and the total.
+    '''
+    grouping_id = sum(bit for column, bit in ROLLUP_COLUMNS if column not in columns)
+    q = model.Session.query(*([DgeGaRollup.year_month] +
+                              [getattr(DgeGaRollup, column) for column, _ in ROLLUP_COLUMNS
+                               if column in columns] +
+                              [DgeGaRollup.value])).\
+        filter(DgeGaRollup.stat==stat).\
+        filter(DgeGaRollup.grouping_id==grouping_id)
+    if period_name:
+        q = q.filter(DgeGaRollup.year_month==period_name)
+    return [tuple(result) for result in q.order_by(DgeGaRollup.year_month).all()]
+
 def _get_previous_dge_ga_package_stats(url):
     pack_name = None
     org_id = None
@@ -625,46 +1678,97 @@ def _get_previous_dge_ga_resource_stats(resource_url, package_url):
 
     return res_id, pack_name, org_id, pub_id, res_format
 
+class _BoundedDict(collections.OrderedDict):
+    '''Dict that drops its least recently added keys beyond max_size'''
+
+    def __init__(self, max_size):
+        collections.OrderedDict.__init__(self)
+        self.max_size = max_size
+
+    def __setitem__(self, key, value):
+        collections.OrderedDict.__setitem__(self, key, value)
+        if len(self) > self.max_size:
+            self.popitem(last=False)
+
+def _get_urls_in_period(query, object_type, period_name):
+    '''
+    Returns the set of urls already stored in the period, or None if they
+    exceed the row budget and have to be looked up one by one.
+    '''
+    query = query.filter(object_type.year_month==period_name)
+    if query.count() > get_row_budget():
+        return None
+    return set(tuple(result) if len(result) > 1 else result[0] for result in query.all())
+
+def _get_attributed_rows(rows, rows_stored, keys_in_period, get_key, resolve, kind=None):
+    '''
+    Yields the rows with the attribution of their key appended. The rows
+    are read in batches, and the attributions of the keys of each batch not
+    stored yet in the period are resolved together by resolve_attributions.
+    '''
+    count = 0
+    for batch in _get_batches(rows):
+        keys = set()
+        for row in batch:
+            count += 1
+            key = get_key(row)
+            if count > rows_stored and (keys_in_period is None or key not in keys_in_period):
+                keys.add(key)
+        attributions = resolve_attributions(list(keys), resolve, kind)
+        for row in batch:
+            yield tuple(row) + (attributions.get(get_key(row)),)
+
 def update_dge_ga_package_stats(period_name, period_complete_day, url_data,
-                     print_progress=False):
+                     print_progress=False, checkpoint=None, total=None, commit=True):
     '''
     Given a list of urls and number of hits for each during a given period,
-    stores them in DgeGaPackage under the period.
+    stores them in DgeGaPackage under the period. url_data may be any
+    iterable if its total number of rows is given.
+
+    If a checkpoint is given, the rows already stored are skipped and the
+    number of stored rows is committed with every row. If commit is False,
+    the rows are left in the session for the caller to commit.
     '''
     print("Updating dge_ga_package...")
-    progress_total = len(url_data)
+    progress_total = total if total is not None else len(url_data)
     progress_count = 0
     if print_progress:
         progress_bar = GaProgressBar(progress_total)
-    urls_in_dge_ga_package_this_period = set(
-        result[0] for result in model.Session.query(DgeGaPackage.url)
-                                     .filter(DgeGaPackage.year_month==period_name)
-                                     .all())
-    processed_urls = []
+    urls_in_dge_ga_package_this_period = _get_urls_in_period(
+        model.Session.query(DgeGaPackage.url), DgeGaPackage, period_name)
     #dict with key:<url> and value: (<package_name>, <org_id>, <pub_id>)
-    processed_urls_dict = {} 
-
-    identifier = Identifier()
-    for url, views in url_data:
+    processed_urls_dict = _BoundedDict(get_row_budget())
+    # the package attribution table already has the last attribution of purged packages
+    check_previous_stats = not is_package_attribution_built()
+
+    rows_stored = checkpoint.rows_stored if checkpoint else 0
+    for url, views, attribution in _get_attributed_rows(url_data, rows_stored,
+                                                        urls_in_dge_ga_package_this_period,
+                                                        lambda row: row[0],
+                                                        lambda identifier, url: identifier.get_package_information(url),
+                                                        'package'):
         progress_count += 1
         if print_progress:
             progress_bar.update(progress_count)
+        if progress_count <= rows_stored:
+            continue
 
-        if url in urls_in_dge_ga_package_this_period:
+        item = None
+        if urls_in_dge_ga_package_this_period is None or url in urls_in_dge_ga_package_this_period:
             item = model.Session.query(DgeGaPackage).\
                 filter(DgeGaPackage.year_month==period_name).\
                 filter(DgeGaPackage.url==url).first()
+        if item is not None:
             item.pageviews = int(item.pageviews or 0) + int(views or 0)
             model.Session.add(item)
         else:
-            pack_name, org_id, pub_id = identifier.get_package_information(url)
+            pack_name, org_id, pub_id = attribution
 
             #Only if package not found, possible purged dataset, check previous stats
-            if pack_name is None:
+            if pack_name is None and check_previous_stats:
                 #get persisted data from other periods
-                if url not in processed_urls:
+                if url not in processed_urls_dict:
                     pack_name, org_id, pub_id = _get_previous_dge_ga_package_stats(url)
-                    processed_urls.append(url)
                     processed_urls_dict[url] = (pack_name, org_id, pub_id)
                 else:
                     url_dict = processed_urls_dict.get(url, None)
@@ -685,98 +1789,121 @@ def update_dge_ga_package_stats(period_name, period_complete_day, url_data,
                       'publisher_id': pub_id
                       }
             model.Session.add(DgeGaPackage(**values))
-            urls_in_dge_ga_package_this_period.add(url)
-        model.Session.commit()
+            if urls_in_dge_ga_package_this_period is not None:
+                urls_in_dge_ga_package_this_period.add(url)
+        if checkpoint:
+            checkpoint.set_rows_stored(progress_count, commit=False)
+        if commit:
+            model.Session.commit()
     print("...Updated dge_ga_package")
 
 def update_dge_ga_resource_stats(period_name, period_complete_day, url_data,
-                     print_progress=False):
+                     print_progress=False, checkpoint=None, total=None, commit=True):
     '''
     Given a list of urls and number of hits for each during a given period,
-    stores them in DgeGaResource under the period.
+    stores them in DgeGaResource under the period. url_data may be any
+    iterable if its total number of rows is given.
+
+    If a checkpoint is given, the rows already stored are skipped and the
+    number of stored rows is committed with every row. If commit is False,
+    the rows are left in the session for the caller to commit.
     '''
     print("Updating dge_ga_resource...")
-    progress_total = len(url_data)
+    progress_total = total if total is not None else len(url_data)
     progress_count = 0
     if print_progress:
         progress_bar = GaProgressBar(progress_total)
-    urls_in_dge_ga_resource_this_period = set(
-        (result[0], result[1]) for result in model.Session.query(DgeGaResource.url, DgeGaResource.package_url)
-                                     .filter(DgeGaResource.year_month==period_name)
-                                     .all())
-    identifier = Identifier()
-    processed_urls = []
+    urls_in_dge_ga_resource_this_period = _get_urls_in_period(
+        model.Session.query(DgeGaResource.url, DgeGaResource.package_url), DgeGaResource, period_name)
     #dict with key:<resource_url-package_url> and value: (<res_id>, <package_name>, <org_id>, <pub_id>)
-    processed_urls_dict = {} 
-    for resource_url, package_url, events in url_data:
+    processed_urls_dict = _BoundedDict(get_row_budget())
+    rows_stored = checkpoint.rows_stored if checkpoint else 0
+    for resource_url, package_url, events, attribution in _get_attributed_rows(
+            url_data, rows_stored, urls_in_dge_ga_resource_this_period,
+            lambda row: (row[0], row[1]),
+            lambda identifier, key: identifier.get_resource_information(*key),
+            'resource'):
         progress_count += 1
         if print_progress:
             progress_bar.update(progress_count)
+        if progress_count <= rows_stored:
+            continue
+
+        item = None
+        if urls_in_dge_ga_resource_this_period is None or \
+           (resource_url, package_url) in urls_in_dge_ga_resource_this_period:
+            item = model.Session.query(DgeGaResource).\
+                             filter(DgeGaResource.year_month==period_name).\
+                             filter(DgeGaResource.url==resource_url).\
+                             filter(DgeGaResource.package_url==package_url).first()
+        if item is not None:
+            item.total_events = int(item.total_events or 0) + int(events or 0)
+            model.Session.add(item)
+        else:
+            res_id, pack_name, org_id, pub_id, res_format = attribution
+
+            # Only if package not found, possible purged dataset, check previous stats
+            if pack_name is None or res_id is None:
+                # get persisted data from other periods
+                url = '%s-%s' % (resource_url, package_url)
+                if url not in processed_urls_dict:
+                    res_id, pack_name, org_id, pub_id, res_format = _get_previous_dge_ga_resource_stats(resource_url,
+                                                                                            package_url)
+                    processed_urls_dict[url] = (res_id, pack_name, org_id, pub_id, res_format)
+                else:
+                    url_dict = processed_urls_dict.get(url, None)
+                    if url_dict:
+                        res_id = url_dict[0]
+                        pack_name = url_dict[1]
+                        org_id = url_dict[2]
+                        pub_id = url_dict[3]
+                        res_format = url_dict[4]
 
-            if (resource_url, package_url) in urls_in_dge_ga_resource_this_period:
-                item = model.Session.query(DgeGaResource).\
-                                 filter(DgeGaResource.year_month==period_name).\
-                                 filter(DgeGaResource.url==resource_url).\
-                                 filter(DgeGaResource.package_url==package_url).first()
-                item.total_events = int(item.total_events or 0) + int(events or 0)
-                model.Session.add(item)
-            else:
-                res_id, pack_name, org_id, pub_id, res_format = identifier.get_resource_information(resource_url,
-                                                                                                    package_url)
-
-                # Only if package not found, possible purged dataset, check previous stats
-                if pack_name is None or res_id is None:
-                    # get persisted data from other periods
-                    url = '%s-%s' % (resource_url, package_url)
-                    if url not in processed_urls:
-                        res_id, pack_name, org_id, pub_id, res_format = _get_previous_dge_ga_resource_stats(resource_url,
-                                                                                                package_url)
-                        processed_urls.append(url)
-                        processed_urls_dict[url] = (res_id, pack_name, org_id, pub_id, res_format)
-                    else:
-                        url_dict = processed_urls_dict.get(url, None)
-                        if url_dict:
-                            res_id = url_dict[0]
-                            pack_name = url_dict[1]
-                            org_id = url_dict[2]
-                            pub_id = url_dict[3]
-                            res_format = url_dict[4]
-
-                if res_id is None:
-                    res_id = ''
-
-                values = {
-                    'year_month': period_name,
-                    'end_day': period_complete_day,
-                    'url': resource_url,
-                    'package_url': package_url,
-                    'total_events': events,
-                    'resource_id': res_id,
-                    'package_name': pack_name,
-                    'organization_id': org_id,
-                    'publisher_id': pub_id,
-                    'format': res_format
-                }
-                model.Session.add(DgeGaResource(**values))
+            if res_id is None:
+                res_id = ''
+
+            values = {
+                'year_month': period_name,
+                'end_day': period_complete_day,
+                'url': resource_url,
+                'package_url': package_url,
+                'total_events': events,
+                'resource_id': res_id,
+                'package_name': pack_name,
+                'organization_id': org_id,
+                'publisher_id': pub_id,
+                'format': res_format
+            }
+            model.Session.add(DgeGaResource(**values))
+            if urls_in_dge_ga_resource_this_period is not None:
                 urls_in_dge_ga_resource_this_period.add((resource_url, package_url))
+        if checkpoint:
+            checkpoint.set_rows_stored(progress_count, commit=False)
+        if commit:
             model.Session.commit()
     print("... Updated dge_ga_resource")
 
 def update_dge_ga_visit_stats(period_name, period_complete_day, data,
-                     print_progress=False):
+                     print_progress=False, checkpoint=None):
     '''
     Given a list of sections and number of sessions for each during a given period,
     stores them in DgeGaVisit under the period.
+
+    If a checkpoint is given, the rows already stored are skipped and the
+    number of stored rows is committed with every row.
     '''
     print("Updating dge_ga_visits...")
     progress_total = len(data)
     progress_count = 0
     if print_progress:
         progress_bar = GaProgressBar(progress_total)
+    rows_stored = checkpoint.rows_stored if checkpoint else 0
     for key, key_value, sessions in data:
         progress_count += 1
         if print_progress:
             progress_bar.update(progress_count)
+        if progress_count <= rows_stored:
+            continue
         values = {
                   'year_month': period_name,
                   'end_day': period_complete_day,
@@ -785,6 +1912,8 @@ def update_dge_ga_visit_stats(period_name, period_complete_day, data,
                   'key_value': key_value
                  }
         model.Session.add(DgeGaVisit(**values))
+        if checkpoint:
+            checkpoint.set_rows_stored(progress_count, commit=False)
         model.Session.commit()
     print("... Updated dge_ga_visits")
 
@@ -866,6 +1995,8 @@ def post_update_dge_ga_package_stats():
             model.Session.add(DgeGaPackage(**values))
             model.Session.commit()
 
+    refresh_dge_ga_top_packages('All')
+
     log.debug('... Created dge_ga_package "All" records')
     print('... Created dge_ga_package "All" records')
 
@@ -15,6 +15,18 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import json
+import stat
+import time
+import heapq
+import logging
+import tempfile
+
+from ckan.plugins.toolkit import (config, asint)
+
+log = logging.getLogger(__name__)
+
 try:
     # optional fancy progress bar you can install
     from progressbar import ProgressBar, Percentage, Bar, ETA
@@ -36,4 +48,190 @@ except ImportError:
 
         def update(self, count):
             if count % 100 == 0:
-                print('.. %d/%d done so far' % (count, self.total))
\ No newline at end of file
+                print('.. %d/%d done so far' % (count, self.total))
+
+class JsonFileCache(object):
+    '''
+    Small cache of JSON values with expiry, kept in a file of the
+    ckanext-dge-ga-report.cache_dir directory so it is shared by the
+    processes of the commands. The cache holds access tokens, so it is not
+    used unless the directory is private to the current user, and its
+    files are only readable by the user.
+    '''
+
+    def __init__(self, name, ttl):
+        self.ttl = ttl
+        self.path = os.path.join(get_cache_dir(), '%s.json' % name)
+
+    def _read(self):
+        if not check_private_dir(os.path.dirname(self.path)):
+            return {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as cache_file:
+                return json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def get(self, key):
+        entry = self._read().get(key)
+        if entry and entry.get('expires', 0) > time.time():
+            return entry.get('value')
+        return None
+
+    def set(self, key, value, ttl=None):
+        entries = dict((k, v) for k, v in self._read().items()
+                       if v.get('expires', 0) > time.time())
+        entries[key] = {'value': value, 'expires': time.time() + (self.ttl if ttl is None else ttl)}
+        if not check_private_dir(os.path.dirname(self.path)):
+            return
+        try:
+            # write to a temporary file and rename, so concurrent readers
+            # never see a partial file
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path))
+            os.fchmod(fd, 0o600)
+            with os.fdopen(fd, 'w', encoding='utf-8') as cache_file:
+                json.dump(entries, cache_file)
+            os.replace(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            log.warning('Could not write cache file %s: %s', self.path, e)
+
+
+def get_cache_dir():
+    return config.get('ckanext-dge-ga-report.cache_dir',
+                      os.path.join(tempfile.gettempdir(), 'dge_ga_report_cache'))
+
+
+_private_dirs = set()
+
+
+def check_private_dir(path):
+    '''
+    Creates the directory with mode 0700 if it does not exist. Returns True
+    if it is a directory (not a link) owned by the current user that other
+    users can not access, so files with secrets can be kept in it. The
+    permissions of a directory of the user are restricted if needed.
+    '''
+    if path in _private_dirs:
+        return True
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        info = os.lstat(path)
+        if not stat.S_ISDIR(info.st_mode):
+            log.warning('%s is not a directory, it is not used', path)
+            return False
+        if hasattr(os, 'getuid') and info.st_uid != os.getuid():
+            log.warning('%s is not owned by the current user, it is not used', path)
+            return False
+        if stat.S_IMODE(info.st_mode) & 0o077:
+            os.chmod(path, 0o700)
+    except (IOError, OSError) as e:
+        log.warning('Could not use %s: %s', path, e)
+        return False
+    _private_dirs.add(path)
+    return True
+
+
+def get_row_budget():
+    return asint(config.get('ckanext-dge-ga-report.memory.row_budget', 200000))
+
+
+def get_spill_dir():
+    return config.get('ckanext-dge-ga-report.memory.spill_dir', None)
+
+
+def _get_number(value):
+    if isinstance(value, (int, float)):
+        return value
+    if not value:
+        return 0
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+class SpillingAggregator(object):
+    '''
+    Adds up values by key keeping at most max_keys keys in memory. When
+    they are exceeded, the partial totals are written sorted by key to a
+    temporary file, and the files are merged when the totals are read. The
+    totals can be read several times, until the aggregator is closed.
+    '''
+
+    def __init__(self, max_keys=None):
+        self.max_keys = max_keys or get_row_budget()
+        self._totals = {}
+        self._runs = []
+        self._spilled_keys = 0
+
+    def __len__(self):
+        '''Returns the number of keys, or an upper bound if some were spilled'''
+        return len(self._totals) + self._spilled_keys
+
+    def add(self, key, value):
+        self._totals[key] = self._totals.get(key, 0) + value
+        if len(self._totals) > self.max_keys:
+            self._spill()
+
+    def _spill(self):
+        run = tempfile.TemporaryFile(mode='w+', encoding='utf-8', dir=get_spill_dir())
+        for key, value in sorted(self._totals.items()):
+            run.write(json.dumps([list(key), value]) + '\n')
+        log.debug('Spilled %d keys to a temporary file', len(self._totals))
+        self._runs.append(run)
+        self._spilled_keys += len(self._totals)
+        self._totals = {}
+
+    @staticmethod
+    def _read_run(run):
+        run.seek(0)
+        for line in run:
+            key, value = json.loads(line)
+            yield tuple(key), value
+
+    def __iter__(self):
+        '''Yields the (key, total) pairs sorted by key'''
+        runs = [iter(sorted(self._totals.items()))] + [self._read_run(run) for run in self._runs]
+        current_key = None
+        current_value = 0
+        for key, value in heapq.merge(*runs, key=lambda item: item[0]):
+            if current_key is not None and key == current_key:
+                current_value += value
+                continue
+            if current_key is not None:
+                yield current_key, current_value
+            current_key, current_value = key, value
+        if current_key is not None:
+            yield current_key, current_value
+
+    def close(self):
+        for run in self._runs:
+            run.close()
+        self._runs = []
+        self._totals = {}
+        self._spilled_keys = 0
+
+    def __del__(self):
+        if hasattr(self, '_runs'):
+            self.close()
+
+
+class RowTotals(SpillingAggregator):
+    '''
+    Rows of dimensions ending with a metric, added up by their dimensions
+    within the row budget. Iterating yields the rows sorted by dimensions,
+    so the rows of a report can be passed from the download to the store
+    without keeping them all in memory.
+    '''
+
+    def add_row(self, row):
+        self.add(tuple(row[:-1]), _get_number(row[-1]))
+
+    def add_rows(self, rows):
+        for row in rows:
+            self.add(tuple(row[:-1]), _get_number(row[-1]))
+        return self
+
+    def __iter__(self):
+        for key, value in SpillingAggregator.__iter__(self):
+            yield key + (value,)
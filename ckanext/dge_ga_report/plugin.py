@@ -20,7 +20,10 @@ import ckan.lib.helpers as h
 import ckan.plugins as p
 from ckan.plugins import toolkit
 
+import ckan.model as model
+
 import ckanext.dge_ga_report.cli as cli
+import ckanext.dge_ga_report.ga_model as ga_model
 
 log = logging.getLogger('ckanext.dge_ga_report')
 
@@ -31,10 +34,101 @@ class DgeGAReportException(Exception):
 class DgeGaReportPlugin(p.SingletonPlugin):
     p.implements(p.IConfigurer, inherit=True)
     p.implements(p.IClick, inherit=True)
+    p.implements(p.IPackageController, inherit=True)
+    p.implements(p.IResourceController, inherit=True)
 
     def get_commands(self):
         return cli.get_commands()
 
+    # IPackageController and IResourceController (CKAN 2.9 names, shared
+    # by both interfaces)
+
+    def after_create(self, context, data_dict):
+        self._index(data_dict)
+
+    def after_update(self, context, data_dict):
+        self._index(data_dict)
+
+    def after_delete(self, context, data_dict):
+        self._index(data_dict)
+
+    # IPackageController (CKAN 2.10 names)
+
+    def after_dataset_create(self, context, pkg_dict):
+        self._index(pkg_dict)
+
+    def after_dataset_update(self, context, pkg_dict):
+        self._index(pkg_dict)
+
+    def after_dataset_delete(self, context, pkg_dict):
+        self._index(pkg_dict)
+
+    # IResourceController (CKAN 2.10 names)
+
+    def after_resource_create(self, context, resource):
+        self._index(resource)
+
+    def after_resource_update(self, context, resource):
+        self._index(resource)
+
+    def after_resource_delete(self, context, resources):
+        self._index(resources)
+
+    # IPackageController (CKAN 2.9 and 2.10 names)
+
+    def before_index(self, pkg_dict):
+        return self._add_counts(pkg_dict)
+
+    def before_dataset_index(self, pkg_dict):
+        return self._add_counts(pkg_dict)
+
+    def _add_counts(self, pkg_dict):
+        '''Adds the view and download counts of the package to the dict
+        indexed, so search results can be sorted by them. Errors are logged
+        and the package is indexed without them.'''
+        if not toolkit.asbool(toolkit.config.get('ckanext-dge-ga-report.index_counts', True)):
+            return pkg_dict
+        try:
+            # use a savepoint, so an error does not abort the action transaction
+            with model.Session.begin_nested():
+                views_total, views_last_month, downloads_total = \
+                    ga_model.get_index_counts(pkg_dict.get('name'))
+        except Exception as e:
+            log.warning('Unable to get the counts of %s: %s', pkg_dict.get('name'), e)
+            return pkg_dict
+        pkg_dict['ga_views_total'] = views_total
+        pkg_dict['ga_views_last_month'] = views_last_month
+        pkg_dict['ga_downloads_total'] = downloads_total
+        return pkg_dict
+
+    def _index(self, data):
+        '''Updates the resource url index and the package attribution of the
+        package of a dataset, a resource or a list of resources. Errors are
+        logged and do not stop the action.'''
+        package_ids = set()
+        for data_dict in (data if isinstance(data, list) else [data]):
+            if not isinstance(data_dict, dict):
+                continue
+            if data_dict.get('package_id'):
+                package_ids.add(data_dict['package_id'])
+            elif data_dict.get('id'):
+                package_ids.add(data_dict['id'])
+        if not package_ids:
+            return
+        for name, is_built, update in (('resource url index', ga_model.is_resource_url_index_built,
+                                        ga_model.index_package_resources),
+                                       ('package attribution', ga_model.is_package_attribution_built,
+                                        ga_model.update_package_attribution)):
+            if not is_built():
+                continue
+            try:
+                # use a savepoint, so an error does not abort the action transaction
+                with model.Session.begin_nested():
+                    for package_id in package_ids:
+                        update(package_id)
+            except Exception as e:
+                log.warning('Unable to update the %s of %s: %s', name, package_ids, e)
+
     def update_config(self, config):
         toolkit.add_template_directory(config, 'templates')
         toolkit.add_public_directory(config, 'public')
@@ -0,0 +1,141 @@
+# Copyright (C) 2025 Entidad Pública Empresarial Red.es
+#
+# This file is part of "dge-ga-report (datos.gob.es)".
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Popularity score of the packages: the sum of their monthly pageviews and
+resource downloads, each month weighted by an exponential decay of its age
+from the last month stored. Computed with numpy when it is installed.
+'''
+
+import logging
+import datetime
+
+import ckan.model as model
+from ckan.plugins.toolkit import (config, asbool)
+
+from . import ga_model
+
+log = logging.getLogger(__name__)
+
+try:
+    # optional, the scores are computed in pure python without it
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# monthly pageviews and downloads of every package, with the month as a
+# number of months (year * 12 + month) so it is loaded as a number
+MONTHLY_VALUES_QUERY = '''
+    select package_name, month, sum(pageviews), sum(downloads)
+    from (select package_name,
+                 cast(substr(year_month, 1, 4) as integer) * 12 + cast(substr(year_month, 6, 2) as integer) as month,
+                 pageviews, 0 as downloads
+          from {t0}
+          where package_name != '' and year_month != 'All'
+          union all
+          select package_name,
+                 cast(substr(year_month, 1, 4) as integer) * 12 + cast(substr(year_month, 6, 2) as integer) as month,
+                 0 as pageviews, total_events as downloads
+          from {t1}
+          where package_name != '' and package_name is not null and year_month != 'All') monthly
+    group by package_name, month'''
+
+
+def get_half_life():
+    '''Returns the number of months in which a pageview loses half its
+    weight in the score'''
+    return float(config.get('ckanext-dge-ga-report.popularity.half_life', 3))
+
+
+def get_downloads_weight():
+    return float(config.get('ckanext-dge-ga-report.popularity.downloads_weight', 1))
+
+
+def _get_scores_numpy(rows, half_life, downloads_weight):
+    names = numpy.array([row[0] for row in rows], dtype=object)
+    months = numpy.fromiter((row[1] for row in rows), dtype=numpy.int64, count=len(rows))
+    pageviews = numpy.fromiter((row[2] or 0 for row in rows), dtype=numpy.float64, count=len(rows))
+    downloads = numpy.fromiter((row[3] or 0 for row in rows), dtype=numpy.float64, count=len(rows))
+
+    package_names, packages = numpy.unique(names, return_inverse=True)
+    reference_month = months.max()
+    decay = numpy.power(0.5, (reference_month - months) / half_life)
+    pageviews_scores = numpy.bincount(packages, weights=pageviews * decay, minlength=len(package_names))
+    downloads_scores = numpy.bincount(packages, weights=downloads * decay, minlength=len(package_names))
+    scores = pageviews_scores + downloads_weight * downloads_scores
+    return int(reference_month), zip(package_names.tolist(), scores.tolist(),
+                                     pageviews_scores.tolist(), downloads_scores.tolist())
+
+
+def _get_scores(rows, half_life, downloads_weight):
+    reference_month = max(row[1] for row in rows)
+    pageviews_scores = {}
+    downloads_scores = {}
+    for package_name, month, pageviews, downloads in rows:
+        decay = 0.5 ** ((reference_month - month) / half_life)
+        pageviews_scores[package_name] = pageviews_scores.get(package_name, 0.0) + (pageviews or 0) * decay
+        downloads_scores[package_name] = downloads_scores.get(package_name, 0.0) + (downloads or 0) * decay
+    return reference_month, ((package_name, pageviews_scores[package_name] +
+                              downloads_weight * downloads_scores[package_name],
+                              pageviews_scores[package_name], downloads_scores[package_name])
+                             for package_name in pageviews_scores)
+
+
+def refresh_popularity():
+    '''
+    Computes the popularity score of every package from its monthly
+    pageviews and downloads, with an exponential decay from the last month
+    stored, and replaces the dge_ga_popularity table with them.
+    '''
+    if not asbool(config.get('ckanext-dge-ga-report.popularity', True)):
+        return 0
+    init = datetime.datetime.now()
+    query = MONTHLY_VALUES_QUERY.format(t0=ga_model.DGE_GA_PACKAGE_TABLE_NAME,
+                                        t1=ga_model.DGE_GA_RESOURCE_TABLE_NAME)
+    rows = model.Session.execute(query).fetchall()
+    if not rows:
+        return 0
+    half_life = get_half_life()
+    downloads_weight = get_downloads_weight()
+    if numpy is not None:
+        reference_month, scores = _get_scores_numpy(rows, half_life, downloads_weight)
+    else:
+        reference_month, scores = _get_scores(rows, half_life, downloads_weight)
+    year, month = divmod(reference_month - 1, 12)
+    period_name = '%04d-%02d' % (year, month + 1)
+
+    modified = datetime.datetime.now()
+    model.Session.execute(ga_model.dge_ga_popularity_table.delete())
+    count = 0
+    batch = []
+    for package_name, score, pageviews_score, downloads_score in scores:
+        batch.append({'package_name': package_name, 'score': score,
+                      'pageviews_score': pageviews_score, 'downloads_score': downloads_score,
+                      'year_month': period_name, 'modified': modified})
+        if len(batch) >= 10000:
+            model.Session.execute(ga_model.dge_ga_popularity_table.insert(), batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        model.Session.execute(ga_model.dge_ga_popularity_table.insert(), batch)
+        count += len(batch)
+    model.Session.commit()
+    end = datetime.datetime.now()
+    log.info('Stored the popularity of %d packages up to %s in %s milliseconds',
+             count, period_name, (end - init).total_seconds() * 1000)
+    return count
@@ -0,0 +1,108 @@
+# Copyright (C) 2025 Entidad Pública Empresarial Red.es
+#
+# This file is part of "dge-ga-report (datos.gob.es)".
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import pytest
+
+from ckanext.dge_ga_report import attribution_index
+from ckanext.dge_ga_report.attribution_index import (AttributionIndex, write_snapshot,
+                                                     read_fingerprint, _encode_value,
+                                                     _get_package_key, _get_resource_key)
+
+FINGERPRINT = b'f' * 32
+
+
+def _get_entries():
+    entries = {}
+    for package_id, package_name, org_id, pub_id in (('id-a', 'dataset-a', 'org-1', 'pub-1'),
+                                                     ('id-b', 'dataset-b', 'org-2', None),
+                                                     ('id-c', 'dataset-c', None, None)):
+        value = _encode_value(package_id, package_name, org_id, pub_id)
+        entries[_get_package_key(package_name)] = value
+        entries[_get_package_key(package_id)] = value
+    entries[_get_resource_key('id-a', 'http://example.com/a.csv')] = _encode_value('res-1', 'CSV')
+    entries[_get_resource_key('id-b', 'http://example.com/año.json')] = _encode_value('res-2', None)
+    return entries
+
+
+def _write_index(path, entries):
+    path = str(path / 'attribution.idx')
+    assert write_snapshot(path, FINGERPRINT, entries) == len(entries)
+    return path
+
+
+def _check_lookups(index):
+    assert index.get_package('dataset-a') == ('id-a', 'dataset-a', 'org-1', 'pub-1')
+    assert index.get_package('id-a') == ('id-a', 'dataset-a', 'org-1', 'pub-1')
+    assert index.get_package('dataset-b') == ('id-b', 'dataset-b', 'org-2', None)
+    assert index.get_package('id-c') == ('id-c', 'dataset-c', None, None)
+    assert index.get_package('dataset-d') is None
+    assert index.get_resource('id-a', 'http://example.com/a.csv') == ('res-1', 'CSV')
+    assert index.get_resource('id-b', 'http://example.com/año.json') == ('res-2', None)
+    assert index.get_resource('id-b', 'http://example.com/a.csv') is None
+    assert index.get_resource(None, 'http://example.com/a.csv') is None
+
+
+class TestAttributionIndex(object):
+
+    def test_build_and_lookup(self, tmp_path):
+        path = _write_index(tmp_path, _get_entries())
+        index = AttributionIndex(path)
+        try:
+            assert index.fingerprint == FINGERPRINT
+            assert index.entries == len(_get_entries())
+            assert index.slots >= 2 * index.entries
+            _check_lookups(index)
+        finally:
+            index.close()
+        assert read_fingerprint(path) == FINGERPRINT
+
+    def test_lookup_probes_colliding_keys(self, tmp_path, monkeypatch):
+        # every key has the same hash, so all but one are found by probing
+        monkeypatch.setattr(attribution_index, '_hash', lambda key: 5)
+        path = _write_index(tmp_path, _get_entries())
+        index = AttributionIndex(path)
+        try:
+            _check_lookups(index)
+        finally:
+            index.close()
+
+    def test_lookup_probes_keys_of_the_same_slot(self, tmp_path, monkeypatch):
+        # different hashes with the same low bits end in the same slot
+        hashes = {}
+        monkeypatch.setattr(attribution_index, '_hash',
+                            lambda key: hashes.setdefault(key, (len(hashes) + 1) << 32))
+        path = _write_index(tmp_path, _get_entries())
+        index = AttributionIndex(path)
+        try:
+            _check_lookups(index)
+        finally:
+            index.close()
+
+    def test_empty_snapshot(self, tmp_path):
+        path = _write_index(tmp_path, {})
+        index = AttributionIndex(path)
+        try:
+            assert index.get_package('dataset-a') is None
+        finally:
+            index.close()
+
+    def test_not_a_snapshot(self, tmp_path):
+        path = tmp_path / 'attribution.idx'
+        path.write_bytes(b'x' * 100)
+        assert read_fingerprint(str(path)) is None
+        with pytest.raises(ValueError):
+            AttributionIndex(str(path))
@@ -0,0 +1,106 @@
+# Copyright (C) 2025 Entidad Pública Empresarial Red.es
+#
+# This file is part of "dge-ga-report (datos.gob.es)".
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import pytest
+
+from ckanext.dge_ga_report.download_analytics import (DownloadAnalytics, DownloadError,
+                                                      decode_ga4_rows, _compare_rows)
+
+
+def _response(headers, rows):
+    return {
+        'dimensionHeaders': [{'name': header} for header in headers],
+        'rows': [{'dimensionValues': [{'value': value} for value in dimensions],
+                  'metricValues': [{'value': value} for value in metrics]}
+                 for dimensions, metrics in rows],
+    }
+
+
+class TestDecodeGa4Rows(object):
+
+    def test_decodes_dimensions_and_metrics(self):
+        response = _response(['date', 'pagePath'], [
+            (['20240501', '/dataset/a'], ['12']),
+            (['20240502', '/dataset/b'], ['1.5']),
+        ])
+        assert decode_ga4_rows(response) == [
+            ('2024-05-01', '/dataset/a', 12),
+            ('2024-05-02', '/dataset/b', 1.5),
+        ]
+
+    def test_empty_response(self):
+        assert decode_ga4_rows({}) == []
+        assert decode_ga4_rows({}, date_ranges=True) == []
+
+    def test_date_ranges(self):
+        response = _response(['pagePath', 'dateRange'], [
+            (['/dataset/a', '2024-04'], ['3']),
+            (['/dataset/a', '2024-05'], ['4']),
+        ])
+        assert decode_ga4_rows(response, date_ranges=True) == [
+            ('2024-04', ('/dataset/a', 3)),
+            ('2024-05', ('/dataset/a', 4)),
+        ]
+
+    def test_date_ranges_without_other_dimensions(self):
+        response = _response(['dateRange'], [(['2024-04'], ['7'])])
+        assert decode_ga4_rows(response, date_ranges=True) == [('2024-04', (7,))]
+
+    def test_missing_date_range_dimension(self):
+        response = _response(['pagePath'], [(['/dataset/a'], ['3'])])
+        with pytest.raises(DownloadError):
+            decode_ga4_rows(response, date_ranges=True)
+
+
+class TestGa4Request(object):
+
+    def test_named_date_ranges_request_the_date_range_dimension(self):
+        params = {'metrics': 'screenPageViews', 'dimensions': [{'name': 'pagePath'}], 'filters': None}
+        date_ranges = [{'name': '2024-04', 'startDate': '2024-04-01', 'endDate': '2024-04-30'},
+                       {'name': '2024-05', 'startDate': '2024-05-01', 'endDate': '2024-05-31'}]
+        request = DownloadAnalytics()._get_ga4_request(params, date_ranges, 0, 10)
+        assert request['dimensions'] == [{'name': 'pagePath'}, {'name': 'dateRange'}]
+        assert params['dimensions'] == [{'name': 'pagePath'}]
+
+    def test_single_date_range(self):
+        params = {'metrics': 'screenPageViews', 'dimensions': None, 'filters': None}
+        date_ranges = [{'startDate': '2024-04-01', 'endDate': '2024-04-30'}]
+        request = DownloadAnalytics()._get_ga4_request(params, date_ranges, 0, 10)
+        assert 'dimensions' not in request
+
+
+class TestCompareRows(object):
+
+    def test_equal_rows(self):
+        rows = [('/dataset/a', 1), ('/dataset/b', 2)]
+        assert list(_compare_rows(rows, list(rows))) == []
+
+    def test_different_and_missing_rows(self):
+        rows = [('/dataset/a', 1), ('/dataset/b', 2), ('/dataset/d', 4)]
+        other_rows = [('/dataset/a', 1), ('/dataset/b', 3), ('/dataset/c', 5)]
+        assert list(_compare_rows(rows, other_rows)) == [
+            (('/dataset/b',), 2, 3),
+            (('/dataset/c',), None, 5),
+            (('/dataset/d',), 4, None),
+        ]
+
+    def test_rows_with_several_dimensions(self):
+        rows = [('/r/1.csv', '/dataset/a', 1)]
+        other_rows = [('/r/1.csv', '/dataset/a', 1), ('/r/1.csv', '/dataset/b', 2)]
+        assert list(_compare_rows(rows, other_rows)) == [
+            (('/r/1.csv', '/dataset/b'), None, 2),
+        ]
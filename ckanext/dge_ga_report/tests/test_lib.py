@@ -0,0 +1,71 @@
+# Copyright (C) 2025 Entidad Pública Empresarial Red.es
+#
+# This file is part of "dge-ga-report (datos.gob.es)".
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from ckanext.dge_ga_report.lib import SpillingAggregator, RowTotals
+
+
+class TestSpillingAggregator(object):
+
+    def test_adds_up_values_by_key(self):
+        aggregator = SpillingAggregator(max_keys=10)
+        aggregator.add(('b',), 1)
+        aggregator.add(('a',), 2)
+        aggregator.add(('b',), 3)
+        assert list(aggregator) == [(('a',), 2), (('b',), 4)]
+        assert aggregator._runs == []
+
+    def test_spills_and_merges_sorted_runs(self):
+        aggregator = SpillingAggregator(max_keys=2)
+        for key, value in (('c', 1), ('a', 1), ('b', 1), ('a', 2), ('d', 5), ('c', 3), ('a', 1)):
+            aggregator.add((key,), value)
+        assert len(aggregator._runs) >= 2
+        assert list(aggregator) == [(('a',), 4), (('b',), 1), (('c',), 4), (('d',), 5)]
+
+    def test_can_be_read_again_until_closed(self):
+        aggregator = SpillingAggregator(max_keys=1)
+        aggregator.add(('a', 'x'), 1)
+        aggregator.add(('b', 'y'), 2)
+        aggregator.add(('a', 'x'), 3)
+        expected = [(('a', 'x'), 4), (('b', 'y'), 2)]
+        assert list(aggregator) == expected
+        assert list(aggregator) == expected
+        aggregator.close()
+        assert list(aggregator) == []
+        assert len(aggregator) == 0
+
+
+class TestRowTotals(object):
+
+    def test_adds_up_rows_by_dimensions(self):
+        rows = RowTotals(max_keys=2).add_rows([
+            ('/dataset/b', '/dataset/b', '3'),
+            ('/dataset/a', '', 1),
+            ('/dataset/b', '/dataset/b', 2),
+            ('/dataset/c', '', '1.5'),
+            ('/dataset/a', '', None),
+        ])
+        rows.add_row(('/dataset/a', '', 4))
+        assert list(rows) == [
+            ('/dataset/a', '', 5),
+            ('/dataset/b', '/dataset/b', 5),
+            ('/dataset/c', '', 1.5),
+        ]
+
+    def test_empty(self):
+        rows = RowTotals(max_keys=2)
+        assert list(rows) == []
+        assert len(rows) == 0
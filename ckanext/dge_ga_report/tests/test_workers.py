@@ -0,0 +1,58 @@
+# Copyright (C) 2025 Entidad Pública Empresarial Red.es
+#
+# This file is part of "dge-ga-report (datos.gob.es)".
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from ckanext.dge_ga_report.workers import pack_rows, unpack_rows, _add_up, _get_chunks
+
+
+class TestPackRows(object):
+
+    def test_round_trip(self):
+        rows = [
+            ('/dataset/a', '/dataset/a', 10),
+            ('/recurso/año.csv', '', 0),
+            ('http://example.com/€?x=1', '/dataset/b', 2 ** 40),
+        ]
+        assert unpack_rows(pack_rows(rows)) == rows
+
+    def test_empty_and_missing_values(self):
+        packed = pack_rows([('/dataset/a', None, None), ('', '/dataset/b', '3')])
+        assert unpack_rows(packed) == [('/dataset/a', '', 0), ('', '/dataset/b', 3)]
+
+    def test_rows_with_a_single_dimension(self):
+        rows = [('/dataset/a', 1), ('/dataset/b', 2)]
+        width, data, lengths, metrics = pack_rows(rows)
+        assert width == 1
+        assert data == b'/dataset/a/dataset/b'
+        assert unpack_rows((width, data, lengths, metrics)) == rows
+
+    def test_no_rows(self):
+        assert unpack_rows(pack_rows([])) == []
+
+    def test_packs_iterators(self):
+        rows = [('/dataset/a', 1), ('/dataset/b', 2)]
+        assert unpack_rows(pack_rows(iter(rows))) == rows
+
+
+class TestRowHelpers(object):
+
+    def test_add_up(self):
+        totals = _add_up([('/dataset/a', 1), ('/dataset/b', '2'), ('/dataset/a', None)])
+        assert _add_up([('/dataset/a', 3)], totals) == {('/dataset/a',): 4, ('/dataset/b',): 2}
+
+    def test_get_chunks(self):
+        assert list(_get_chunks(range(5), 2)) == [[0, 1], [2, 3], [4]]
+        assert list(_get_chunks([], 2)) == []
@@ -0,0 +1,115 @@
+# Copyright (C) 2025 Entidad Pública Empresarial Red.es
+#
+# This file is part of "dge-ga-report (datos.gob.es)".
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import socket
+import logging
+import threading
+
+import httplib2
+import requests
+from requests.adapters import HTTPAdapter
+
+from ckan.plugins.toolkit import (config, asint)
+
+log = logging.getLogger(__name__)
+
+TRANSPORT_REQUESTS = 'requests'
+TRANSPORT_HTTPLIB2 = 'httplib2'
+
+_lock = threading.Lock()
+_adapter = None
+_thread_data = threading.local()
+
+
+def get_transport():
+    return config.get('ckanext-dge-ga-report.http.transport', TRANSPORT_REQUESTS)
+
+
+def is_thread_safe():
+    '''Returns True if the GA requests can be made concurrently with the
+    same http object'''
+    return get_transport() == TRANSPORT_REQUESTS
+
+
+def get_timeout():
+    return (asint(config.get('ckanext-dge-ga-report.http.connect_timeout', 10)),
+            asint(config.get('ckanext-dge-ga-report.http.read_timeout', 120)))
+
+
+def _get_adapter():
+    '''Returns the connection pool shared by the sessions of all the threads'''
+    global _adapter
+    with _lock:
+        if _adapter is None:
+            pool_size = asint(config.get('ckanext-dge-ga-report.http.pool_size', 10))
+            _adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        return _adapter
+
+
+def get_session():
+    '''
+    Returns the requests session of the current thread. Sessions are not
+    shared between threads, but they all use the same pool of keep-alive
+    connections.
+    '''
+    session = getattr(_thread_data, 'session', None)
+    if session is None:
+        session = requests.Session()
+        adapter = _get_adapter()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers['Accept-Encoding'] = 'gzip, deflate'
+        _thread_data.session = session
+    return session
+
+
+class RequestsHttp(object):
+    '''
+    httplib2.Http compatible object that makes the requests with the
+    pooled sessions, so it can be authorized by oauth2client and used by
+    googleapiclient.
+    '''
+
+    redirect_codes = frozenset((300, 301, 302, 303, 307))
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout or get_timeout()
+
+    def request(self, uri, method='GET', body=None, headers=None,
+                redirections=httplib2.DEFAULT_MAX_REDIRECTS, connection_type=None):
+        try:
+            response = get_session().request(method, uri, data=body, headers=headers,
+                                             timeout=self.timeout,
+                                             allow_redirects=bool(redirections))
+        except requests.exceptions.Timeout as e:
+            raise socket.timeout(str(e))
+        except requests.exceptions.ConnectionError as e:
+            raise ConnectionError(str(e))
+        info = dict((key.lower(), value) for key, value in response.headers.items())
+        # the content is already decoded by requests
+        info.pop('content-encoding', None)
+        info.pop('content-length', None)
+        info['status'] = str(response.status_code)
+        return httplib2.Response(info), response.content
+
+
+def get_http():
+    '''Returns the http object for googleapiclient configured by
+    ckanext-dge-ga-report.http.transport'''
+    if get_transport() == TRANSPORT_HTTPLIB2:
+        return httplib2.Http(timeout=get_timeout()[1])
+    return RequestsHttp()
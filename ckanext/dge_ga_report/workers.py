@@ -0,0 +1,286 @@
+# Copyright (C) 2025 Entidad Pública Empresarial Red.es
+#
+# This file is part of "dge-ga-report (datos.gob.es)".
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Pool of worker processes for the CPU work of the backfills: normalizing
+and classifying the rows returned by GA, decoding the archive, adding up
+the rows of the same url in each process, and resolving the attribution
+of the urls in the attribution snapshot, without database connections.
+
+Rows are sent between processes packed in buffers: the utf-8 strings of
+the rows concatenated, their lengths and the metrics as arrays of
+integers, instead of pickled tuples. The rows are sent and added up in
+chunks, with a bounded number of chunks in flight, so the memory used
+does not grow with the size of the report.
+'''
+
+import os
+import json
+import array
+import logging
+import tempfile
+import itertools
+import threading
+import collections
+import multiprocessing
+import concurrent.futures
+
+from ckan.plugins.toolkit import (config, asint)
+
+from .lib import RowTotals, get_spill_dir
+
+log = logging.getLogger(__name__)
+
+_pool = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+# path of the attribution snapshot opened by the workers, if it was built
+_snapshot_path = None
+# attribution snapshot opened in a worker process
+_index = None
+
+
+def get_workers():
+    return asint(config.get('ckanext-dge-ga-report.backfill.workers', 1))
+
+
+def get_chunk_size():
+    return asint(config.get('ckanext-dge-ga-report.backfill.workers.chunk_size', 50000))
+
+
+def _start_worker():
+    return True
+
+
+def start_pool(workers):
+    '''
+    Starts the pool of worker processes used by the classification of the
+    rows, the reprocessing of the archive and the attribution of the urls.
+    It must be started before other threads, as processes are forked so
+    they share the configuration.
+
+    The attribution snapshot is built first if the catalog has changed
+    since it was last built. If it cannot be built, the attribution is
+    resolved against the database.
+    '''
+    global _pool, _pool_workers, _snapshot_path
+    with _pool_lock:
+        if _pool is None and workers > 1:
+            from . import attribution_index
+
+            try:
+                attribution_index.ensure_snapshot()
+                _snapshot_path = attribution_index.get_snapshot_path()
+            except Exception as e:
+                log.warning('Unable to build the attribution snapshot, the attribution '
+                            'is resolved against the database: %s', e)
+                _snapshot_path = None
+            _pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+            # fork all the processes now
+            list(_pool.map(_start_worker, range(workers)))
+            _pool_workers = workers
+            log.info('Started %d worker processes', workers)
+    return _pool
+
+
+def get_pool():
+    return _pool
+
+
+def shutdown_pool():
+    global _pool, _snapshot_path
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown()
+            _pool = None
+            _snapshot_path = None
+
+
+def has_snapshot():
+    '''Returns True if the workers resolve the attribution of the urls in
+    the attribution snapshot'''
+    return _pool is not None and _snapshot_path is not None
+
+
+def pack_rows(rows):
+    '''
+    Packs rows of strings ending with an integer metric. Returns the
+    number of strings of each row, the utf-8 strings concatenated, their
+    lengths and the metrics.
+    '''
+    width = None
+    data = bytearray()
+    lengths = array.array('I')
+    metrics = array.array('q')
+    for row in rows:
+        if width is None:
+            width = len(row) - 1
+        for value in row[:-1]:
+            value = (value or '').encode('utf-8')
+            data += value
+            lengths.append(len(value))
+        metrics.append(int(row[-1] or 0))
+    return width or 0, bytes(data), lengths.tobytes(), metrics.tobytes()
+
+
+def unpack_rows(buffers):
+    '''Returns the list of rows packed by pack_rows'''
+    width, data, length_bytes, metric_bytes = buffers
+    lengths = array.array('I')
+    lengths.frombytes(length_bytes)
+    metrics = array.array('q')
+    metrics.frombytes(metric_bytes)
+    data = memoryview(data)
+    rows = []
+    offset = 0
+    index = 0
+    for metric in metrics:
+        row = []
+        for length in lengths[index:index + width]:
+            row.append(str(data[offset:offset + length], 'utf-8'))
+            offset += length
+        index += width
+        row.append(metric)
+        rows.append(tuple(row))
+    return rows
+
+
+def _add_up(rows, totals=None):
+    totals = {} if totals is None else totals
+    for row in rows:
+        key = tuple(row[:-1])
+        totals[key] = totals.get(key, 0) + int(row[-1] or 0)
+    return totals
+
+
+def _get_chunks(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _classify_chunk(stat, daily, buffers):
+    from .download_analytics import classify_rows
+
+    totals = _add_up(classify_rows(stat, unpack_rows(buffers), daily))
+    return pack_rows(key + (value,) for key, value in totals.items())
+
+
+def classify_rows(stat, rows, daily=False):
+    '''
+    Classifies the package or resource rows returned by GA in the worker
+    processes. The rows are read and sent in chunks, each process adds up
+    the rows of the same url of its chunk and the partial totals are added
+    up here, at most two chunks per process being in flight.
+    Returns the rows in RowTotals.
+    '''
+    from . import download_analytics
+
+    chunks = _get_chunks(rows, get_chunk_size())
+    first_chunks = list(itertools.islice(chunks, 2))
+    if len(first_chunks) < 2:
+        # a single chunk is not worth sending
+        return RowTotals().add_rows(download_analytics.classify_rows(
+            stat, first_chunks[0] if first_chunks else [], daily))
+    totals = RowTotals()
+    pending = collections.deque()
+    count = 0
+    for chunk in itertools.chain(first_chunks, chunks):
+        pending.append(_pool.submit(_classify_chunk, stat, daily, pack_rows(chunk)))
+        count += 1
+        if len(pending) >= _pool_workers * 2:
+            totals.add_rows(unpack_rows(pending.popleft().result()))
+    while pending:
+        totals.add_rows(unpack_rows(pending.popleft().result()))
+    log.debug('Classified the rows of stat %s in %d chunks', stat, count)
+    return totals
+
+
+def _read_archive(period_name, stat):
+    '''Adds up the archived rows by url within the row budget and writes
+    them to a temporary file. Returns its path.'''
+    from . import archive
+
+    totals = RowTotals()
+    for rows in archive.read_archive(period_name, stat):
+        totals.add_rows(rows)
+    fd, path = tempfile.mkstemp(suffix='.jsonl', dir=get_spill_dir())
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as result:
+            for row in totals:
+                result.write(json.dumps(row) + '\n')
+    except Exception:
+        os.remove(path)
+        raise
+    finally:
+        totals.close()
+    return path
+
+
+def _read_result(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as result:
+            for line in result:
+                yield tuple(json.loads(line))
+    finally:
+        os.remove(path)
+
+
+def read_archive_rows(period_name, stat):
+    '''Returns an iterator of the archived rows of the stat in the period
+    added up by url. The archive is decoded in a worker process, so the
+    archives of several periods reprocessed at the same time are decoded
+    in parallel, and the rows are passed through a temporary file.'''
+    return _read_result(_pool.submit(_read_archive, period_name, stat).result())
+
+
+def _get_index(path):
+    global _index
+    if _index is None or _index.path != path:
+        from .attribution_index import AttributionIndex
+
+        _index = AttributionIndex(path)
+    return _index
+
+
+def _resolve_chunk(path, kind, keys):
+    from .attribution_index import MappedIdentifier
+
+    identifier = MappedIdentifier(_get_index(path))
+    if kind == 'package':
+        return [identifier.get_package_information(key) for key in keys]
+    return [identifier.get_resource_information(*key) for key in keys]
+
+
+def resolve_attributions(kind, keys):
+    '''
+    Returns a dict with the attribution of every key, resolved in the
+    worker processes with the attribution snapshot: the package information
+    of package urls if kind is 'package', or the resource information of
+    (resource url, package url) keys if kind is 'resource'.
+    '''
+    chunk_size = max(1, -(-len(keys) // _pool_workers))
+    chunks = [keys[index:index + chunk_size] for index in range(0, len(keys), chunk_size)]
+    futures = [_pool.submit(_resolve_chunk, _snapshot_path, kind, chunk) for chunk in chunks]
+    attributions = {}
+    for chunk, future in zip(chunks, futures):
+        attributions.update(zip(chunk, future.result()))
+    return attributions